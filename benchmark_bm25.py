@@ -0,0 +1,74 @@
+"""
+Latency and top-k parity of the in-process BM25 retriever against Elasticsearch.
+
+    python benchmark_bm25.py --docs_path data/80000_docs --collection_name docs_80k --task quest_answer
+"""
+import argparse
+import time
+
+import numpy as np
+
+from src.datasets.xinhua import get_task_datasets
+from src.retrievers import CustomBM25Retriever
+from src.retrievers.local_bm25 import LocalBM25Retriever
+
+QUERY_FIELDS = {
+    'event_summary': 'event',
+    'continuing_writing': 'beginning',
+    'hallu_modified': 'newsBeginning',
+    'quest_answer': 'questions',
+}
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_path', default='data/crud_split/split_merged.json', help="Path to the dataset")
+parser.add_argument('--task', default='quest_answer', choices=list(QUERY_FIELDS), help="Task whose queries are searched")
+parser.add_argument('--num_queries', type=int, default=500, help="Number of queries to search")
+parser.add_argument('--docs_path', default='data/80000_docs', help="Path to the retrieval documents")
+parser.add_argument('--chunk_size', type=int, default=128, help="Chunk size")
+parser.add_argument('--chunk_overlap', type=int, default=0, help="Overlap chunk size")
+parser.add_argument('--collection_name', default='docs_80k', help="Name of the Elasticsearch index and of the local index")
+parser.add_argument('--index_directory', default='./index', help="Directory of the local indexes")
+parser.add_argument('--construct_index', action='store_true', help="Whether to construct the local index")
+parser.add_argument('--num_workers', type=int, default=0, help="Number of processes tokenizing the documents")
+parser.add_argument('--retrieve_top_k', type=int, default=8, help="Top k documents to retrieve")
+args = parser.parse_args()
+
+
+def timed(retriever, queries: list[str]) -> tuple[list[list[str]], np.ndarray]:
+    results, latencies = [], []
+    for query_text in queries:
+        start = time.perf_counter()
+        results.append([hit.text for hit in retriever.retrieve(query_text)])
+        latencies.append(time.perf_counter() - start)
+    return results, 1000 * np.array(latencies)
+
+
+if __name__ == '__main__':
+    dataset = get_task_datasets(args.data_path, args.task)[0]
+    queries = [obj[QUERY_FIELDS[args.task]] for obj in dataset[:args.num_queries]]
+
+    es = CustomBM25Retriever(
+        args.docs_path, embed_model=None, chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap,
+        collection_name=args.collection_name, similarity_top_k=args.retrieve_top_k,
+    )
+    local = LocalBM25Retriever(
+        args.docs_path, chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap,
+        collection_name=args.collection_name, construct_index=args.construct_index,
+        similarity_top_k=args.retrieve_top_k, index_directory=args.index_directory,
+        num_workers=args.num_workers,
+    )
+    # Warm up jieba and the connection pool
+    es.retrieve(queries[0])
+    local.retrieve(queries[0])
+
+    es_results, es_latencies = timed(es, queries)
+    local_results, local_latencies = timed(local, queries)
+    for name, latencies in (('elasticsearch', es_latencies), ('local', local_latencies)):
+        print(
+            f"{name:>13}: p50 {np.percentile(latencies, 50):7.2f} ms, "
+            f"p95 {np.percentile(latencies, 95):7.2f} ms, mean {latencies.mean():7.2f} ms"
+        )
+    overlap = [
+        len(set(a) & set(b)) / max(len(a), 1) for a, b in zip(es_results, local_results)
+    ]
+    print(f"Top-{args.retrieve_top_k} overlap with Elasticsearch: {np.mean(overlap):.3f}")
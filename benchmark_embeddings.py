@@ -0,0 +1,68 @@
+"""
+Memory and throughput of document embedding, comparing lists of Python floats with
+float32 arrays.
+
+    python benchmark_embeddings.py --docs_path data/80000_docs --num_texts 8000
+"""
+import argparse
+import gc
+import os
+import time
+import tracemalloc
+
+import numpy as np
+from llama_index import SimpleDirectoryReader
+from llama_index.node_parser import SimpleNodeParser
+from llama_index.schema import MetadataMode
+
+from src.embeddings.base import HuggingfaceEmbeddings
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--embedding_name', default='sentence-transformers/bge-base-zh-v1.5')
+parser.add_argument('--docs_path', default='data/tmp', help="Path to the documents to embed")
+parser.add_argument('--chunk_size', type=int, default=128, help="Chunk size")
+parser.add_argument('--num_texts', type=int, default=8000, help="Number of chunks to embed")
+parser.add_argument('--batch_size', type=int, default=32, help="Batch size of `encode`")
+args = parser.parse_args()
+
+
+def load_texts() -> list[str]:
+    documents = SimpleDirectoryReader(args.docs_path).load_data()
+    nodes = SimpleNodeParser.from_defaults(chunk_size=args.chunk_size).get_nodes_from_documents(documents)
+    texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+    # Repeat the corpus if it is smaller than asked
+    return (texts * (args.num_texts // max(len(texts), 1) + 1))[:args.num_texts]
+
+
+def run(name: str, embed_model: HuggingfaceEmbeddings, texts: list[str], to_output) -> None:
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    embeddings = embed_model.model.encode(texts, normalize_embeddings=True, **embed_model.encode_kwargs)
+    encoded = time.perf_counter()
+    output = to_output(embeddings)
+    end = time.perf_counter()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"{name:>8}: encode {len(texts) / (encoded - start):8.1f} texts/s, "
+        f"conversion {1000 * (end - encoded):8.1f} ms, peak Python memory {peak / 2 ** 20:8.1f} MB"
+    )
+    del output
+
+
+if __name__ == '__main__':
+    texts = load_texts()
+    print(f"{len(texts)} chunks from {args.docs_path}, {os.cpu_count()} CPUs")
+
+    as_list = HuggingfaceEmbeddings(
+        model_name=args.embedding_name, cache_size=0,
+        encode_kwargs={'convert_to_tensor': True, 'batch_size': args.batch_size},
+    )
+    run('list', as_list, texts, lambda embeddings: embeddings.tolist())
+
+    as_array = HuggingfaceEmbeddings(
+        model_name=args.embedding_name, cache_size=0,
+        encode_kwargs={'convert_to_numpy': True, 'batch_size': args.batch_size},
+    )
+    run('float32', as_array, texts, lambda embeddings: np.ascontiguousarray(embeddings, dtype=np.float32))
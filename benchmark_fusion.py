@@ -0,0 +1,70 @@
+"""
+Latency and quality of the hybrid retriever fusions at several candidate depths.
+
+Quality is the fraction of queries whose top-k contains a chunk of the source news
+of the question (`news1`), and the overlap of the top-k with the default RRF at
+depth `retrieve_top_k`.
+
+    python benchmark_fusion.py --collection_name docs_80k_chuncksize_128_0 --depths 8 16 32 64
+"""
+import argparse
+import time
+
+import numpy as np
+
+from src.datasets.xinhua import get_task_datasets
+from src.embeddings.base import HuggingfaceEmbeddings
+from src.retrievers import EnsembleRetriever
+from src.retrievers.fusion import FUSION_METHODS, fuse
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_path', default='data/crud_split/split_merged.json', help="Path to the dataset")
+parser.add_argument('--num_queries', type=int, default=200, help="Number of questions to search")
+parser.add_argument('--embedding_name', default='sentence-transformers/bge-base-zh-v1.5')
+parser.add_argument('--embedding_dim', type=int, default=768)
+parser.add_argument('--docs_path', default='data/80000_docs', help="Path to the retrieval documents")
+parser.add_argument('--collection_name', default='docs_80k_chuncksize_128_0', help="Name of the collection")
+parser.add_argument('--retrieve_top_k', type=int, default=8, help="Top k documents after fusion")
+parser.add_argument('--depths', type=int, nargs='+', default=[8, 16, 32, 64], help="Candidate depths of both legs")
+parser.add_argument('--normalization', default='minmax', choices=['minmax', 'zscore', 'none'])
+args = parser.parse_args()
+
+
+def source_hit(hits, news: str) -> bool:
+    return any(hit.text.strip() and hit.text.strip() in news for hit in hits)
+
+
+if __name__ == '__main__':
+    dataset = get_task_datasets(args.data_path, 'quest_answer')[0][:args.num_queries]
+    retriever = EnsembleRetriever(
+        args.docs_path, embed_model=HuggingfaceEmbeddings(model_name=args.embedding_name),
+        embed_dim=args.embedding_dim, collection_name=args.collection_name,
+        similarity_top_k=args.retrieve_top_k,
+    )
+    retriever.search_docs(dataset[0]['questions'])  # warm up
+
+    reference = [
+        {hit.text for hit in retriever.retrieve(obj['questions'])} for obj in dataset
+    ]
+    for depth in args.depths:
+        retriever.fan_out.depths = {'bm25': depth, 'embedding': depth}
+        start = time.perf_counter()
+        hit_lists = [retriever.fan_out.retrieve(obj['questions']) for obj in dataset]
+        legs_ms = 1000 * (time.perf_counter() - start) / len(dataset)
+
+        for method in FUSION_METHODS:
+            start = time.perf_counter()
+            fused = [
+                fuse(hits, method, retriever.weights, retriever.c, args.normalization, args.retrieve_top_k)
+                for hits in hit_lists
+            ]
+            fuse_ms = 1000 * (time.perf_counter() - start) / len(dataset)
+            overlap = np.mean([
+                len(ref & {hit.text for hit in hits}) / max(len(ref), 1) for ref, hits in zip(reference, fused)
+            ])
+            source_rate = np.mean([source_hit(hits, obj.get('news1', '')) for obj, hits in zip(dataset, fused)])
+            print(
+                f"depth {depth:>4} {method:>8}: legs {legs_ms:7.2f} ms, fusion {fuse_ms:6.3f} ms, "
+                f"source hit rate {source_rate:.3f}, overlap with RRF@{args.retrieve_top_k} {overlap:.3f}"
+            )
+    print(retriever.latency_summary())
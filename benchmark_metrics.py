@@ -0,0 +1,67 @@
+"""
+Per-sample latency of BLEU and ROUGE-L with the metrics loaded once per process by
+`load_metric`, against loading them with `evaluate.load` for every sample.
+
+The answers of the question answering data points are scored against the beginning
+of their source news, which stands in for generated answers.
+
+    python benchmark_metrics.py --num_samples 200
+"""
+import argparse
+import time
+
+import evaluate
+import numpy as np
+
+from src.datasets.xinhua import get_task_datasets
+from src.metric.common import bleu_score, jieba_cut, rougeL_score, tokenization_cache
+
+BLEU_PATH = 'src/.cache/huggingface/bleu'
+ROUGE_PATH = 'src/.cache/huggingface/rouge'
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_path', default='data/crud_split/split_merged.json', help="Path to the dataset")
+parser.add_argument('--num_samples', type=int, default=200, help="Number of samples to score")
+args = parser.parse_args()
+
+
+def uncached_bleu(continuation: str, reference: str) -> float:
+    bleu = evaluate.load(BLEU_PATH)
+    return bleu.compute(predictions=[continuation], references=[[reference]], tokenizer=jieba_cut)['bleu']
+
+
+def uncached_rougeL(continuation: str, reference: str) -> float:
+    rouge = evaluate.load(ROUGE_PATH)
+    results = rouge.compute(
+        predictions=[continuation], references=[[reference]], tokenizer=jieba_cut, rouge_types=['rougeL']
+    )
+    return results['rougeL']
+
+
+def timed(score_fn, pairs: list[tuple[str, str]]) -> np.ndarray:
+    # Every run segments the texts with jieba again
+    tokenization_cache.clear()
+    latencies = []
+    for continuation, reference in pairs:
+        start = time.perf_counter()
+        score_fn(continuation, reference)
+        latencies.append(time.perf_counter() - start)
+    return 1000 * np.array(latencies)
+
+
+if __name__ == '__main__':
+    dataset = get_task_datasets(args.data_path, 'quest_answer')[0][:args.num_samples]
+    pairs = [(obj['news1'][:2 * len(obj['answers'])], obj['answers']) for obj in dataset]
+    # Warm up jieba, and load the cached metrics
+    bleu_score(*pairs[0])
+    rougeL_score(*pairs[0])
+
+    for name, score_fn in (
+        ('bleu cached', bleu_score), ('bleu evaluate.load', uncached_bleu),
+        ('rougeL cached', rougeL_score), ('rougeL evaluate.load', uncached_rougeL),
+    ):
+        latencies = timed(score_fn, pairs)
+        print(
+            f"{name:>20}: p50 {np.percentile(latencies, 50):7.2f} ms, "
+            f"p95 {np.percentile(latencies, 95):7.2f} ms, mean {latencies.mean():7.2f} ms"
+        )
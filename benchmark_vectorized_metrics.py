@@ -0,0 +1,71 @@
+"""
+Time and parity of the NumPy batch BLEU and ROUGE-L of `src.metric.vectorized`
+against `bleu_score` and `rougeL_score`, which go through `evaluate` one pair at a time.
+
+The answers of the question answering data points are scored against the beginning
+of their source news, which stands in for generated answers. Texts are segmented by
+jieba once, before timing, so that both sides only time the scoring.
+
+    python benchmark_vectorized_metrics.py --num_samples 1000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from src.datasets.xinhua import get_task_datasets
+from src.metric.common import bleu_score, jieba_cut, rougeL_score
+from src.metric.vectorized import Vocabulary, batch_bleu, batch_rougeL
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_path', default='data/crud_split/split_merged.json', help="Path to the dataset")
+parser.add_argument('--num_samples', type=int, default=1000, help="Number of samples to score")
+args = parser.parse_args()
+
+
+def max_difference(expected: np.ndarray, actual: np.ndarray) -> float:
+    """Largest absolute difference, where both sides fail on the same rows (NaN)."""
+    assert np.array_equal(np.isnan(expected), np.isnan(actual)), 'the failed rows differ'
+    valid = ~np.isnan(expected)
+    return float(np.abs(expected[valid] - actual[valid]).max(initial=0.0))
+
+
+if __name__ == '__main__':
+    dataset = [obj for split in get_task_datasets(args.data_path, 'quest_answer') for obj in split]
+    dataset = dataset[:args.num_samples]
+    continuations = [obj['news1'][:2 * len(obj['answers'])] for obj in dataset]
+    references = [obj['answers'] for obj in dataset]
+    for text in continuations + references:
+        jieba_cut(text)
+    # Load the cached metrics
+    bleu_score(continuations[0], references[0])
+    rougeL_score(continuations[0], references[0])
+
+    start = time.perf_counter()
+    expected_bleu = np.array([bleu_score(c, r) or [np.nan] * 5 for c, r in zip(continuations, references)])
+    bleu_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    expected_rouge = np.array([rougeL_score(c, r) for c, r in zip(continuations, references)], dtype=float)
+    rouge_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vocab = Vocabulary()
+    predictions, targets = vocab.encode_texts(continuations), vocab.encode_texts(references)
+    encode_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    actual_bleu = batch_bleu(predictions, targets)
+    batch_bleu_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    actual_rouge = batch_rougeL(predictions, targets)
+    batch_rouge_seconds = time.perf_counter() - start
+
+    print(f"{len(dataset)} pairs, token ids encoded in {encode_seconds:.3f}s")
+    for name, seconds, batch_seconds, expected, actual in (
+        ('bleu', bleu_seconds, batch_bleu_seconds, expected_bleu, actual_bleu),
+        ('rougeL', rouge_seconds, batch_rouge_seconds, expected_rouge, actual_rouge),
+    ):
+        print(
+            f"{name:>6}: evaluate {seconds:7.3f}s, numpy {batch_seconds:7.3f}s "
+            f"({seconds / max(batch_seconds + encode_seconds, 1e-9):.0f}x with encoding), "
+            f"max abs difference {max_difference(expected, actual):.2e}"
+        )
@@ -1,18 +1,27 @@
+import asyncio
 import copy
 import json
 import os
+import queue
+import threading
+import time
 from abc import ABC
 from loguru import logger
 from tqdm import tqdm
 from threading import Lock
 from src.llms.base import BaseLLM
+from src.llms.transport import close_async_session
 from src.tasks.base import BaseTask
 from src.retrievers.base import BaseRetriever
+from src.retrievers.contexts import load_contexts
+from src.metric.common import tokenization_cache
+from src.utils.checkpoint import ResultCheckpoint
 import concurrent.futures
 
 class BaseEvaluator(ABC):
     def __init__(self, task: BaseTask, model: BaseLLM, retriever: BaseRetriever,
-        dataset: list[dict], output_dir: str = './output', num_threads: int = 40):
+        dataset: list[dict], output_dir: str = './output', num_threads: int = 40,
+        retrieve_batch_size: int = 0, contexts_dir: str = None):
         """
         Args:
             model (BaseLLM): The large language model to be evaluated.
@@ -20,13 +29,21 @@ class BaseEvaluator(ABC):
             task (BaseTask): The task for evaluation.
             dataset (list[dict]): The dataset for evaluation.
             output_dir (str): The directory for result output and caching.
+            retrieve_batch_size (int): Number of data points whose contexts are retrieved
+                together before the evaluation, 0 retrieves each data point on its own.
+            contexts_dir (str): Directory of the contexts materialized by `materialize_contexts`,
+                which are used instead of retrieving when they come from the same retriever.
         """
         self.model = model
         self.retriever = retriever
         self.dataset = dataset
         self.task = task
         self.lock = Lock()
+        self.retrieve_lock = Lock()
         self.num_threads = num_threads
+        self.retrieve_batch_size = retrieve_batch_size
+        self.contexts_dir = contexts_dir
+        self.contexts = {}
 
         collection_name = self.retriever.collection_name
         similarity_top_k = self.retriever.similarity_top_k
@@ -37,22 +54,68 @@ class BaseEvaluator(ABC):
         self.output_path = os.path.join(
             output_dir, f'{self.task.__class__.__name__}_{model.params["model_name"]}.json'
         )
+        self.checkpoint = ResultCheckpoint(os.path.splitext(self.output_path)[0] + '.jsonl')
         self.task.set_model(self.model, self.retriever)
 
+    def load_contexts(self) -> None:
+        """Load the contexts materialized for this task and retriever, if any."""
+        if self.contexts_dir is None:
+            return
+        contexts = load_contexts(self.contexts_dir, self.task.__class__.__name__, self.retriever)
+        self.contexts.update(contexts)
+        logger.info(f'Loaded {len(contexts)} materialized contexts from {self.contexts_dir}')
+
+    def pre_retrieve(self, dataset: list[dict]) -> None:
+        """Retrieve the contexts of the data points still to evaluate, `retrieve_batch_size` at a time.
+
+        A batch that fails is left to be retrieved one data point at a time.
+        """
+        if self.retrieve_batch_size <= 0 or not hasattr(self.retriever, 'search_docs_batch'):
+            return
+        saved_ids = self.load_saved_ids()
+        todo = [
+            data_point for data_point in dataset
+            if data_point['ID'] not in saved_ids and data_point['ID'] not in self.contexts
+        ]
+        retrieved = 0
+        start = time.perf_counter()
+        for i in tqdm(range(0, len(todo), self.retrieve_batch_size), desc='Retrieval'):
+            batch = todo[i:i + self.retrieve_batch_size]
+            try:
+                contexts = self.task.retrieve_docs_batch(batch)
+            except Exception as e:
+                logger.warning(repr(e))
+                continue
+            for data_point, context in zip(batch, contexts):
+                self.contexts[data_point['ID']] = context
+            retrieved += len(contexts)
+        logger.info(f'Retrieved {retrieved}/{len(todo)} contexts in batches in {time.perf_counter() - start:.1f}s')
+
+    def retrieve(self, data_point) -> str:
+        """Retrieve the context of a data point, serialized only for retrievers that are not thread-safe."""
+        if data_point['ID'] in self.contexts:
+            return self.contexts.pop(data_point['ID'])
+        if getattr(self.retriever, 'thread_safe', False):
+            return self.task.retrieve_docs(data_point)
+        with self.retrieve_lock:
+            return self.task.retrieve_docs(data_point)
+
     def task_generation(self, data_point):
         try:
-            self.lock.acquire()
-            retrieve_context = self.task.retrieve_docs(data_point)
-            self.lock.release()
+            retrieve_context = self.retrieve(data_point)
             data_point["retrieve_context"] = retrieve_context
 
         except Exception as e:
             logger.warning(repr(e))
-            self.lock.release()
             data_point["retrieve_context"] = ''
 
         return self.task.model_generation(data_point)
 
+    @staticmethod
+    def _is_failed_generation(generated_text: str) -> bool:
+        """Whether the model gave no answer, including the error body that the GPT transit returns as text."""
+        return generated_text in ('', '","msg":"request openai failed"')
+
     def multithread_batch_scoring(self, dataset: list[dict], sort=True, show_progress_bar=False, contain_original_data=False) -> list[dict]:
         """Perform batch scoring on the given dataset.
 
@@ -62,24 +125,17 @@ class BaseEvaluator(ABC):
             show_progress_bar (bool): Whether to display a progress bar.
 
         Returns:
-            list[dict]: List of results.
+            list[dict]: List of results scored in this call, all results are in the checkpoint.
         """
 
-        if os.path.exists(self.output_path):  # Resume evaluation
-            results = self.read_output().get('results', [])
-            results = self.remove_invalid(results)
-            saved_ids = [result['id'] for result in results]
-        else:
-            results = []
-            saved_ids = []
+        saved_ids = self.load_saved_ids()
 
         def process_data_point(data_point):
             if data_point['ID'] in saved_ids:
                 return None  # Skip results that have already been evaluated and are valid
             try:
                 generated_text = self.task_generation(data_point)
-                # TODO fix bugs
-                if generated_text == '","msg":"request openai failed"' or generated_text == '':
+                if self._is_failed_generation(generated_text):
                     return None
                 
                 data_point["generated_text"] = generated_text
@@ -93,6 +149,7 @@ class BaseEvaluator(ABC):
                 if contain_original_data:
                     result['original_data'] = data_point
 
+                self.checkpoint.append(result)
                 return result
             
             except Exception as e:
@@ -102,10 +159,25 @@ class BaseEvaluator(ABC):
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_threads) as executor:
             future_results = list(tqdm(executor.map(process_data_point, dataset), total=len(dataset)))
         
-        results.extend([result for result in future_results if result is not None])
+        results = [result for result in future_results if result is not None]
         
         return sorted(results, key=lambda x: x['id']) if sort else results
 
+    def load_saved_ids(self) -> set:
+        """Ids with a valid result in the checkpoint, to resume the evaluation."""
+        if not self.checkpoint.exists() and os.path.exists(self.output_path):
+            # Output of a run that predates the checkpoint: move its results into the checkpoint once
+            for result in self.read_output().get('results', []):
+                self.checkpoint.append(result)
+            self.checkpoint.close()
+        return self.checkpoint.completed_ids()
+
+    def compact(self, sort=True) -> list[dict]:
+        """Read back one result per id from the checkpoint."""
+        self.checkpoint.close()
+        results = self.checkpoint.read_results()
+        return sorted(results, key=lambda x: x['id']) if sort else results
+
     def save_output(self, output: dict) -> None:
         """Save evaluation results."""
         with open(self.output_path, 'w', encoding='utf-8') as f:
@@ -131,7 +203,10 @@ class BaseEvaluator(ABC):
             'llm': str(self.model.params),
         }
 
-        results = self.multithread_batch_scoring(self.dataset, sort, show_progress_bar, contain_original_data)
+        self.load_contexts()
+        self.pre_retrieve(self.dataset)
+        self.multithread_batch_scoring(self.dataset, sort, show_progress_bar, contain_original_data)
+        results = self.compact(sort)
         valid_results = self.remove_invalid(results)
 
         try:
@@ -148,6 +223,15 @@ class BaseEvaluator(ABC):
 
         self.save_output(output:={'info': info, 'overall': overall, 'results': results})
         print(f'Output saved at {self.output_path}!')
+        logger.info(f'Tokenization cache: {tokenization_cache.info()}')
+        if getattr(self.model, 'cache', None) is not None:
+            logger.info(f'LLM response cache: {self.model.cache.info()}')
+        embedding_cache = getattr(getattr(self.retriever, 'embed_model', None), 'cache', None)
+        if embedding_cache is not None:
+            embedding_cache.flush()
+            logger.info(f'Query embedding cache: {embedding_cache.info()}')
+        if hasattr(self.retriever, 'latency_summary'):
+            logger.info(f'Retrieval latency: {self.retriever.latency_summary()}')
         return output
 
     @staticmethod
@@ -164,16 +248,11 @@ class BaseEvaluator(ABC):
             show_progress_bar (bool): Whether to display a progress bar.
         
         Returns:
-            list[dict]: List of results.
+            list[dict]: List of results scored in this call, all results are in the checkpoint.
         """
         
-        if os.path.exists(self.output_path):  # Resume evaluation
-            results = self.read_output().get('results', [])
-            results = self.remove_invalid(results)
-            saved_ids = [result['id'] for result in results]
-        else:
-            results = []
-            saved_ids = []
+        results = []
+        saved_ids = self.load_saved_ids()
 
         for data_point in (tqdm(dataset, desc=self.model.params['model_name']) if show_progress_bar else dataset):
             if data_point['ID'] in saved_ids:
@@ -184,8 +263,269 @@ class BaseEvaluator(ABC):
                 result = {'id': data_point['ID'], **self.task.scoring(data_point)}
                 if contain_original_data:
                     result['original_data'] = data_point
+                self.checkpoint.append(result)
                 results.append(result)
             except Exception as e:
                 logger.warning(repr(e))
 
         return sorted(results, key=lambda x: x['id']) if sort else results
+
+
+_scoring_task = None
+
+
+def _init_scoring_worker(task: BaseTask) -> None:
+    global _scoring_task
+    _scoring_task = task
+
+
+def _score_data_point(data_point: dict, task: BaseTask = None) -> tuple[dict, dict, float]:
+    """Score one data point, in a scoring process unless `task` is given."""
+    task = task or _scoring_task
+    start = time.perf_counter()
+    try:
+        score_dict = task.scoring(data_point)
+    except Exception as e:
+        logger.warning(repr(e))
+        score_dict = None
+    return score_dict, data_point, time.perf_counter() - start
+
+
+class StageStats:
+    """Busy time and throughput of one pipeline stage."""
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self._lock = Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self.items += 1
+            self.busy += seconds
+
+    def summary(self, wall_time: float) -> dict:
+        return {
+            'workers': self.workers,
+            'items': self.items,
+            'busy_seconds': round(self.busy, 3),
+            'utilization': round(self.busy / (wall_time * self.workers), 4) if wall_time > 0 else 0.0,
+        }
+
+
+class PipelineEvaluator(BaseEvaluator):
+    """Evaluator running retrieval, generation and scoring as overlapping stages.
+
+    Each stage has its own worker pool and the stages are connected by bounded queues:
+    I/O threads for retrieval and LLM calls, and a process pool for the CPU-bound
+    metrics so that jieba, BLEU and ROUGE do not compete with the LLM calls for the GIL.
+    Scoring falls back to threads when RAGQuestEval or bertScore is enabled, since
+    those need the shared QuestEval cache and model.
+    """
+    def __init__(self, task: BaseTask, model: BaseLLM, retriever: BaseRetriever,
+        dataset: list[dict], output_dir: str = './output', num_threads: int = 40,
+        num_retrieve_threads: int = 8, num_generate_threads: int = None,
+        num_score_workers: int = None, queue_size: int = 64, score_in_processes: bool = True,
+        retrieve_batch_size: int = 0, contexts_dir: str = None):
+        """
+        Args:
+            num_retrieve_threads (int): Number of retrieval threads.
+            num_generate_threads (int): Number of LLM threads, `num_threads` by default.
+            num_score_workers (int): Number of scoring workers, the number of CPUs by default.
+            queue_size (int): Capacity of the queues between the stages.
+            score_in_processes (bool): Whether to score in a process pool instead of threads.
+        """
+        super().__init__(task, model, retriever, dataset, output_dir, num_threads, retrieve_batch_size, contexts_dir)
+        self.num_retrieve_threads = num_retrieve_threads
+        self.num_generate_threads = num_generate_threads or num_threads
+        self.num_score_workers = num_score_workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.score_in_processes = score_in_processes and not (task.use_quest_eval or task.use_bert_score)
+        self.stage_stats = {}
+
+    def _detached_task(self) -> BaseTask:
+        """A copy of the task without the model and retriever, which cannot be sent to other processes."""
+        task = copy.copy(self.task)
+        task.__dict__.pop('model', None)
+        task.__dict__.pop('retriever', None)
+        return task
+
+    def multithread_batch_scoring(self, dataset: list[dict], sort=True, show_progress_bar=False, contain_original_data=False) -> list[dict]:
+        saved_ids = self.load_saved_ids()
+        todo = [data_point for data_point in dataset if data_point['ID'] not in saved_ids]
+
+        self.stage_stats = {
+            'retrieve': StageStats('retrieve', self.num_retrieve_threads),
+            'generate': StageStats('generate', self.num_generate_threads),
+            'score': StageStats('score', self.num_score_workers),
+        }
+        retrieve_queue = queue.Queue(maxsize=self.queue_size)
+        generate_queue = queue.Queue(maxsize=self.queue_size)
+        in_flight = threading.Semaphore(self.queue_size)
+        new_results = []
+        results_lock = Lock()
+        progress = tqdm(total=len(todo), disable=not show_progress_bar)
+
+        if self.score_in_processes:
+            score_executor = concurrent.futures.ProcessPoolExecutor(
+                self.num_score_workers, initializer=_init_scoring_worker, initargs=(self._detached_task(),)
+            )
+            score_fn = _score_data_point
+        else:
+            score_executor = concurrent.futures.ThreadPoolExecutor(self.num_score_workers)
+            score_fn = lambda data_point: _score_data_point(data_point, self.task)
+
+        def on_scored(future):
+            in_flight.release()
+            try:
+                score_dict, data_point, elapsed = future.result()
+            except Exception as e:
+                logger.warning(repr(e))
+                score_dict = None
+            else:
+                self.stage_stats['score'].record(elapsed)
+            if score_dict is not None:
+                result = {'id': data_point['ID'], **score_dict}
+                if contain_original_data:
+                    result['original_data'] = data_point
+                self.checkpoint.append(result)
+                with results_lock:
+                    new_results.append(result)
+            progress.update()
+
+        def retrieve_worker():
+            while (data_point := retrieve_queue.get()) is not None:
+                start = time.perf_counter()
+                try:
+                    data_point["retrieve_context"] = self.retrieve(data_point)
+                except Exception as e:
+                    logger.warning(repr(e))
+                    data_point["retrieve_context"] = ''
+                self.stage_stats['retrieve'].record(time.perf_counter() - start)
+                generate_queue.put(data_point)
+
+        def generate_worker():
+            while (data_point := generate_queue.get()) is not None:
+                start = time.perf_counter()
+                try:
+                    generated_text = self.task.model_generation(data_point)
+                except Exception as e:
+                    logger.warning(repr(e))
+                    generated_text = ''
+                self.stage_stats['generate'].record(time.perf_counter() - start)
+                if self._is_failed_generation(generated_text):
+                    progress.update()
+                    continue
+                data_point["generated_text"] = generated_text
+                in_flight.acquire()
+                try:
+                    score_future = score_executor.submit(score_fn, data_point)
+                except Exception as e:  # e.g. BrokenProcessPool after a scoring process died
+                    logger.warning(f'Scoring {data_point["ID"]} in this thread: {e!r}')
+                    score_future = concurrent.futures.Future()
+                    score_future.set_result(_score_data_point(data_point, self.task))
+                score_future.add_done_callback(on_scored)
+
+        def start_workers(target, num):
+            workers = [threading.Thread(target=target, daemon=True) for _ in range(num)]
+            for worker in workers:
+                worker.start()
+            return workers
+
+        start = time.perf_counter()
+        with score_executor:
+            if self.score_in_processes:
+                # The pool forks its processes lazily, start them before any other thread can hold a lock
+                concurrent.futures.wait([score_executor.submit(os.getpid) for _ in range(self.num_score_workers)])
+            retrieve_workers = start_workers(retrieve_worker, self.num_retrieve_threads)
+            generate_workers = start_workers(generate_worker, self.num_generate_threads)
+            for data_point in todo:
+                retrieve_queue.put(data_point)
+            for _ in retrieve_workers:
+                retrieve_queue.put(None)
+            for worker in retrieve_workers:
+                worker.join()
+            for _ in generate_workers:
+                generate_queue.put(None)
+            for worker in generate_workers:
+                worker.join()
+        progress.close()
+        wall_time = time.perf_counter() - start
+
+        for name, stats in self.stage_stats.items():
+            logger.info(f'Stage {name}: {stats.summary(wall_time)}')
+
+        return sorted(new_results, key=lambda x: x['id']) if sort else new_results
+
+
+class AsyncEvaluator(BaseEvaluator):
+    """Evaluator driving all LLM calls from one asyncio event loop.
+
+    Generation awaits `BaseLLM.arequest`, so hundreds of requests can be in flight
+    without one OS thread each. Retrieval and scoring are blocking and run on a pool of
+    `num_threads` threads.
+    """
+    def __init__(self, task: BaseTask, model: BaseLLM, retriever: BaseRetriever,
+        dataset: list[dict], output_dir: str = './output', num_threads: int = 40,
+        max_concurrency: int = 256, retrieve_batch_size: int = 0, contexts_dir: str = None):
+        """
+        Args:
+            max_concurrency (int): Maximum number of data points processed at the same time.
+        """
+        super().__init__(task, model, retriever, dataset, output_dir, num_threads, retrieve_batch_size, contexts_dir)
+        self.max_concurrency = max_concurrency
+
+    def multithread_batch_scoring(self, dataset: list[dict], sort=True, show_progress_bar=False, contain_original_data=False) -> list[dict]:
+        return asyncio.run(self.abatch_scoring(dataset, sort, show_progress_bar, contain_original_data))
+
+    async def abatch_scoring(self, dataset: list[dict], sort=True, show_progress_bar=False, contain_original_data=False) -> list[dict]:
+        """Asynchronous `multithread_batch_scoring`."""
+        saved_ids = self.load_saved_ids()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        loop = asyncio.get_running_loop()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.num_threads)
+        progress = tqdm(total=len(dataset), disable=not show_progress_bar)
+
+        async def process_data_point(data_point):
+            if data_point['ID'] in saved_ids:
+                progress.update()
+                return None  # Skip results that have already been evaluated and are valid
+            async with semaphore:
+                try:
+                    try:
+                        data_point["retrieve_context"] = await loop.run_in_executor(executor, self.retrieve, data_point)
+                    except Exception as e:
+                        logger.warning(repr(e))
+                        data_point["retrieve_context"] = ''
+
+                    generated_text = await self.task.amodel_generation(data_point)
+                    if self._is_failed_generation(generated_text):
+                        return None
+                    data_point["generated_text"] = generated_text
+
+                    score_dict = await loop.run_in_executor(executor, self.task.scoring, data_point)
+                    if score_dict is None:
+                        return None
+
+                    result = {'id': data_point['ID'], **score_dict}
+                    if contain_original_data:
+                        result['original_data'] = data_point
+                    self.checkpoint.append(result)
+                    return result
+
+                except Exception as e:
+                    logger.warning(repr(e))
+                    return None
+                finally:
+                    progress.update()
+
+        try:
+            future_results = await asyncio.gather(*(process_data_point(data_point) for data_point in dataset))
+        finally:
+            executor.shutdown()
+            progress.close()
+            await close_async_session()
+
+        results = [result for result in future_results if result is not None]
+        return sorted(results, key=lambda x: x['id']) if sort else results
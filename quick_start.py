@@ -1,14 +1,15 @@
 import argparse
 from loguru import logger
 from src.datasets.xinhua import get_task_datasets
-from evaluator import BaseEvaluator
+from evaluator import AsyncEvaluator, BaseEvaluator, PipelineEvaluator
 from src.llms import GPT
 from src.llms import Qwen_7B_Chat
 from src.tasks.summary import Summary
 from src.tasks.continue_writing import ContinueWriting
 from src.tasks.hallucinated_modified import HalluModified
 from src.tasks.quest_answer import QuestAnswer1Doc, QuestAnswer2Docs, QuestAnswer3Docs
-from src.retrievers import BaseRetriever, CustomBM25Retriever, EnsembleRetriever, EnsembleRerankRetriever
+from src.retrievers import BaseRetriever, CustomBM25Retriever, EnsembleRetriever, EnsembleRerankRetriever, LocalVectorRetriever, LocalBM25Retriever
+from src.retrievers.contexts import materialize_contexts
 from src.embeddings.base import HuggingfaceEmbeddings
 
 parser = argparse.ArgumentParser()
@@ -17,6 +18,10 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--model_name', default='qwen7b', help="Name of the model to use")
 parser.add_argument('--temperature', type=float, default=0.1, help="Controls the randomness of the model's text generation")
 parser.add_argument('--max_new_tokens', type=int, default=1280, help="Maximum number of new tokens to be generated by the model")
+parser.add_argument('--local_max_batch_size', type=int, default=8, help="Maximum number of prompts a local model generates together")
+parser.add_argument('--local_max_wait', type=float, default=0.01, help="Seconds a local model waits for concurrent prompts before generating")
+parser.add_argument('--llm_cache', default=None, help="Path of an on-disk cache of model responses, disabled by default")
+parser.add_argument('--llm_cache_max_mb', type=int, default=1024, help="Maximum size of the model response cache in MB")
 
 # Dataset related options
 parser.add_argument('--data_path', default='data/crud_split/split_merged.json', help="Path to the dataset")
@@ -24,6 +29,9 @@ parser.add_argument('--shuffle', type=bool, default=True, help="Whether to shuff
 
 parser.add_argument('--embedding_name', default='sentence-transformers/bge-base-zh-v1.5')
 parser.add_argument('--embedding_dim', type=int, default=768)
+parser.add_argument('--embedding_cache_size', type=int, default=100000, help="Number of query embeddings cached in memory, 0 disables the cache")
+parser.add_argument('--embedding_cache_path', default=None, help="Directory of an on-disk query embedding cache shared across runs, disabled by default")
+parser.add_argument('--embedding_cache_dtype', default='float32', choices=['float32', 'float16'], help="Dtype of the embeddings cached on disk")
 
 # Index related options
 parser.add_argument('--docs_path', default='data/tmp', help="Path to the retrieval documents")
@@ -32,11 +40,27 @@ parser.add_argument('--chunk_size', type=int, default=128, help="Chunk size")
 parser.add_argument('--chunk_overlap', type=int, default=0, help="Overlap chunk size")
 parser.add_argument('--construct_index', action='store_true', help="Whether to construct an index")
 parser.add_argument('--add_index', action='store_true', default=False, help="Whether to add an index")
+parser.add_argument('--embed_workers', type=int, default=0, help="Number of processes embedding the documents when constructing an index, 0 embeds in-process")
+parser.add_argument('--embed_threads_per_worker', type=int, default=4, help="Torch threads of each embedding process")
+parser.add_argument('--embed_batch_size', type=int, default=None, help="Batch size of the embedding model when constructing an index, tuned by default")
+parser.add_argument('--ingest_workers', type=int, default=0, help="Number of processes reading and chunking the documents when constructing an index, 0 chunks in-process")
 parser.add_argument('--collection_name', default="docs_80k_chuncksize_128_0", help="Name of the collection")
 
 # Retriever related options
 parser.add_argument('--retrieve_top_k', type=int, default=8, help="Top k documents to retrieve")
 parser.add_argument('--retriever_name', default="base", help="Name of the retriever")
+parser.add_argument('--index_directory', default='./index', help="Directory of the local vector indexes")
+parser.add_argument('--index_type', default='ivf', choices=['ivf', 'flat'], help="Search of the local vector retriever, flat is exact")
+parser.add_argument('--nlist', type=int, default=None, help="Number of IVF lists of the local vector index, 4*sqrt(chunks) by default")
+parser.add_argument('--nprobe', type=int, default=16, help="Number of IVF lists searched per query")
+parser.add_argument('--bm25_num_workers', type=int, default=0, help="Number of processes tokenizing the documents of the local BM25 index")
+parser.add_argument('--leg_timeout', type=float, default=None, help="Seconds to wait for each leg of a hybrid retriever before using the other legs only, no limit by default")
+parser.add_argument('--fusion', default='rrf', choices=['rrf', 'combsum', 'combmnz'], help="Fusion of the hybrid retriever")
+parser.add_argument('--fusion_normalization', default='minmax', choices=['minmax', 'zscore', 'none'], help="Score normalization of combsum and combmnz")
+parser.add_argument('--bm25_candidate_depth', type=int, default=None, help="Candidates fetched from the BM25 leg of a hybrid retriever, retrieve_top_k by default")
+parser.add_argument('--embedding_candidate_depth', type=int, default=None, help="Candidates fetched from the embedding leg of a hybrid retriever, retrieve_top_k by default")
+parser.add_argument('--rerank_max_batch_size', type=int, default=16, help="Maximum number of queries reranked in one forward pass")
+parser.add_argument('--rerank_max_wait', type=float, default=0.01, help="Seconds to wait for concurrent queries before reranking a batch")
 
 # Metric related options
 parser.add_argument('--quest_eval', action='store_true', help="Whether to use QA metrics(RAGQuestEval)")
@@ -47,63 +71,142 @@ parser.add_argument('--task', default='event_summary', help="Task to perform")
 parser.add_argument('--num_threads', type=int, default=1, help="Number of threads")
 parser.add_argument('--show_progress_bar', action='store', default=True, type=bool, help="Whether to show a progress bar")
 parser.add_argument('--contain_original_data', action='store_true', help="Whether to contain original data")
-
-args = parser.parse_args()
-logger.info(args)
-
-if args.model_name.startswith("gpt"):
-    llm = GPT(model_name=args.model_name, temperature=args.temperature, max_new_tokens=args.max_new_tokens)
-elif args.model_name == "qwen7b":
-    llm = Qwen_7B_Chat(model_name=args.model_name, temperature=args.temperature, max_new_tokens=args.max_new_tokens)
-
-embed_model = HuggingfaceEmbeddings(model_name=args.embedding_name)
-
-if args.retriever_name == "base":
-    retriever = BaseRetriever(
-        args.docs_path, embed_model=embed_model, embed_dim=args.embedding_dim,
-        chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap,
-        construct_index=args.construct_index, add_index=args.add_index,
-        collection_name=args.collection_name, similarity_top_k=args.retrieve_top_k
-    )
-elif args.retriever_name == "bm25":
-    retriever = CustomBM25Retriever(
-        args.docs_path, embed_model=embed_model, chunk_size=args.chunk_size, 
-        construct_index=args.construct_index,
-        chunk_overlap=args.chunk_overlap, similarity_top_k=args.retrieve_top_k
-    )
-elif args.retriever_name == "hybrid":
-    retriever = EnsembleRetriever(
-        args.docs_path, embed_model=embed_model, embed_dim=args.embedding_dim,
-        chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap,
-        construct_index=args.construct_index, add_index=args.add_index,
-        collection_name=args.collection_name, similarity_top_k=args.retrieve_top_k
+parser.add_argument('--retrieve_batch_size', type=int, default=0, help="Number of data points retrieved together before the evaluation, 0 retrieves each data point on its own")
+parser.add_argument('--contexts_dir', default=None, help="Directory of materialized retrieval contexts, used instead of retrieving when they match the retriever")
+parser.add_argument('--materialize_contexts', action='store_true', help="Only retrieve the contexts of the datasets and save them in contexts_dir (./contexts by default)")
+parser.add_argument('--pipeline', action='store_true', help="Whether to run retrieval, generation and scoring as overlapping stages")
+parser.add_argument('--num_retrieve_threads', type=int, default=8, help="Number of retrieval threads in pipeline mode")
+parser.add_argument('--num_generate_threads', type=int, default=None, help="Number of generation threads in pipeline mode, num_threads by default")
+parser.add_argument('--num_score_workers', type=int, default=None, help="Number of scoring processes in pipeline mode, the number of CPUs by default")
+parser.add_argument('--pipeline_queue_size', type=int, default=64, help="Capacity of the queues between pipeline stages")
+parser.add_argument('--async_eval', action='store_true', help="Whether to drive the LLM calls from an asyncio event loop")
+parser.add_argument('--max_concurrency', type=int, default=256, help="Maximum number of in-flight data points with --async_eval")
+
+
+def main():
+    args = parser.parse_args()
+    logger.info(args)
+
+    embed_model = HuggingfaceEmbeddings(
+        model_name=args.embedding_name, cache_size=args.embedding_cache_size,
+        cache_path=args.embedding_cache_path, cache_dtype=args.embedding_cache_dtype
     )
-elif args.retriever_name == "hybrid-rerank":
-    retriever = EnsembleRerankRetriever(
-        args.docs_path, embed_model=embed_model, embed_dim=args.embedding_dim,
-        chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap,
-        construct_index=args.construct_index, add_index=args.add_index,
-        collection_name=args.collection_name, similarity_top_k=args.retrieve_top_k
-    )
-else:
-    raise ValueError(f"Unknown retriever: {args.retriever_name}")
-
-task_mapping = {
-    'event_summary':[Summary],
-    'continuing_writing': [ContinueWriting],
-    'hallu_modified': [HalluModified],
-    'quest_answer': [QuestAnswer1Doc, QuestAnswer2Docs, QuestAnswer3Docs],
-    'all': [Summary, ContinueWriting, HalluModified, QuestAnswer1Doc, QuestAnswer2Docs, QuestAnswer3Docs]
-}
-
-if args.task not in task_mapping:
-    raise ValueError(f"Unknown task: {args.task}")
-
-tasks = [task(use_quest_eval=args.quest_eval, use_bert_score=args.bert_score_eval) for task in task_mapping[args.task]]
-
-datasets = get_task_datasets(args.data_path, args.task)
-
-for task, dataset in zip(tasks, datasets):
-    evaluator = BaseEvaluator(task, llm, retriever, dataset, num_threads=args.num_threads)
-    evaluator.run(show_progress_bar=args.show_progress_bar, contain_original_data=args.contain_original_data)
 
+    candidate_depth = {'bm25': args.bm25_candidate_depth, 'embedding': args.embedding_candidate_depth}
+    if args.retriever_name == "base":
+        retriever = BaseRetriever(
+            args.docs_path, embed_model=embed_model, embed_dim=args.embedding_dim,
+            chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap,
+            construct_index=args.construct_index, add_index=args.add_index,
+            collection_name=args.collection_name, similarity_top_k=args.retrieve_top_k,
+            embed_workers=args.embed_workers, embed_threads_per_worker=args.embed_threads_per_worker,
+            embed_batch_size=args.embed_batch_size, ingest_workers=args.ingest_workers
+        )
+    elif args.retriever_name == "local":
+        retriever = LocalVectorRetriever(
+            args.docs_path, embed_model=embed_model, embed_dim=args.embedding_dim,
+            chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap,
+            construct_index=args.construct_index, collection_name=args.collection_name,
+            similarity_top_k=args.retrieve_top_k, index_directory=args.index_directory,
+            index_type=args.index_type, nlist=args.nlist, nprobe=args.nprobe,
+            embed_workers=args.embed_workers, embed_threads_per_worker=args.embed_threads_per_worker,
+            embed_batch_size=args.embed_batch_size, ingest_workers=args.ingest_workers
+        )
+    elif args.retriever_name == "bm25":
+        retriever = CustomBM25Retriever(
+            args.docs_path, embed_model=embed_model, chunk_size=args.chunk_size, 
+            construct_index=args.construct_index,
+            chunk_overlap=args.chunk_overlap, similarity_top_k=args.retrieve_top_k,
+            ingest_workers=args.ingest_workers
+        )
+    elif args.retriever_name == "local-bm25":
+        retriever = LocalBM25Retriever(
+            args.docs_path, embed_model=embed_model, chunk_size=args.chunk_size,
+            chunk_overlap=args.chunk_overlap, collection_name=args.collection_name,
+            construct_index=args.construct_index, similarity_top_k=args.retrieve_top_k,
+            index_directory=args.index_directory, num_workers=args.bm25_num_workers,
+            ingest_workers=args.ingest_workers
+        )
+    elif args.retriever_name == "hybrid":
+        retriever = EnsembleRetriever(
+            args.docs_path, embed_model=embed_model, embed_dim=args.embedding_dim,
+            chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap,
+            construct_index=args.construct_index, add_index=args.add_index,
+            collection_name=args.collection_name, similarity_top_k=args.retrieve_top_k,
+            embed_workers=args.embed_workers, embed_threads_per_worker=args.embed_threads_per_worker,
+            embed_batch_size=args.embed_batch_size, ingest_workers=args.ingest_workers,
+            leg_timeout=args.leg_timeout, fanout_workers=2 * max(args.num_threads, args.num_retrieve_threads),
+            fusion=args.fusion, fusion_normalization=args.fusion_normalization, candidate_depth=candidate_depth
+        )
+    elif args.retriever_name == "hybrid-rerank":
+        retriever = EnsembleRerankRetriever(
+            args.docs_path, embed_model=embed_model, embed_dim=args.embedding_dim,
+            chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap,
+            construct_index=args.construct_index, add_index=args.add_index,
+            collection_name=args.collection_name, similarity_top_k=args.retrieve_top_k,
+            embed_workers=args.embed_workers, embed_threads_per_worker=args.embed_threads_per_worker,
+            embed_batch_size=args.embed_batch_size, ingest_workers=args.ingest_workers,
+            rerank_max_batch_size=args.rerank_max_batch_size, rerank_max_wait=args.rerank_max_wait,
+            leg_timeout=args.leg_timeout, fanout_workers=2 * max(args.num_threads, args.num_retrieve_threads),
+            candidate_depth=candidate_depth
+        )
+    else:
+        raise ValueError(f"Unknown retriever: {args.retriever_name}")
+
+    task_mapping = {
+        'event_summary':[Summary],
+        'continuing_writing': [ContinueWriting],
+        'hallu_modified': [HalluModified],
+        'quest_answer': [QuestAnswer1Doc, QuestAnswer2Docs, QuestAnswer3Docs],
+        'all': [Summary, ContinueWriting, HalluModified, QuestAnswer1Doc, QuestAnswer2Docs, QuestAnswer3Docs]
+    }
+
+    if args.task not in task_mapping:
+        raise ValueError(f"Unknown task: {args.task}")
+
+    tasks = [task(use_quest_eval=args.quest_eval, use_bert_score=args.bert_score_eval) for task in task_mapping[args.task]]
+
+    datasets = get_task_datasets(args.data_path, args.task)
+
+    if args.materialize_contexts:
+        # Retrieval only: the contexts are reused by every following evaluation with this retriever
+        for task, dataset in zip(tasks, datasets):
+            task.set_model(None, retriever)
+            materialize_contexts(task, retriever, dataset, args.contexts_dir or './contexts', batch_size=args.retrieve_batch_size or 64)
+        return
+
+    if args.model_name.startswith("gpt"):
+        llm = GPT(model_name=args.model_name, temperature=args.temperature, max_new_tokens=args.max_new_tokens)
+    elif args.model_name == "qwen7b":
+        llm = Qwen_7B_Chat(
+            model_name=args.model_name, temperature=args.temperature, max_new_tokens=args.max_new_tokens,
+            max_batch_size=args.local_max_batch_size, max_wait=args.local_max_wait
+        )
+
+    if args.llm_cache:
+        llm.enable_cache(args.llm_cache, max_bytes=args.llm_cache_max_mb << 20)
+
+    for task, dataset in zip(tasks, datasets):
+        if args.pipeline:
+            evaluator = PipelineEvaluator(
+                task, llm, retriever, dataset, num_threads=args.num_threads,
+                num_retrieve_threads=args.num_retrieve_threads, num_generate_threads=args.num_generate_threads,
+                num_score_workers=args.num_score_workers, queue_size=args.pipeline_queue_size,
+                retrieve_batch_size=args.retrieve_batch_size, contexts_dir=args.contexts_dir
+            )
+        elif args.async_eval:
+            evaluator = AsyncEvaluator(
+                task, llm, retriever, dataset, num_threads=args.num_threads, max_concurrency=args.max_concurrency,
+                retrieve_batch_size=args.retrieve_batch_size, contexts_dir=args.contexts_dir
+            )
+        else:
+            evaluator = BaseEvaluator(
+                task, llm, retriever, dataset, num_threads=args.num_threads,
+                retrieve_batch_size=args.retrieve_batch_size, contexts_dir=args.contexts_dir
+            )
+        evaluator.run(show_progress_bar=args.show_progress_bar, contain_original_data=args.contain_original_data)
+
+
+if __name__ == '__main__':
+    # Embedding workers are spawned processes, which import this module again
+    main()
@@ -11,4 +11,8 @@ GPT_transit_user = ''
 Qwen_7B_local_path = ''
 Baichuan2_13b_local_path = ''
 ChatGLM3_local_path = ''
-Qwen_14B_local_path = ''
\ No newline at end of file
+Qwen_14B_local_path = ''
+
+# Requests per second allowed for each remote LLM url (Optional)
+# e.g. {'http://127.0.0.1:8000/generate': 5}
+LLM_rate_limits = {}
@@ -9,6 +9,8 @@ import numpy as np
 from langchain.schema.embeddings import Embeddings
 from pydantic.dataclasses import dataclass
 
+from src.embeddings.cache import EmbeddingCache
+
 DEFAULT_MODEL_NAME = "sentence-transformers/bge-base-zh-v1.5"
 
 @dataclass
@@ -21,6 +23,12 @@ class HuggingfaceEmbeddings(Embeddings):
     model_kwargs: t.Dict[str, t.Any] = field(default_factory=dict)
     """Keyword arguments to pass to the model."""
     encode_kwargs: t.Dict[str, t.Any] = field(default_factory=dict)
+    cache_size: int = 100_000
+    """Number of query embeddings kept in memory, 0 disables the cache."""
+    cache_path: t.Optional[str] = None
+    """Directory of the on-disk query embedding cache, shared across runs."""
+    cache_dtype: str = 'float32'
+    """Dtype of the cached vectors on disk, float32 or float16."""
 
     def __post_init__(self):
         try:
@@ -51,16 +59,46 @@ class HuggingfaceEmbeddings(Embeddings):
                 self.model_name, cache_folder=self.cache_folder, **self.model_kwargs
             )
 
-        # ensure outputs are tensors
+        # keep outputs as float32 arrays, never as lists of Python floats
         if "convert_to_tensor" not in self.encode_kwargs:
-            self.encode_kwargs["convert_to_tensor"] = True
+            self.encode_kwargs["convert_to_numpy"] = True
 
-    def embed_query(self, text: str) -> List[float]:
-        return self.embed_documents([text])[0]
+        self.cache = None
+        if self.cache_size > 0 or self.cache_path is not None:
+            self.cache = EmbeddingCache(
+                self.model_name, max_size=self.cache_size,
+                path=self.cache_path, dtype=self.cache_dtype,
+            )
 
-    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+    def embed_query(self, text: str) -> np.ndarray:
+        # The same queries are embedded again for every retriever and top_k compared
+        if self.cache is None:
+            return self.embed_documents([text])[0]
+        vector = self.cache.get(text)
+        if vector is None:
+            vector = self.embed_documents([text])[0]
+            self.cache.put(text, vector)
+        return vector
+
+    def embed_queries(self, texts: List[str]) -> np.ndarray:
+        """Embed a batch of queries in one `encode` call, through the cache like `embed_query`."""
+        if self.cache is None or not texts:
+            return self.embed_documents(texts)
+        vectors = {text: self.cache.get(text) for text in texts}
+        missing = [text for text, vector in vectors.items() if vector is None]
+        if missing:
+            for text, vector in zip(missing, self.embed_documents(missing)):
+                self.cache.put(text, vector)
+                vectors[text] = vector
+        return np.stack([vectors[text] for text in texts])
+
+    def embed_documents(self, texts: List[str]) -> np.ndarray:
+        """Embed `texts` into a C-contiguous float32 array of shape (len(texts), dim).
+
+        Rows can be used wherever a list of floats is expected (llama_index nodes,
+        Milvus inserts) without materializing one Python float per dimension.
+        """
         from sentence_transformers.SentenceTransformer import SentenceTransformer
-        from torch import Tensor
 
         assert isinstance(
             self.model, SentenceTransformer
@@ -68,20 +106,22 @@ class HuggingfaceEmbeddings(Embeddings):
         embeddings = self.model.encode(
             texts, normalize_embeddings=True, **self.encode_kwargs
         )
+        return _to_float32_array(embeddings)
 
-        assert isinstance(embeddings, Tensor)
-        return embeddings.tolist()
-
-    def predict(self, texts: List[List[str]]) -> List[List[float]]:
+    def predict(self, texts: List[List[str]]) -> np.ndarray:
         from sentence_transformers.cross_encoder import CrossEncoder
-        from torch import Tensor
 
         assert isinstance(
             self.model, CrossEncoder
         ), "Model is not of the type CrossEncoder"
 
         predictions = self.model.predict(texts, **self.encode_kwargs)
+        return _to_float32_array(predictions)
+
 
-        assert isinstance(predictions, Tensor)
-        return predictions.tolist()
+def _to_float32_array(embeddings) -> np.ndarray:
+    # `convert_to_tensor=True` in `encode_kwargs` still yields tensors
+    if hasattr(embeddings, 'detach'):
+        embeddings = embeddings.detach().to('cpu').float().numpy()
+    return np.ascontiguousarray(embeddings, dtype=np.float32)
 
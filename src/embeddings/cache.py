@@ -0,0 +1,185 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """Two-tier cache of text embeddings keyed by (model name, hash of the text).
+
+    The memory tier is an LRU of at most `max_size` vectors. The optional disk tier
+    under `path` keeps every vector computed so far, one directory per model:
+
+    - `vectors.bin` holds a raw `dtype` matrix. It is memory-mapped and grows by doubling.
+    - `keys.bin` holds 16-byte text digests, one per matrix row.
+    - `meta.json` records the dimension and dtype.
+
+    A digest is appended only after its row has been written, so a crash leaves at
+    most an unused row. Processes sharing the disk tier append under an exclusive
+    `flock` of `keys.bin`: the row of a new vector is the number of digests in the
+    file, and the digests appended by the other processes are picked up on the way.
+
+    Args:
+        model_name (str): Name of the embedding model, part of every key.
+        max_size (int): Maximum number of vectors kept in memory, 0 disables the memory tier.
+        path (str): Directory of the disk tier, None disables it.
+        dtype (str): 'float32' or 'float16', the dtype of the vectors on disk.
+    """
+    _initial_rows = 1024
+
+    def __init__(self, model_name: str, max_size: int = 100_000, path: str = None, dtype: str = 'float32'):
+        if dtype not in ('float32', 'float16'):
+            raise ValueError(f'Unsupported embedding cache dtype: {dtype}')
+        self.model_name = model_name
+        self.max_size = max_size
+        self.dtype = np.dtype(dtype)
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+        self.directory = None
+        self.dim = None
+        self._rows = {}
+        self._num_keys = 0
+        self._vectors = None
+        if path is not None:
+            self.directory = os.path.join(path, re.sub(r'[^\w.-]+', '_', model_name))
+            os.makedirs(self.directory, exist_ok=True)
+            self._load()
+
+    def _key(self, text: str) -> bytes:
+        return hashlib.blake2b(f'{self.model_name}\0{text}'.encode('utf-8'), digest_size=16).digest()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _load(self) -> None:
+        if not self._load_meta() or not os.path.exists(self._file('keys.bin')):
+            return
+        with self._locked_keys() as f:
+            self._grow(self._read_keys(f))
+
+    def _load_meta(self) -> bool:
+        if not os.path.exists(self._file('meta.json')):
+            return False
+        with open(self._file('meta.json')) as f:
+            meta = json.load(f)
+        if np.dtype(meta['dtype']) != self.dtype:
+            raise ValueError(f"Embedding cache at {self.directory} stores {meta['dtype']}, not {self.dtype}")
+        self.dim = meta['dim']
+        return True
+
+    def _write_meta(self, dim: int) -> None:
+        self.dim = dim
+        # Replaced at once, other processes never read a partial file
+        with open(self._file('meta.json.tmp'), 'w') as f:
+            json.dump({'model_name': self.model_name, 'dim': self.dim, 'dtype': self.dtype.name}, f)
+        os.replace(self._file('meta.json.tmp'), self._file('meta.json'))
+
+    @contextmanager
+    def _locked_keys(self):
+        """`keys.bin` opened for appending, locked against the other processes."""
+        with open(self._file('keys.bin'), 'ab+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield f
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_keys(self, f) -> int:
+        """Map the digests appended since the last read, by any process, and return the number of rows."""
+        size = f.seek(0, os.SEEK_END)
+        if size % 16:
+            # Drop a digest truncated by a crash, so that the next one is appended on its row
+            size -= size % 16
+            f.truncate(size)
+        f.seek(self._num_keys * 16)
+        keys = f.read(size - self._num_keys * 16)
+        for offset in range(0, len(keys), 16):
+            self._rows[keys[offset:offset + 16]] = self._num_keys + offset // 16
+        self._num_keys = size // 16
+        return self._num_keys
+
+    def _map(self) -> None:
+        self._vectors = np.memmap(self._file('vectors.bin'), dtype=self.dtype, mode='r+').reshape(-1, self.dim)
+
+    def _grow(self, rows: int) -> None:
+        """Map at least `rows` rows, growing `vectors.bin` unless another process already did."""
+        if rows <= (0 if self._vectors is None else len(self._vectors)):
+            return
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._vectors = None
+        row_bytes = self.dim * self.dtype.itemsize
+        with open(self._file('vectors.bin'), 'ab') as f:
+            capacity = f.seek(0, os.SEEK_END) // row_bytes
+            if capacity < rows:
+                f.truncate(max(self._initial_rows, 2 * capacity, rows) * row_bytes)
+        self._map()
+
+    def get(self, text: str) -> np.ndarray:
+        """Cached float32 embedding of `text`, or None."""
+        key = self._key(text)
+        with self._lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+            elif key in self._rows:
+                vector = np.array(self._vectors[self._rows[key]], dtype=np.float32)
+                vector.setflags(write=False)
+                self._remember(key, vector)
+            if vector is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return vector
+
+    def put(self, text: str, vector) -> None:
+        key = self._key(text)
+        vector = np.array(vector, dtype=np.float32).reshape(-1)
+        # Cached vectors are handed out without copying
+        vector.setflags(write=False)
+        with self._lock:
+            self._remember(key, vector)
+            if self.directory is None or key in self._rows:
+                return
+            with self._locked_keys() as f:
+                row = self._read_keys(f)
+                if self.dim is None and not self._load_meta():
+                    self._write_meta(len(vector))
+                self._grow(row)
+                if key in self._rows:  # Added by another process
+                    return
+                self._grow(row + 1)
+                self._vectors[row] = vector
+                f.write(key)
+                f.flush()
+                self._rows[key] = row
+                self._num_keys += 1
+
+    def _remember(self, key: bytes, vector: np.ndarray) -> None:
+        if self.max_size <= 0:
+            return
+        self._cache[key] = vector
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._vectors is not None:
+                self._vectors.flush()
+
+    def info(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits, 'misses': self.misses, 'size': len(self._cache),
+                'max_size': self.max_size, 'disk_size': len(self._rows),
+            }
@@ -0,0 +1,147 @@
+import concurrent.futures
+import multiprocessing
+import os
+import time
+from collections import deque
+from typing import Iterator
+
+import numpy as np
+from loguru import logger
+
+_embed_model = None
+
+
+def _init_embedding_worker(model_name: str, cache_folder: str, model_kwargs: dict, num_threads: int) -> None:
+    global _embed_model
+    import torch
+
+    from src.embeddings.base import HuggingfaceEmbeddings
+
+    # Workers share the cores, each one must not spawn a thread per core
+    torch.set_num_threads(num_threads)
+    _embed_model = HuggingfaceEmbeddings(
+        model_name=model_name, cache_folder=cache_folder,
+        model_kwargs=model_kwargs, cache_size=0,
+    )
+
+
+def _encode_shard(texts: list[str], batch_size: int) -> np.ndarray:
+    _embed_model.encode_kwargs['batch_size'] = batch_size
+    return _embed_model.embed_documents(texts)
+
+
+def _time_batch_sizes(texts: list[str], batch_sizes: list[int]) -> dict:
+    throughput = {}
+    _encode_shard(texts[:batch_sizes[0]], batch_sizes[0])  # warm up
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        _encode_shard(texts, batch_size)
+        throughput[batch_size] = len(texts) / (time.perf_counter() - start)
+    return throughput
+
+
+class ParallelEmbedder:
+    """Embed documents with a pool of CPU worker processes, one model copy per worker.
+
+    Texts are cut into shards of `shard_size`, which are encoded concurrently and
+    yielded back in input order. At most two shards per worker are in flight, so
+    memory stays bounded for any number of texts.
+
+    The embeddings are the same as those of `HuggingfaceEmbeddings.embed_documents`.
+
+    Args:
+        embed_model (HuggingfaceEmbeddings): Model to copy into the workers.
+        num_workers (int): Number of worker processes, the number of CPUs divided by
+            `threads_per_worker` by default.
+        threads_per_worker (int): Torch intra-op threads of each worker.
+        batch_size (int): Batch size of `encode`, see `tune_batch_size`.
+        shard_size (int): Number of texts sent to a worker at a time.
+    """
+    def __init__(
+            self,
+            embed_model,
+            num_workers: int = None,
+            threads_per_worker: int = 4,
+            batch_size: int = 32,
+            shard_size: int = 1024,
+        ):
+        cpus = os.cpu_count() or 1
+        self.threads_per_worker = max(1, min(threads_per_worker, cpus))
+        self.num_workers = num_workers or max(1, cpus // self.threads_per_worker)
+        self.batch_size = batch_size
+        self.shard_size = shard_size
+        self.tuned = False
+        # Forked workers would inherit the torch thread pools of the parent
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            self.num_workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_embedding_worker,
+            initargs=(embed_model.model_name, embed_model.cache_folder, embed_model.model_kwargs, self.threads_per_worker),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        self.executor.shutdown(cancel_futures=True)
+
+    def tune_batch_size(self, texts: list[str], batch_sizes: tuple = (8, 16, 32, 64, 128), sample_size: int = 512) -> int:
+        """Time `encode` on a sample of `texts` in one worker and keep the fastest batch size."""
+        sample = texts[:sample_size]
+        if not sample:
+            return self.batch_size
+        throughput = self.executor.submit(_time_batch_sizes, sample, list(batch_sizes)).result()
+        self.batch_size = max(throughput, key=throughput.get)
+        self.tuned = True
+        logger.info(
+            'Embedding throughput per worker: '
+            + ', '.join(f'batch {size}: {rate:.1f} texts/s' for size, rate in throughput.items())
+        )
+        return self.batch_size
+
+    def embed(self, texts: list[str]) -> Iterator[np.ndarray]:
+        """Yield the float32 embeddings of consecutive shards of `texts`, in order."""
+        pending = deque()
+        shards = (texts[start:start + self.shard_size] for start in range(0, len(texts), self.shard_size))
+        for shard in shards:
+            pending.append(self.executor.submit(_encode_shard, shard, self.batch_size))
+            if len(pending) >= 2 * self.num_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def embed_documents(self, texts: list[str]) -> np.ndarray:
+        shards = list(self.embed(texts))
+        return np.concatenate(shards) if shards else np.zeros((0, 0), dtype=np.float32)
+
+
+def iter_embeddings(
+        embed_model,
+        texts: list[str],
+        num_workers: int = 0,
+        threads_per_worker: int = 4,
+        batch_size: int = None,
+        chunk_size: int = 8000,
+    ) -> Iterator[np.ndarray]:
+    """Yield the float32 embeddings of consecutive chunks of `texts`, in order.
+
+    With `num_workers` > 0 the texts are embedded by a `ParallelEmbedder`, whose
+    `encode` batch size is tuned on the first texts unless `batch_size` is set.
+    Otherwise they are embedded in-process, `chunk_size` texts at a time.
+    """
+    if num_workers <= 0:
+        if batch_size is not None:
+            embed_model.encode_kwargs['batch_size'] = batch_size
+        for start in range(0, len(texts), chunk_size):
+            yield embed_model.embed_documents(texts[start:start + chunk_size])
+        return
+
+    with ParallelEmbedder(
+        embed_model, num_workers=num_workers,
+        threads_per_worker=threads_per_worker, batch_size=batch_size or 32,
+    ) as embedder:
+        if batch_size is None:
+            embedder.tune_batch_size(texts)
+        yield from embedder.embed(texts)
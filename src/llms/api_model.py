@@ -1,7 +1,9 @@
+from typing import Iterator
+
 import openai
 from loguru import logger
 
-from src.llms.base import BaseLLM
+from src.llms.base import BaseLLM, iter_until_stop, truncate_at_stop
 from importlib import import_module
 
 try:
@@ -14,7 +16,7 @@ class GPT(BaseLLM):
         super().__init__(model_name, temperature, max_new_tokens)
         self.report = report
 
-    def request(self, query: str) -> str:
+    def request(self, query: str, stop: list[str] = None) -> str:
         openai.api_key = conf.GPT_api_key
         if conf.GPT_api_base and conf.GPT_api_base.strip():
             openai.base_url = conf.GPT_api_base
@@ -24,6 +26,49 @@ class GPT(BaseLLM):
             temperature = self.params['temperature'],
             max_tokens = self.params['max_new_tokens'],
             top_p = self.params['top_p'],
+            stop = stop,
+        )
+        real_res = res.choices[0].message.content
+
+        token_consumed = res.usage.total_tokens
+        logger.info(f'GPT token consumed: {token_consumed}') if self.report else ()
+        return real_res
+
+    def request_with_stop(self, query: str, stop: list[str]) -> str:
+        # Not streamed, as in `arequest`
+        return truncate_at_stop(self.request(query, stop), stop)
+
+    def stream(self, query: str, stop: list[str] = None) -> Iterator[str]:
+        openai.api_key = conf.GPT_api_key
+        if conf.GPT_api_base and conf.GPT_api_base.strip():
+            openai.base_url = conf.GPT_api_base
+        res = openai.chat.completions.create(
+            model = self.params['model_name'],
+            messages = [{"role": "user","content": query}],
+            temperature = self.params['temperature'],
+            max_tokens = self.params['max_new_tokens'],
+            top_p = self.params['top_p'],
+            stop = stop,
+            stream = True,
+        )
+        chunks = (chunk.choices[0].delta.content or '' for chunk in res if chunk.choices)
+        try:
+            yield from iter_until_stop(chunks, stop)
+        finally:
+            res.close()
+
+    async def arequest(self, query: str, stop: list[str] = None) -> str:
+        # The async client pools its connections, one client is kept per model
+        if getattr(self, '_async_client', None) is None:
+            base_url = conf.GPT_api_base if conf.GPT_api_base and conf.GPT_api_base.strip() else None
+            self._async_client = openai.AsyncOpenAI(api_key=conf.GPT_api_key, base_url=base_url)
+        res = await self._async_client.chat.completions.create(
+            model = self.params['model_name'],
+            messages = [{"role": "user","content": query}],
+            temperature = self.params['temperature'],
+            max_tokens = self.params['max_new_tokens'],
+            top_p = self.params['top_p'],
+            stop = stop,
         )
         real_res = res.choices[0].message.content
 
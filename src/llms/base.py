@@ -1,8 +1,42 @@
+import asyncio
 import copy
 from abc import ABC, abstractmethod
+from typing import Iterable, Iterator
 
 from loguru import logger
 
+from src.llms.cache import ResponseCache
+
+
+def iter_until_stop(chunks: Iterable[str], stop: list[str] = None) -> Iterator[str]:
+    """Re-yield streamed text chunks, ending right before the first stop sequence.
+
+    Up to `len(longest stop) - 1` characters are held back, so a stop sequence split
+    across two chunks is still found.
+    """
+    if not stop:
+        yield from chunks
+        return
+    hold = max(len(s) for s in stop) - 1
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk
+        positions = [i for i in (buffer.find(s) for s in stop) if i != -1]
+        if positions:
+            if head := buffer[:min(positions)]:
+                yield head
+            return
+        if len(buffer) > hold:
+            yield buffer[:len(buffer) - hold]
+            buffer = buffer[len(buffer) - hold:]
+    if buffer:
+        yield buffer
+
+
+def truncate_at_stop(text: str, stop: list[str] = None) -> str:
+    return ''.join(iter_until_stop([text], stop))
+
+
 class BaseLLM(ABC):
     def __init__(
             self, 
@@ -21,6 +55,16 @@ class BaseLLM(ABC):
             'top_k': top_k,
             **more_params
         }
+        self.cache = None
+
+    def enable_cache(self, path: str = './output/llm_cache.sqlite', max_bytes: int = 1 << 30):
+        """Serve `safe_request` from an on-disk response cache keyed by params and prompt."""
+        self.cache = ResponseCache(path, max_bytes)
+        return self
+
+    def _cache_key(self, query: str, stop: list[str] = None) -> str:
+        params = {**self.params, 'stop': list(stop)} if stop else self.params
+        return ResponseCache.make_key(self.__class__.__name__, params, query)
 
     def update_params(self, inplace: bool = True, **params):
         if inplace:
@@ -35,12 +79,52 @@ class BaseLLM(ABC):
     def request(self, query:str) -> str:
         return ''
 
-    def safe_request(self, query: str) -> str:
+    def stream(self, query: str, stop: list[str] = None) -> Iterator[str]:
+        """Yield the response in chunks as it is generated, ending at the first stop sequence.
+
+        Models that cannot stream yield their whole response at once, cut at the stop sequence.
+        """
+        yield from iter_until_stop([self.request(query)], stop)
+
+    def request_with_stop(self, query: str, stop: list[str]) -> str:
+        """Request a response that ends as soon as one of the `stop` sequences is generated."""
+        return ''.join(self.stream(query, stop))
+
+    def safe_request(self, query: str, stop: list[str] = None) -> str:
         """Safely make a request to the language model, handling exceptions."""
+        cache = getattr(self, 'cache', None)
+        if cache is not None and (response := cache.get(key := self._cache_key(query, stop))) is not None:
+            return response
+        try:
+            response = self.request_with_stop(query, stop) if stop else self.request(query)
+        except Exception as e:
+            logger.warning(repr(e))
+            response = ''
+        if cache is not None and response:
+            cache.put(key, response)
+        return response
+
+    async def arequest(self, query: str, stop: list[str] = None) -> str:
+        """Asynchronous `request`, ending at the first stop sequence.
+
+        Runs the blocking `request`, or `request_with_stop` when given stop sequences,
+        in a worker thread unless overridden.
+        """
+        if stop:
+            return await asyncio.to_thread(self.request_with_stop, query, stop)
+        return await asyncio.to_thread(self.request, query)
+
+    async def asafe_request(self, query: str, stop: list[str] = None) -> str:
+        """Asynchronous `safe_request`. The response is cut at the first stop sequence."""
+        cache = getattr(self, 'cache', None)
+        if cache is not None and (response := cache.get(key := self._cache_key(query, stop))) is not None:
+            return response
         try:
-            response = self.request(query)
+            response = truncate_at_stop(await self.arequest(query, stop), stop)
         except Exception as e:
             logger.warning(repr(e))
             response = ''
+        if cache is not None and response:
+            cache.put(key, response)
         return response
 
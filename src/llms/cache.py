@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from threading import Lock
+
+
+class ResponseCache:
+    """Content-addressed sqlite store of LLM responses.
+
+    Responses are keyed by a hash of the model class, its params and the prompt, so
+    re-running an evaluation with the same model settings costs no model calls. When
+    the stored responses exceed `max_bytes`, the least recently used ones are evicted.
+
+    Args:
+        path (str): Path of the sqlite database.
+        max_bytes (int): Upper bound on the total size of the stored responses.
+    """
+    def __init__(self, path: str = './output/llm_cache.sqlite', max_bytes: int = 1 << 30):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+        self._conn.commit()
+        self.total_bytes = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def __deepcopy__(self, memo):
+        # Copies of a model made by `update_params` share the same store
+        return self
+
+    @staticmethod
+    def make_key(model_class: str, params: dict, query: str) -> str:
+        head = json.dumps({'class': model_class, 'params': params}, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(f'{head}\0{query}'.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> str:
+        with self._lock:
+            row = self._conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key: str, response: str) -> None:
+        size = len(response.encode('utf-8'))
+        with self._lock:
+            old = self._conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)',
+                (key, response, size, time.time())
+            )
+            self.total_bytes += size - (old[0] if old else 0)
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        while self.total_bytes > self.max_bytes:
+            rows = self._conn.execute(
+                'SELECT key, size FROM responses ORDER BY last_access LIMIT 64'
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.total_bytes -= size
+
+    def info(self) -> dict:
+        with self._lock:
+            count = self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            return {'hits': self.hits, 'misses': self.misses, 'entries': count,
+                    'bytes': self.total_bytes, 'max_bytes': self.max_bytes}
@@ -1,21 +1,65 @@
+from threading import Event, Thread
+from typing import Iterator
+
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import (
+    AutoModelForCausalLM, AutoTokenizer, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+)
 from importlib import import_module
 
 try:
     conf = import_module("src.configs.real_config")
 except ImportError:
     conf = import_module("src.configs.config")
-from src.llms.base import BaseLLM
+from src.llms.base import BaseLLM, iter_until_stop, truncate_at_stop
+from src.utils.batching import MicroBatcher
+
+
+class StopOnSequences(StoppingCriteria):
+    """Stop generating once every sequence of the batch contains one of its stop strings.
+
+    Only the last `window` new tokens are decoded at each step. A sequence without stop
+    strings runs until `max_new_tokens`.
+    """
+    def __init__(self, tokenizer, stops: list[tuple[str, ...]], prompt_length: int, window: int = 32):
+        self.tokenizer = tokenizer
+        self.stops = stops
+        self.prompt_length = prompt_length
+        self.window = window
+        self.done = [False] * len(stops)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        for row, stop in enumerate(self.stops):
+            if self.done[row] or not stop:
+                continue
+            start = max(self.prompt_length, input_ids.shape[1] - self.window)
+            tail = self.tokenizer.decode(input_ids[row, start:], skip_special_tokens=True)
+            self.done[row] = any(s in tail for s in stop)
+        return torch.full((input_ids.shape[0],), all(self.done), dtype=torch.bool, device=input_ids.device)
+
+
+class StopOnEvent(StoppingCriteria):
+    """Stop generating once `event` is set, e.g. when the consumer of a stream went away."""
+    def __init__(self, event: Event):
+        self.event = event
 
-class Qwen_7B_Chat(BaseLLM):
-    def __init__(self, model_name='qwen_7b', temperature=1.0, max_new_tokens=1024):
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+class LocalLLM(BaseLLM):
+    """HuggingFace causal LM running in-process.
+
+    Concurrent `request` calls from the evaluator threads are collected by a
+    `MicroBatcher`, left-padded into one batch and generated together, instead of
+    serializing on the model one prompt at a time.
+
+    Args:
+        max_batch_size (int): Maximum number of prompts generated together.
+        max_wait (float): Seconds to wait for concurrent prompts before generating a batch.
+    """
+    def __init__(self, model_name, temperature=1.0, max_new_tokens=1024, max_batch_size=8, max_wait=0.01):
         super().__init__(model_name, temperature, max_new_tokens)
-        local_path = conf.Qwen_7B_local_path
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            local_path, trust_remote_code=True)
-        self.model = AutoModelForCausalLM.from_pretrained(local_path, device_map="auto",
-                                                     trust_remote_code=True).eval()
         self.gen_kwargs = {
             "temperature": self.params['temperature'],
             "do_sample": True,
@@ -23,19 +67,82 @@ class Qwen_7B_Chat(BaseLLM):
             "top_p": self.params['top_p'],
             "top_k": self.params['top_k'],
         }
+        self.batcher = MicroBatcher(
+            self.generate_batch, max_batch_size=max_batch_size, max_wait=max_wait, name=self.__class__.__name__
+        )
+
+    def format_prompt(self, query: str) -> str:
+        return query
+
+    def _tokenize(self, prompts: list[str]):
+        self.tokenizer.padding_side = 'left'
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        return self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.model.device)
+
+    def generate_batch(self, items: list[tuple[str, tuple[str, ...]]]) -> list[str]:
+        """Generate a batch of (prompt, stop sequences) items together."""
+        prompts = [prompt for prompt, _ in items]
+        stops = [stop for _, stop in items]
+        inputs = self._tokenize(prompts)
+        prompt_length = inputs['input_ids'].shape[1]
+        stopping_criteria = None
+        if any(stops):
+            stopping_criteria = StoppingCriteriaList([StopOnSequences(self.tokenizer, stops, prompt_length)])
+        with torch.no_grad():
+            output = self.model.generate(
+                **inputs, pad_token_id=self.tokenizer.pad_token_id,
+                stopping_criteria=stopping_criteria, **self.gen_kwargs
+            )
+        # Left padding aligns all prompts to the same length, the new tokens come after it
+        output = output[:, prompt_length:]
+        return [
+            truncate_at_stop(self.tokenizer.decode(tokens, skip_special_tokens=True), stop)
+            for tokens, stop in zip(output, stops)
+        ]
 
     def request(self, query: str) -> str:
-        query = "<|im_start|>system\nYou are a helpful assistant.<|im_end|>\n<|im_start|>user\n{}<|im_end|>\n<|im_start|>assistant\n".format(query)
-        input_ids = self.tokenizer.encode(query, return_tensors="pt").cuda()
-        output = self.model.generate(input_ids, **self.gen_kwargs)[0]
-        response = self.tokenizer.decode(
-            output[len(input_ids[0]) - len(output):], skip_special_tokens=True)
-        return response
+        return self.batcher.submit((self.format_prompt(query), ()))
 
+    def request_with_stop(self, query: str, stop: list[str]) -> str:
+        # Stays batched, the batch ends once every prompt reached one of its stop sequences
+        return self.batcher.submit((self.format_prompt(query), tuple(stop)))
 
-class Baichuan2_13B_Chat(BaseLLM):
-    def __init__(self, model_name='baichuan2_13b', temperature=1.0, max_new_tokens=1024):
-        super().__init__(model_name, temperature, max_new_tokens)
+    def stream(self, query: str, stop: list[str] = None) -> Iterator[str]:
+        inputs = self._tokenize([self.format_prompt(query)])
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        cancelled = Event()
+        stopping_criteria = StoppingCriteriaList([StopOnEvent(cancelled)])
+        if stop:
+            stopping_criteria.append(StopOnSequences(self.tokenizer, [tuple(stop)], inputs['input_ids'].shape[1]))
+        thread = Thread(target=self.model.generate, kwargs=dict(
+            **inputs, streamer=streamer, pad_token_id=self.tokenizer.pad_token_id,
+            stopping_criteria=stopping_criteria, **self.gen_kwargs
+        ))
+        thread.start()
+        try:
+            yield from iter_until_stop(streamer, stop)
+        finally:
+            cancelled.set()
+            thread.join()
+
+
+class Qwen_7B_Chat(LocalLLM):
+    def __init__(self, model_name='qwen_7b', temperature=1.0, max_new_tokens=1024, max_batch_size=8, max_wait=0.01):
+        super().__init__(model_name, temperature, max_new_tokens, max_batch_size, max_wait)
+        local_path = conf.Qwen_7B_local_path
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            local_path, pad_token='<|extra_0|>', trust_remote_code=True)
+        self.model = AutoModelForCausalLM.from_pretrained(local_path, device_map="auto",
+                                                     trust_remote_code=True).eval()
+
+    def format_prompt(self, query: str) -> str:
+        return "<|im_start|>system\nYou are a helpful assistant.<|im_end|>\n<|im_start|>user\n{}<|im_end|>\n<|im_start|>assistant\n".format(query)
+
+
+class Baichuan2_13B_Chat(LocalLLM):
+    def __init__(self, model_name='baichuan2_13b', temperature=1.0, max_new_tokens=1024, max_batch_size=8, max_wait=0.01):
+        super().__init__(model_name, temperature, max_new_tokens, max_batch_size, max_wait)
         local_path = conf.Baichuan2_13b_local_path
         self.tokenizer = AutoTokenizer.from_pretrained(
             local_path, use_fast=False, trust_remote_code=True)
@@ -44,25 +151,11 @@ class Baichuan2_13B_Chat(BaseLLM):
             device_map="auto",
             torch_dtype=torch.bfloat16,
             trust_remote_code=True)
-        self.gen_kwargs = {
-            "temperature": self.params['temperature'],
-            "do_sample": True,
-            "max_new_tokens": self.params['max_new_tokens'],
-            "top_p": self.params['top_p'],
-            "top_k": self.params['top_k'],
-        }
-    
-    def request(self, query: str) -> str:
-        input_ids = self.tokenizer.encode(query, return_tensors="pt").cuda()
-        output = self.model.generate(input_ids, **self.gen_kwargs)[0]
-        response = self.tokenizer.decode(
-            output[len(input_ids[0]) - len(output):], skip_special_tokens=True)
-        return response
 
 
-class ChatGLM3_6B_Chat(BaseLLM):
-    def __init__(self, model_name='chatglm3_6b', temperature=1.0, max_new_tokens=1024):
-        super().__init__(model_name, temperature, max_new_tokens)
+class ChatGLM3_6B_Chat(LocalLLM):
+    def __init__(self, model_name='chatglm3_6b', temperature=1.0, max_new_tokens=1024, max_batch_size=8, max_wait=0.01):
+        super().__init__(model_name, temperature, max_new_tokens, max_batch_size, max_wait)
         local_path = conf.ChatGLM3_local_path
         self.tokenizer = AutoTokenizer.from_pretrained(
             local_path, use_fast=False, trust_remote_code=True)
@@ -71,43 +164,16 @@ class ChatGLM3_6B_Chat(BaseLLM):
             device_map="auto",
             torch_dtype=torch.bfloat16,
             trust_remote_code=True)
-        self.gen_kwargs = {
-            "temperature": self.params['temperature'],
-            "do_sample": True,
-            "max_new_tokens": self.params['max_new_tokens'],
-            "top_p": self.params['top_p'],
-            "top_k": self.params['top_k'],
-        }
-    
-    def request(self, query: str) -> str:
-        input_ids = self.tokenizer.encode(query, return_tensors="pt").cuda()
-        output = self.model.generate(input_ids, **self.gen_kwargs)[0]
-        response = self.tokenizer.decode(
-            output[len(input_ids[0]) - len(output):], skip_special_tokens=True)
-        return response
 
 
-class Qwen_14B_Chat(BaseLLM):
-    def __init__(self, model_name='qwen_14b', temperature=1.0, max_new_tokens=1024):
-        super().__init__(model_name, temperature, max_new_tokens)
+class Qwen_14B_Chat(LocalLLM):
+    def __init__(self, model_name='qwen_14b', temperature=1.0, max_new_tokens=1024, max_batch_size=8, max_wait=0.01):
+        super().__init__(model_name, temperature, max_new_tokens, max_batch_size, max_wait)
         local_path = conf.Qwen_14B_local_path
         self.tokenizer = AutoTokenizer.from_pretrained(
-            local_path, trust_remote_code=True)
+            local_path, pad_token='<|extra_0|>', trust_remote_code=True)
         self.model = AutoModelForCausalLM.from_pretrained(local_path, device_map="auto",
                                                      trust_remote_code=True).eval()
-        self.gen_kwargs = {
-            "temperature": self.params['temperature'],
-            "do_sample": True,
-            "max_new_tokens": self.params['max_new_tokens'],
-            "top_p": self.params['top_p'],
-            "top_k": self.params['top_k'],
-        }
 
-    def request(self, query: str) -> str:
-        query = "<|im_start|>system\nYou are a helpful assistant.<|im_end|>\n<|im_start|>user\n{}<|im_end|>\n<|im_start|>assistant\n".format(query)
-        input_ids = self.tokenizer.encode(query, return_tensors="pt").cuda()
-        output = self.model.generate(input_ids, **self.gen_kwargs)[0]
-        response = self.tokenizer.decode(
-            output[len(input_ids[0]) - len(output):], skip_special_tokens=True)
-        return response
-    
+    def format_prompt(self, query: str) -> str:
+        return "<|im_start|>system\nYou are a helpful assistant.<|im_end|>\n<|im_start|>user\n{}<|im_end|>\n<|im_start|>assistant\n".format(query)
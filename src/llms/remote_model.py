@@ -1,8 +1,11 @@
-import requests
 import json
+from abc import abstractmethod
+from typing import Iterator
+
 from loguru import logger
 
-from src.llms.base import BaseLLM
+from src.llms.base import BaseLLM, iter_until_stop, truncate_at_stop
+from src.llms.transport import get_transport, iter_sse_data
 from importlib import import_module
 
 try:
@@ -11,55 +14,42 @@ except ImportError:
     conf = import_module("src.configs.config")
 
 
-class Baichuan2_13B_Chat(BaseLLM):
-    def request(self, query) -> str:
-        url = conf.Baichuan2_13B_url
-        payload = json.dumps({
-            "prompt": query,
-            "params": {
-                "temperature": self.params['temperature'],
-                "do_sample": True,
-                "max_new_tokens": self.params['max_new_tokens'],
-                "num_return_sequences": 1,
-                "top_p": self.params['top_p'],
-                "top_k": self.params['top_k'],
-            }
-        })
-        headers = {
-        'token': conf.Baichuan2_13B_token,
-        'Content-Type': 'application/json'
-        }
-        res = requests.request("POST", url, headers=headers, data=payload)
-        res = res.json()['choices'][0]
-        return res
+class RemoteLLM(BaseLLM):
+    """Model served over HTTP, with a blocking `request` and a non-blocking `arequest`.
 
+    Both go through the shared `HTTPTransport`, which pools connections, retries
+    failed calls and applies the rate limits of `conf.LLM_rate_limits`.
+
+    Subclasses describe the HTTP call in `prepare_request` and read the answer in
+    `parse_response`. Models whose API cannot stream fall back to `BaseLLM.stream`,
+    which cuts the full response at the stop sequence.
+    """
+    @abstractmethod
+    def prepare_request(self, query: str) -> tuple[str, dict, str]:
+        """Return the url, headers and payload of the request."""
+
+    def parse_response(self, res: dict) -> str:
+        return res['choices'][0]
+
+    def request(self, query: str) -> str:
+        url, headers, payload = self.prepare_request(query)
+        res = get_transport().post(url, headers=headers, data=payload)
+        return self.parse_response(res.json())
+
+    async def arequest(self, query: str, stop: list[str] = None) -> str:
+        url, headers, payload = self.prepare_request(query)
+        res = await get_transport().apost(url, headers=headers, data=payload)
+        return truncate_at_stop(self.parse_response(res), stop)
 
-class ChatGLM2_6B_Chat(BaseLLM):
-    def request(self, query) -> str:
-        url = conf.ChatGLM2_url
-        payload = json.dumps({
-            "prompt": query,
-            "params": {
-                "temperature": self.params['temperature'],
-                "do_sample": True,
-                "max_new_tokens": self.params['max_new_tokens'],
-                "num_return_sequences": 1,
-                "top_p": self.params['top_p'],
-                "top_k": self.params['top_k'],
-            }
-        })
-        headers = {
-        'token': conf.ChatGLM2_token,
-        'Content-Type': 'application/json'
-        }
-        res = requests.request("POST", url, headers=headers, data=payload)
-        res = res.json()['choices'][0]
-        return res
 
+class _SelfHostedChat(RemoteLLM):
+    """Models deployed behind the `{"prompt", "params"}` inference API."""
+    @abstractmethod
+    def endpoint(self) -> tuple[str, str]:
+        """Return the url and token of the deployment."""
 
-class Qwen_14B_Chat(BaseLLM):
-    def request(self, query) -> str:
-        url = conf.Qwen_url
+    def prepare_request(self, query: str) -> tuple[str, dict, str]:
+        url, token = self.endpoint()
         payload = json.dumps({
             "prompt": query,
             "params": {
@@ -72,20 +62,33 @@ class Qwen_14B_Chat(BaseLLM):
             }
         })
         headers = {
-        'token': conf.Qwen_token,
+        'token': token,
         'Content-Type': 'application/json'
         }
-        res = requests.request("POST", url, headers=headers, data=payload)
-        res = res.json()['choices'][0]
-        return res
+        return url, headers, payload
 
 
-class GPT(BaseLLM):
+class Baichuan2_13B_Chat(_SelfHostedChat):
+    def endpoint(self) -> tuple[str, str]:
+        return conf.Baichuan2_13B_url, conf.Baichuan2_13B_token
+
+
+class ChatGLM2_6B_Chat(_SelfHostedChat):
+    def endpoint(self) -> tuple[str, str]:
+        return conf.ChatGLM2_url, conf.ChatGLM2_token
+
+
+class Qwen_14B_Chat(_SelfHostedChat):
+    def endpoint(self) -> tuple[str, str]:
+        return conf.Qwen_url, conf.Qwen_token
+
+
+class GPT(RemoteLLM):
     def __init__(self, model_name='gpt-3.5-turbo', temperature=1.0, max_new_tokens=1024, report=False):
         super().__init__(model_name, temperature, max_new_tokens)
         self.report = report
 
-    def request(self, query: str) -> str:
+    def prepare_request(self, query: str, **extra) -> tuple[str, dict, str]:
         url = conf.GPT_transit_url
         payload = json.dumps({
             "model": self.params['model_name'],
@@ -93,6 +96,7 @@ class GPT(BaseLLM):
             "temperature": self.params['temperature'],
             'max_tokens': self.params['max_new_tokens'],
             "top_p": self.params['top_p'],
+            **extra,
         })
         headers = {
             'token': conf.GPT_transit_token,
@@ -101,10 +105,36 @@ class GPT(BaseLLM):
             'Accept': '*/*',
             'Connection': 'keep-alive'
         }
-        res = requests.request("POST", url, headers=headers, data=payload)
-        res = res.json()
+        return url, headers, payload
+
+    def parse_response(self, res: dict) -> str:
         real_res = res["choices"][0]["message"]["content"]
 
         token_consumed = res['usage']['total_tokens']
         logger.info(f'GPT token consumed: {token_consumed}') if self.report else ()
         return real_res
+
+    def request_with_stop(self, query: str, stop: list[str]) -> str:
+        # Not streamed, as in `arequest`, so that the endpoint does not have to support SSE
+        url, headers, payload = self.prepare_request(query, stop=stop)
+        res = get_transport().post(url, headers=headers, data=payload)
+        return truncate_at_stop(self.parse_response(res.json()), stop)
+
+    def stream(self, query: str, stop: list[str] = None) -> Iterator[str]:
+        extra = {"stream": True, "stop": stop} if stop else {"stream": True}
+        url, headers, payload = self.prepare_request(query, **extra)
+        res = get_transport().post(url, headers=headers, data=payload, stream=True)
+        chunks = (
+            event['choices'][0]['delta'].get('content') or ''
+            for event in iter_sse_data(res) if event.get('choices')
+        )
+        try:
+            yield from iter_until_stop(chunks, stop)
+        finally:
+            # Leaving early closes the connection, the server stops generating
+            res.close()
+
+    async def arequest(self, query: str, stop: list[str] = None) -> str:
+        url, headers, payload = self.prepare_request(query, **({"stop": stop} if stop else {}))
+        res = await get_transport().apost(url, headers=headers, data=payload)
+        return truncate_at_stop(self.parse_response(res), stop)
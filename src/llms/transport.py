@@ -0,0 +1,221 @@
+import asyncio
+import email.utils
+import json
+import random
+import threading
+import time
+import weakref
+from importlib import import_module
+from typing import Iterator
+from urllib.parse import urlsplit
+
+import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
+
+try:
+    conf = import_module("src.configs.real_config")
+except ImportError:
+    conf = import_module("src.configs.config")
+
+_async_sessions = weakref.WeakKeyDictionary()
+
+
+def get_async_session(limit: int = 512):
+    """Return the pooled keep-alive `aiohttp.ClientSession` of the running event loop.
+
+    Sessions are bound to an event loop, so one session is kept per loop and shared by
+    all remote models running on it.
+    """
+    try:
+        import aiohttp
+    except ImportError as exc:
+        raise ImportError(
+            "Could not import aiohttp python package. "
+            "Please install it with `pip install aiohttp`."
+        ) from exc
+
+    loop = asyncio.get_running_loop()
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=limit, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=600),
+        )
+        _async_sessions[loop] = session
+    return session
+
+
+async def close_async_session() -> None:
+    """Close the session of the running event loop, if any."""
+    session = _async_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` requests per second with bursts of `capacity`.
+
+    Callers reserve a token and wait for the returned delay, so waiting callers are
+    served in order and the bucket can be shared by threads and event loops.
+    """
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take one token and return how many seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def aacquire(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def parse_retry_after(value: str) -> float:
+    """Seconds to wait from a `Retry-After` header, given in seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def iter_sse_data(res: requests.Response) -> Iterator[dict]:
+    """Decode the `data:` events of a server-sent event stream until `[DONE]`."""
+    with res:
+        for line in res.iter_lines(decode_unicode=True):
+            if not line or not line.startswith('data:'):
+                continue
+            data = line[len('data:'):].strip()
+            if data == '[DONE]':
+                return
+            yield json.loads(data)
+
+
+class HTTPTransport:
+    """Connection-pooled HTTP transport of the remote LLMs, with retries and rate limiting.
+
+    Retries connection errors, timeouts, 429 and 5xx responses up to `max_retries`
+    times with full-jitter exponential backoff, or after the delay asked by the
+    `Retry-After` header. Requests to an endpoint listed in `rate_limits` go through a
+    token bucket shared by all threads and event loops.
+
+    Args:
+        pool_size (int): Maximum number of keep-alive connections per host.
+        max_retries (int): Maximum number of retries of a request.
+        backoff_base (float): Backoff of the first retry in seconds, doubled at each retry.
+        backoff_max (float): Upper bound of the backoff in seconds.
+        rate_limits (dict[str, float]): Requests per second allowed for each endpoint url.
+        timeout (float): Timeout of one attempt in seconds.
+    """
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(
+            self,
+            pool_size: int = 64,
+            max_retries: int = 4,
+            backoff_base: float = 0.5,
+            backoff_max: float = 30.0,
+            rate_limits: dict = None,
+            timeout: float = 600,
+        ):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.buckets = {
+            self._endpoint(url): TokenBucket(rate) for url, rate in (rate_limits or {}).items()
+        }
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @staticmethod
+    def _endpoint(url: str) -> str:
+        parts = urlsplit(url)
+        return f'{parts.scheme}://{parts.netloc}{parts.path}'
+
+    def backoff(self, attempt: int, retry_after: float = None) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def post(self, url: str, headers: dict = None, data: str = None, stream: bool = False) -> requests.Response:
+        """POST with retries. With `stream`, the body is left unread for `iter_lines`."""
+        bucket = self.buckets.get(self._endpoint(url))
+        for attempt in range(self.max_retries + 1):
+            if bucket is not None:
+                bucket.acquire()
+            try:
+                res = self.session.post(url, headers=headers, data=data, timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+                logger.warning(f'{repr(e)}, retrying in {delay:.2f}s')
+            else:
+                if res.status_code not in self.retry_statuses or attempt == self.max_retries:
+                    res.raise_for_status()
+                    return res
+                delay = self.backoff(attempt, parse_retry_after(res.headers.get('Retry-After')))
+                logger.warning(f'HTTP {res.status_code} from {url}, retrying in {delay:.2f}s')
+                res.close()
+            time.sleep(delay)
+
+    async def apost(self, url: str, headers: dict = None, data: str = None) -> dict:
+        """Asynchronous `post`, returning the decoded JSON body."""
+        import aiohttp
+
+        bucket = self.buckets.get(self._endpoint(url))
+        for attempt in range(self.max_retries + 1):
+            if bucket is not None:
+                await bucket.aacquire()
+            try:
+                async with get_async_session().post(
+                    url, headers=headers, data=data, timeout=aiohttp.ClientTimeout(total=self.timeout),
+                ) as res:
+                    if res.status not in self.retry_statuses or attempt == self.max_retries:
+                        res.raise_for_status()
+                        return await res.json(content_type=None)
+                    delay = self.backoff(attempt, parse_retry_after(res.headers.get('Retry-After')))
+                    logger.warning(f'HTTP {res.status} from {url}, retrying in {delay:.2f}s')
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+                logger.warning(f'{repr(e)}, retrying in {delay:.2f}s')
+            await asyncio.sleep(delay)
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> HTTPTransport:
+    """Return the process-wide transport shared by all remote models."""
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = HTTPTransport(rate_limits=getattr(conf, 'LLM_rate_limits', {}))
+        return _transport
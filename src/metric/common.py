@@ -2,12 +2,18 @@
 # @Email  : song.shichao@outlook.com
 
 
+import hashlib
+from collections import OrderedDict
+from threading import Lock
 from typing import Callable
 
 import evaluate
 import jieba
+import numpy as np
 from loguru import logger
-from text2vec import Similarity
+from text2vec import SentenceModel
+
+from src.utils.batching import MicroBatcher
 
 
 def catch_all_exceptions(func):
@@ -20,15 +26,90 @@ def catch_all_exceptions(func):
     return wrapper
 
 
+_metric_registry = {}
+_metric_registry_lock = Lock()
+
+
+def load_metric(path: str):
+    """Load an `evaluate` metric once per process.
+
+    `evaluate.load` imports and instantiates the metric module on every call, which
+    dominates the scoring time when done per data point. The loaded metric is cached
+    together with a lock, since `Metric.compute` keeps per-instance state and must not
+    be entered by several evaluator threads at the same time.
+
+    Returns:
+        tuple: The metric object and the lock guarding its `compute`.
+    """
+    with _metric_registry_lock:
+        if path not in _metric_registry:
+            _metric_registry[path] = (evaluate.load(path), Lock())
+        return _metric_registry[path]
+
+
+class TokenizationCache:
+    """Bounded LRU cache of jieba segmentations keyed by the hash of the text.
+
+    BLEU, ROUGE-L and RAGQuestEval F1 all segment the same generated and ground truth
+    texts, so each text only needs to go through jieba once per run.
+    """
+    def __init__(self, max_size: int = 65536):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def _key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+    def cut(self, text: str) -> list[str]:
+        key = self._key(text)
+        with self._lock:
+            tokens = self._cache.get(key)
+            if tokens is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return list(tokens)
+            self.misses += 1
+
+        tokens = tuple(jieba.cut(text))
+        with self._lock:
+            self._cache[key] = tokens
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return list(tokens)
+
+    def info(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cache), 'max_size': self.max_size}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+tokenization_cache = TokenizationCache()
+
+
+def jieba_cut(text: str) -> list[str]:
+    """Segment `text` with jieba through the process-wide tokenization cache."""
+    return tokenization_cache.cut(text)
+
+
 @catch_all_exceptions
 def bleu_score(
     continuation: str,
     reference: str,
     with_penalty = False
 ) -> float:
-    f = lambda text: list(jieba.cut(text))
-    bleu = evaluate.load('src/.cache/huggingface/bleu')
-    results = bleu.compute(predictions=[continuation], references=[[reference]], tokenizer=f)
+    bleu, lock = load_metric('src/.cache/huggingface/bleu')
+    with lock:
+        results = bleu.compute(predictions=[continuation], references=[[reference]], tokenizer=jieba_cut)
     
     bleu_avg = results['bleu']
     bleu1 = results['precisions'][0]
@@ -48,9 +129,9 @@ def rougeL_score(
     continuation: str,
     reference: str
 ) -> float:
-    f = lambda text: list(jieba.cut(text))
-    rouge = evaluate.load('src/.cache/huggingface/rouge')
-    results = rouge.compute(predictions=[continuation], references=[[reference]], tokenizer=f, rouge_types=['rougeL'])
+    rouge, lock = load_metric('src/.cache/huggingface/rouge')
+    with lock:
+        results = rouge.compute(predictions=[continuation], references=[[reference]], tokenizer=jieba_cut, rouge_types=['rougeL'])
     score = results['rougeL']
     return score
 
@@ -71,18 +152,75 @@ def kw_precision(
     return precision, appeared_kws, kws if with_kw_list else precision
 
 
+class BertScorer:
+    """Long-lived text2vec model scoring (continuation, reference) pairs in padded batches.
+
+    The model is loaded once. Concurrent `score` calls from the evaluator threads are
+    micro-batched, so every forward pass encodes the texts of several data points.
+    """
+    def __init__(
+            self,
+            model_name_or_path: str = "src/.cache/text2vec-base-chinese",
+            device: str = 'cpu',
+            batch_size: int = 64,
+            max_batch_size: int = 32,
+            max_wait: float = 0.01,
+        ):
+        self.model = SentenceModel(model_name_or_path=model_name_or_path, device=device)
+        self.batch_size = batch_size
+        self.batcher = MicroBatcher(
+            lambda pairs: self.score_pairs(*zip(*pairs)),
+            max_batch_size=max_batch_size, max_wait=max_wait, name='BertScorer'
+        )
+
+    def score_pairs(self, continuations: list[str], references: list[str]) -> list[float]:
+        """Cosine similarity of each pair, 0.0 when either side is empty (same as `Similarity.get_score`)."""
+        continuations = [text.strip() for text in continuations]
+        references = [text.strip() for text in references]
+        texts = list(dict.fromkeys(text for text in continuations + references if text))
+        if not texts:
+            return [0.0] * len(continuations)
+
+        embeddings = self.model.encode(texts, batch_size=self.batch_size, normalize_embeddings=True)
+        row = {text: i for i, text in enumerate(texts)}
+        scores = []
+        for continuation, reference in zip(continuations, references):
+            if not continuation or not reference:
+                scores.append(0.0)
+            else:
+                scores.append(float(np.dot(embeddings[row[continuation]], embeddings[row[reference]])))
+        return scores
+
+    def score(self, continuation: str, reference: str) -> float:
+        return self.batcher.submit((continuation, reference))
+
+
+_bert_scorer = None
+_bert_scorer_lock = Lock()
+
+
+def get_bert_scorer() -> BertScorer:
+    """Return the process-wide `BertScorer`, loading the model on first use."""
+    global _bert_scorer
+    with _bert_scorer_lock:
+        if _bert_scorer is None:
+            _bert_scorer = BertScorer()
+        return _bert_scorer
+
+
 @catch_all_exceptions
 def bert_score(
     continuation: str,
     reference: str
 ) -> float:
     """
+    Calls made at the same time by the scoring threads of the evaluators are encoded
+    together in one batch by the process-wide `BertScorer`.
+
     Note:
         Requesting the network to connect to Hugging Face. 
     """
-    sim = Similarity(model_name_or_path="src/.cache/text2vec-base-chinese")
-    score = sim.get_score(continuation, reference)
-    return score
+    return get_bert_scorer().score(continuation, reference)
 
 
 def classifications(
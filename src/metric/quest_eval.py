@@ -1,13 +1,13 @@
 import os
 import re
 import json
-import jieba
 import requests
 import numpy as np
 from loguru import logger
 from collections import Counter
 
 from src.llms import GPT
+from src.metric.common import jieba_cut
 from importlib import import_module
 
 try:
@@ -130,8 +130,8 @@ class QuestEval(GPT):
 
 
 def compute_f1(a_gold, a_pred):
-    gold_toks = list(jieba.cut(a_gold)) 
-    pred_toks = list(jieba.cut(a_pred)) 
+    gold_toks = jieba_cut(a_gold)
+    pred_toks = jieba_cut(a_pred)
     common = Counter(gold_toks) & Counter(pred_toks)
     num_same = sum(common.values())
     if len(gold_toks) == 0 or len(pred_toks) == 0:
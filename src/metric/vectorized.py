@@ -0,0 +1,183 @@
+"""
+Pure NumPy BLEU and ROUGE-L over whole batches of token-id arrays.
+
+The scores are per (prediction, reference) pair and reproduce `bleu_score` and
+`rougeL_score` in `src.metric.common` without going through `evaluate`, `datasets`
+and `rouge_score`, which score one pair at a time.
+"""
+
+from threading import Lock
+
+import numpy as np
+
+from src.metric.common import jieba_cut
+
+
+class Vocabulary:
+    """Map tokens to dense integer ids so that texts can be scored as int arrays."""
+    def __init__(self):
+        self.token2id = {}
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.token2id)
+
+    def encode(self, tokens: list[str]) -> np.ndarray:
+        with self._lock:
+            ids = [self.token2id.setdefault(token, len(self.token2id)) for token in tokens]
+        return np.asarray(ids, dtype=np.int64)
+
+    def encode_texts(self, texts: list[str]) -> list[np.ndarray]:
+        return [self.encode(jieba_cut(text)) for text in texts]
+
+
+def _flatten(sequences: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Concatenate sequences and return (tokens, lengths, start offsets)."""
+    lengths = np.fromiter((len(seq) for seq in sequences), dtype=np.int64, count=len(sequences))
+    starts = np.zeros(len(sequences), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    tokens = np.concatenate([np.asarray(seq, dtype=np.int64) for seq in sequences]) if lengths.sum() else np.zeros(0, dtype=np.int64)
+    return tokens, lengths, starts
+
+
+def _ngram_matches(predictions: list[np.ndarray], references: list[np.ndarray], max_order: int) -> np.ndarray:
+    """Clipped n-gram matches per pair and order, shape (batch, max_order).
+
+    Predictions and references are scored in one flat array. Each n-gram is hashed to
+    a dense integer by pairing the (n-1)-gram code with the next token id and
+    re-densifying with `np.unique`, which keeps the codes exact and within int64.
+    """
+    batch = len(predictions)
+    tokens, lengths, starts = _flatten(list(predictions) + list(references))
+    total = len(tokens)
+    owner = np.repeat(np.arange(2 * batch, dtype=np.int64), lengths)
+    position = np.arange(total, dtype=np.int64) - np.repeat(starts, lengths)
+    remaining = np.repeat(lengths, lengths) - position  # tokens left from each position, itself included
+
+    matches = np.zeros((batch, max_order), dtype=np.int64)
+    codes = tokens.copy()
+    vocab_size = int(tokens.max()) + 1 if total else 1
+    for order in range(1, max_order + 1):
+        if order > 1:
+            codes[:total - order + 1] = codes[:total - order + 1] * vocab_size + tokens[order - 1:]
+        valid = np.flatnonzero(remaining >= order)
+        if len(valid) == 0:
+            break
+        # Re-densify so that the next pairing step cannot overflow
+        uniq, inverse = np.unique(codes[valid], return_inverse=True)
+        codes[valid] = inverse
+        codes[remaining < order] = 0
+        num_codes = len(uniq)
+
+        keys = owner[valid] % batch * num_codes + inverse
+        is_pred = owner[valid] < batch
+        pred_keys, pred_counts = np.unique(keys[is_pred], return_counts=True)
+        ref_keys, ref_counts = np.unique(keys[~is_pred], return_counts=True)
+        common, pred_idx, ref_idx = np.intersect1d(pred_keys, ref_keys, assume_unique=True, return_indices=True)
+        clipped = np.minimum(pred_counts[pred_idx], ref_counts[ref_idx])
+        matches[:, order - 1] = np.bincount(common // num_codes, weights=clipped, minlength=batch)[:batch].astype(np.int64)
+    return matches
+
+
+def batch_bleu(
+    predictions: list[np.ndarray],
+    references: list[np.ndarray],
+    max_order: int = 4,
+    smooth: bool = False,
+    with_penalty: bool = False,
+) -> np.ndarray:
+    """Sentence-level BLEU for every (prediction, reference) pair.
+
+    Returns:
+        np.ndarray: Shape (batch, 1 + max_order), the columns match the tuple returned
+        by `bleu_score`: bleu (without brevity penalty unless `with_penalty`) followed by
+        the n-gram precisions. Rows for which `bleu_score` would fail are NaN.
+    """
+    batch = len(predictions)
+    if batch == 0:
+        return np.zeros((0, 1 + max_order))
+    matches = _ngram_matches(predictions, references, max_order)
+    pred_lengths = np.fromiter((len(seq) for seq in predictions), dtype=np.int64, count=batch)
+    ref_lengths = np.fromiter((len(seq) for seq in references), dtype=np.int64, count=batch)
+    possible = np.maximum(pred_lengths[:, None] - np.arange(max_order)[None, :], 0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if smooth:
+            precisions = (matches + 1.) / (possible + 1.)
+        else:
+            precisions = np.where(possible > 0, matches / np.maximum(possible, 1), 0.0)
+
+        log_precisions = (1. / max_order) * np.log(np.where(precisions > 0, precisions, 1.0))
+        geo_mean = np.where(precisions.min(axis=1) > 0, np.exp(log_precisions.sum(axis=1)), 0.0)
+
+        ratio = pred_lengths / ref_lengths
+        bp = np.where(ratio > 1.0, 1.0, np.exp(1 - 1. / ratio))
+        bleu = geo_mean * bp
+        if not with_penalty:
+            bleu = np.where(bp == 0, 0.0, bleu / bp)
+
+    scores = np.column_stack([bleu, precisions])
+    # `compute_bleu` raises ZeroDivisionError on empty references or predictions
+    scores[(ref_lengths == 0) | (pred_lengths == 0)] = np.nan
+    return scores
+
+
+def _lcs_lengths(predictions: list[np.ndarray], references: list[np.ndarray], chunk_size: int = 256) -> np.ndarray:
+    """LCS length of every pair with a DP vectorized over the reference axis and the batch.
+
+    One DP row is computed as a running maximum: dp[i][j] = max over k <= j of
+    (dp[i-1][k-1] + 1 if a[i] == b[k] else dp[i-1][k]). Pairs are bucketed by
+    prediction length to limit padding.
+    """
+    batch = len(predictions)
+    pred_lengths = np.fromiter((len(seq) for seq in predictions), dtype=np.int64, count=batch)
+    ref_lengths = np.fromiter((len(seq) for seq in references), dtype=np.int64, count=batch)
+    lcs = np.zeros(batch, dtype=np.int64)
+
+    order = np.argsort(pred_lengths, kind='stable')
+    for chunk_start in range(0, batch, chunk_size):
+        idx = order[chunk_start:chunk_start + chunk_size]
+        max_pred, max_ref = pred_lengths[idx].max(), ref_lengths[idx].max()
+        if max_pred == 0 or max_ref == 0:
+            continue
+        # Different paddings so that padding never matches
+        pred = np.full((len(idx), max_pred), -1, dtype=np.int64)
+        ref = np.full((len(idx), max_ref), -2, dtype=np.int64)
+        for row, i in enumerate(idx):
+            pred[row, :pred_lengths[i]] = predictions[i]
+            ref[row, :ref_lengths[i]] = references[i]
+
+        dp = np.zeros((len(idx), max_ref + 1), dtype=np.int32)
+        for i in range(max_pred):
+            candidate = np.where(ref == pred[:, i:i + 1], dp[:, :-1] + 1, dp[:, 1:])
+            np.maximum.accumulate(candidate, axis=1, out=dp[:, 1:])
+        lcs[idx] = dp[np.arange(len(idx)), ref_lengths[idx]]
+    return lcs
+
+
+def batch_rougeL(predictions: list[np.ndarray], references: list[np.ndarray]) -> np.ndarray:
+    """ROUGE-L F-measure for every (prediction, reference) pair."""
+    batch = len(predictions)
+    if batch == 0:
+        return np.zeros(0)
+    lcs = _lcs_lengths(predictions, references)
+    pred_lengths = np.fromiter((len(seq) for seq in predictions), dtype=np.int64, count=batch)
+    ref_lengths = np.fromiter((len(seq) for seq in references), dtype=np.int64, count=batch)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(pred_lengths > 0, lcs / np.maximum(pred_lengths, 1), 0.0)
+        recall = np.where(ref_lengths > 0, lcs / np.maximum(ref_lengths, 1), 0.0)
+        fmeasure = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+    return fmeasure
+
+
+def bleu_scores(continuations: list[str], references: list[str], with_penalty=False, vocab: Vocabulary = None) -> np.ndarray:
+    """Text-level wrapper of `batch_bleu`, tokenizing through the shared jieba cache."""
+    vocab = vocab or Vocabulary()
+    return batch_bleu(vocab.encode_texts(continuations), vocab.encode_texts(references), with_penalty=with_penalty)
+
+
+def rougeL_scores(continuations: list[str], references: list[str], vocab: Vocabulary = None) -> np.ndarray:
+    """Text-level wrapper of `batch_rougeL`, tokenizing through the shared jieba cache."""
+    vocab = vocab or Vocabulary()
+    return batch_rougeL(vocab.encode_texts(continuations), vocab.encode_texts(references))
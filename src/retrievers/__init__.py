@@ -1,4 +1,7 @@
+from .hits import RetrievalHit
 from .base import BaseRetriever
 from .bm25 import CustomBM25Retriever
 from .hybrid import EnsembleRetriever
-from .hybrid_rerank import EnsembleRerankRetriever
\ No newline at end of file
+from .hybrid_rerank import EnsembleRerankRetriever
+from .local import LocalVectorRetriever
+from .local_bm25 import LocalBM25Retriever
\ No newline at end of file
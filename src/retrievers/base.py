@@ -1,19 +1,31 @@
 from abc import ABC
+from typing import List
 
-from llama_index import GPTVectorStoreIndex, SimpleDirectoryReader, get_response_synthesizer
+import numpy as np
+
+from llama_index import GPTVectorStoreIndex, get_response_synthesizer
 from llama_index.retrievers import VectorIndexRetriever
-from llama_index.query_engine import RetrieverQueryEngine
 from llama_index.postprocessor import SimilarityPostprocessor
 from llama_index.node_parser import SimpleNodeParser
+from llama_index.schema import MetadataMode
 from llama_index import download_loader
 
 from llama_index.embeddings import LangchainEmbedding
 from llama_index import ServiceContext, StorageContext
 from langchain.schema.embeddings import Embeddings
 from llama_index.vector_stores import MilvusVectorStore
+from llama_index.vector_stores.utils import metadata_dict_to_node
+
+from src.embeddings.parallel import ParallelEmbedder, iter_embeddings
+from src.retrievers.hits import RetrievalHit, join_hits
+from src.retrievers.ingestion import iter_node_batches
 
 
 class BaseRetriever(ABC):
+    # Milvus and the embedding model serve concurrent queries, so the evaluator
+    # does not need to serialize calls to `search_docs`.
+    thread_safe: bool = True
+
     def __init__(
             self, 
             docs_directory: str, 
@@ -25,6 +37,10 @@ class BaseRetriever(ABC):
             construct_index: bool = False,
             add_index: bool = False,
             similarity_top_k: int=2,
+            embed_workers: int = 0,
+            embed_threads_per_worker: int = 4,
+            embed_batch_size: int = None,
+            ingest_workers: int = 0,
         ):
         self.docs_directory = docs_directory
         self.embed_model = embed_model
@@ -33,6 +49,10 @@ class BaseRetriever(ABC):
         self.chunk_overlap = chunk_overlap
         self.collection_name = collection_name
         self.similarity_top_k = similarity_top_k
+        self.embed_workers = embed_workers
+        self.embed_threads_per_worker = embed_threads_per_worker
+        self.embed_batch_size = embed_batch_size
+        self.ingest_workers = ingest_workers
 
         if construct_index:
             self.construct_index()
@@ -42,24 +62,13 @@ class BaseRetriever(ABC):
         if add_index:
             self.add_index()
 
-        # self.query_engine = self.vector_index.as_query_engine()
-        retriever = VectorIndexRetriever(
+        # Nodes are read straight from the retriever, no response is synthesized
+        self.index_retriever = VectorIndexRetriever(
             index=self.vector_index,
             similarity_top_k=self.similarity_top_k,
         )
 
-        # assemble query engine
-        self.query_engine = RetrieverQueryEngine(
-            retriever=retriever,
-        )
-
     def construct_index(self):
-        documents = SimpleDirectoryReader(self.docs_directory).load_data()
-        
-        node_parser = SimpleNodeParser.from_defaults(
-            chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap)
-        nodes = node_parser.get_nodes_from_documents(documents, show_progress=True)
-        
         self.embed_model = LangchainEmbedding(self.embed_model)
         service_context = ServiceContext.from_defaults(
             embed_model=self.embed_model,llm=None,
@@ -69,35 +78,28 @@ class BaseRetriever(ABC):
             collection_name=self.collection_name
         )
         storage_context = StorageContext.from_defaults(vector_store=vector_store)
-        
-        # Process and index nodes in chunks due to Milvus limitations
-        for spilt_ids in range(0, len(nodes), 8000):  
-            self.vector_index = GPTVectorStoreIndex(
-                nodes[spilt_ids:spilt_ids+8000], service_context=service_context, 
-                storage_context=storage_context, show_progress=True
-            )
-            print(f"Indexing of part {spilt_ids} finished!")
-
-            vector_store = MilvusVectorStore(
-                overwrite=False,
-                collection_name=self.collection_name
-            )
-            storage_context = StorageContext.from_defaults(vector_store=vector_store)
 
+        # Nodes are read, embedded and indexed in chunks due to Milvus limitations
+        node_batches = iter_node_batches(
+            self.docs_directory, self.chunk_size, self.chunk_overlap, batch_size=8000, num_workers=self.ingest_workers
+        )
+        self.index_node_batches(node_batches, service_context, storage_context)
         print("Indexing finished!")
 
     def add_index(self):
         if self.docs_type == 'json':
             JSONReader = download_loader("JSONReader")
             documents = JSONReader().load_data(self.docs_directory)
+            node_parser = SimpleNodeParser.from_defaults(
+                chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap
+            )
+            nodes = node_parser.get_nodes_from_documents(documents, show_progress=True)
+            node_batches = (nodes[spilt_ids:spilt_ids+8000] for spilt_ids in range(0, len(nodes), 8000))
         else:
-            documents = SimpleDirectoryReader(self.docs_directory).load_data()
-        
-        node_parser = SimpleNodeParser.from_defaults(
-            chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap
-        )
-        nodes = node_parser.get_nodes_from_documents(documents, show_progress=True)
-        
+            node_batches = iter_node_batches(
+                self.docs_directory, self.chunk_size, self.chunk_overlap, batch_size=8000, num_workers=self.ingest_workers
+            )
+
         self.embed_model = LangchainEmbedding(self.embed_model)
         service_context = ServiceContext.from_defaults(
             embed_model=self.embed_model,llm=None,
@@ -107,16 +109,73 @@ class BaseRetriever(ABC):
             collection_name=self.collection_name
         )
         storage_context = StorageContext.from_defaults(vector_store=vector_store)
+        self.index_node_batches(node_batches, service_context, storage_context)
+        print("Indexing finished!")
 
-         # Process and index nodes in chunks due to Milvus limitations
-        for spilt_ids in range(0, len(nodes), 8000):  
-            self.vector_index = GPTVectorStoreIndex(
-                nodes[spilt_ids:spilt_ids+8000], service_context=service_context, 
-                storage_context=storage_context, show_progress=True
+    def index_node_batches(self, node_batches, service_context, storage_context):
+        """Embed and insert each batch of nodes before the next one is read.
+
+        With `embed_workers` > 0 a single `ParallelEmbedder` serves all the batches, and
+        its `encode` batch size is tuned on the first one unless `embed_batch_size` is set.
+        """
+        embedder = None
+        if self.embed_workers > 0:
+            embedder = ParallelEmbedder(
+                getattr(self.embed_model, '_langchain_embedding', self.embed_model),
+                num_workers=self.embed_workers, threads_per_worker=self.embed_threads_per_worker,
+                batch_size=self.embed_batch_size or 32,
+            )
+        try:
+            num_nodes = 0
+            for nodes in node_batches:
+                self.embed_nodes(nodes, embedder=embedder)
+                self.vector_index = GPTVectorStoreIndex(
+                    nodes, service_context=service_context,
+                    storage_context=storage_context, show_progress=True
+                )
+                num_nodes += len(nodes)
+                print(f"Indexing of {num_nodes} nodes finished!")
+
+                vector_store = MilvusVectorStore(
+                    overwrite=False,
+                    collection_name=self.collection_name
+                )
+                storage_context = StorageContext.from_defaults(vector_store=vector_store)
+        finally:
+            if embedder is not None:
+                embedder.close()
+
+    def embed_nodes(self, nodes, batch_size: int = 8000, embedder: ParallelEmbedder = None):
+        """Embed nodes in place before indexing.
+
+        Each node gets a row view of one float32 array per batch as its embedding, so
+        no list of Python floats is built per node. llama_index skips nodes that
+        already have an embedding.
+
+        With `embedder`, or `embed_workers` > 0, the nodes are embedded by a `ParallelEmbedder`,
+        whose `encode` batch size is tuned on the first nodes unless `embed_batch_size` is set.
+        """
+        # `construct_index` may already have wrapped the model for llama_index
+        embed_model = getattr(self.embed_model, '_langchain_embedding', self.embed_model)
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+
+        if embedder is not None:
+            if self.embed_batch_size is None and not embedder.tuned:
+                embedder.tune_batch_size(texts)
+            embeddings_iter = embedder.embed(texts)
+        else:
+            embeddings_iter = iter_embeddings(
+                embed_model, texts, num_workers=self.embed_workers,
+                threads_per_worker=self.embed_threads_per_worker,
+                batch_size=self.embed_batch_size, chunk_size=batch_size,
             )
-            print(f"Indexing of part {spilt_ids} finished!")
 
-        print("Indexing finished!")
+        start = 0
+        for embeddings in embeddings_iter:
+            for node, embedding in zip(nodes[start:start + len(embeddings)], embeddings):
+                node.embedding = embedding
+            start += len(embeddings)
+            print(f"Embedding of {start}/{len(nodes)} nodes finished!")
 
     def load_index_from_milvus(self):
         vector_store =  MilvusVectorStore(
@@ -130,12 +189,52 @@ class BaseRetriever(ABC):
             service_context=service_context,
         )
 
+    def retrieve(self, query_text: str, top_k: int = None) -> List[RetrievalHit]:
+        index_retriever = self.index_retriever
+        if top_k is not None and top_k != self.similarity_top_k:
+            index_retriever = VectorIndexRetriever(index=self.vector_index, similarity_top_k=top_k)
+        return [
+            RetrievalHit(
+                text=result.node.get_content(), score=result.score,
+                node_id=result.node.node_id, source=result.node.metadata.get('file_path'),
+            )
+            for result in index_retriever.retrieve(query_text)
+        ]
+
+    def retrieve_batch(self, queries: List[str], top_k: int = None) -> List[List[RetrievalHit]]:
+        """Hits of each query, from one embedding call and one Milvus search of all the query vectors."""
+        if not queries:
+            return []
+        embed_model = getattr(self.embed_model, '_langchain_embedding', self.embed_model)
+        embeddings = getattr(embed_model, 'embed_queries', embed_model.embed_documents)(queries)
+
+        # The same search as `MilvusVectorStore.query`, with every query vector at once
+        vector_store = self.vector_index.vector_store
+        results = vector_store.milvusclient.search(
+            collection_name=vector_store.collection_name,
+            data=np.asarray(embeddings, dtype=np.float32).tolist(),
+            limit=top_k or self.similarity_top_k,
+            output_fields=['*'],
+            search_params=vector_store.search_config,
+        )
+        hit_lists = []
+        for result in results:
+            hits = []
+            for record in result:
+                node = metadata_dict_to_node({
+                    '_node_content': record['entity'].get('_node_content'),
+                    '_node_type': record['entity'].get('_node_type'),
+                })
+                hits.append(RetrievalHit(
+                    text=node.get_content(), score=record['distance'],
+                    node_id=node.node_id, source=node.metadata.get('file_path'),
+                ))
+            hit_lists.append(hits)
+        return hit_lists
+
     def search_docs(self, query_text: str):
-        response_vector = self.query_engine.query(query_text)
+        return join_hits(self.retrieve(query_text), "\n\n")
 
-        response_text_list = response_vector.response.split('\n---------------------\n')
-        response_text = response_text_list[1].split("\n\n")
-        response_text = "\n\n".join([text for text in response_text if not text.startswith("file_path: ")])
-        
-        return response_text
+    def search_docs_batch(self, queries: List[str]) -> List[str]:
+        return [join_hits(hits, "\n\n") for hits in self.retrieve_batch(queries)]
 
@@ -1,7 +1,7 @@
 from abc import ABC
+from typing import List
 
-from llama_index import GPTVectorStoreIndex, SimpleDirectoryReader, get_response_synthesizer
-from llama_index.node_parser import SimpleNodeParser
+from llama_index import GPTVectorStoreIndex, get_response_synthesizer
 from llama_index.vector_stores import ElasticsearchStore
 
 from llama_index.embeddings import LangchainEmbedding
@@ -10,8 +10,14 @@ from langchain.schema.embeddings import Embeddings
 from llama_index import QueryBundle
 from elasticsearch import Elasticsearch
 
+from src.retrievers.hits import RetrievalHit, join_hits
+from src.retrievers.ingestion import iter_node_batches
+
 
 class CustomBM25Retriever(ABC):
+    # The Elasticsearch client is thread-safe and pools its connections.
+    thread_safe: bool = True
+
     def __init__(
             self, 
             docs_directory: str, 
@@ -24,6 +30,7 @@ class CustomBM25Retriever(ABC):
             es_host: str = 'localhost',
             es_port: int = 9221,
             es_scheme: str = 'http',
+            ingest_workers: int = 0,
         ):
         self.docs_directory = docs_directory
         self.embed_model = embed_model
@@ -34,6 +41,7 @@ class CustomBM25Retriever(ABC):
         self.es_host = es_host
         self.es_port = es_port
         self.es_scheme = es_scheme
+        self.ingest_workers = ingest_workers
 
         if construct_index:
             self.construct_index()
@@ -42,12 +50,6 @@ class CustomBM25Retriever(ABC):
         print("Elasticsearch connected!")
 
     def construct_index(self):
-        documents = SimpleDirectoryReader(self.docs_directory).load_data()
-        
-        node_parser = SimpleNodeParser.from_defaults(
-            chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap)
-        nodes = node_parser.get_nodes_from_documents(documents, show_progress=True)
-        
         self.embed_model = LangchainEmbedding(self.embed_model)
         service_context = ServiceContext.from_defaults(
             embed_model=self.embed_model,llm=None,
@@ -57,35 +59,63 @@ class CustomBM25Retriever(ABC):
         )
         storage_context = StorageContext.from_defaults(vector_store=vector_store)
         
-        # Process and index nodes in chunks due to Milvus limitations
-        for spilt_ids in range(0, len(nodes), 8000):  
+        # Nodes are read and indexed in chunks, the corpus is never loaded at once
+        num_nodes = 0
+        for nodes in iter_node_batches(
+            self.docs_directory, self.chunk_size, self.chunk_overlap, batch_size=8000, num_workers=self.ingest_workers
+        ):
             self.vector_index = GPTVectorStoreIndex(
-                nodes[spilt_ids:spilt_ids+8000], service_context=service_context, 
+                nodes, service_context=service_context, 
                 storage_context=storage_context, show_progress=True
             )
-            print(f"Indexing of part {spilt_ids} finished!")
+            num_nodes += len(nodes)
+            print(f"Indexing of {num_nodes} nodes finished!")
 
         print("Indexing finished!")
 
-    def search_docs(self, query_text: str):
+    def _dsl(self, query_text: str, top_k: int = None) -> dict:
         query = QueryBundle(query_text)
-
-        result = []
-        dsl = {
+        return {
             'query': {
                 'match': {
                     'content': query.query_str
                 }
             },
-            "size": self.similarity_top_k
+            "size": top_k or self.similarity_top_k
         }
-        search_result = self.es_client.search(index=self.collection_name, body=dsl)
-        if search_result['hits']['hits']:
-            for record in search_result['hits']['hits']:
-                text = record['_source']['content']
-                result.append(text)
-        
-        result_str = '\n'.join(result)
 
-        return result_str
+    @staticmethod
+    def _hits(search_result: dict) -> List[RetrievalHit]:
+        return [
+            RetrievalHit(
+                text=record['_source']['content'], score=record['_score'], node_id=record['_id'],
+                source=record['_source'].get('metadata', {}).get('file_path'),
+            )
+            for record in search_result['hits']['hits']
+        ]
+
+    def retrieve(self, query_text: str, top_k: int = None) -> List[RetrievalHit]:
+        search_result = self.es_client.search(index=self.collection_name, body=self._dsl(query_text, top_k))
+        return self._hits(search_result)
+
+    def retrieve_batch(self, queries: List[str], top_k: int = None) -> List[List[RetrievalHit]]:
+        """Hits of each query, from a single `_msearch` request."""
+        if not queries:
+            return []
+        body = []
+        for query_text in queries:
+            body += [{'index': self.collection_name}, self._dsl(query_text, top_k)]
+        responses = self.es_client.msearch(body=body)['responses']
+
+        hit_lists = []
+        for query_text, response in zip(queries, responses):
+            if 'error' in response:
+                raise RuntimeError(f"Elasticsearch search of {query_text[:20]!r} failed: {response['error']}")
+            hit_lists.append(self._hits(response))
+        return hit_lists
+
+    def search_docs(self, query_text: str):
+        return join_hits(self.retrieve(query_text), '\n')
 
+    def search_docs_batch(self, queries: List[str]) -> List[str]:
+        return [join_hits(hits, '\n') for hits in self.retrieve_batch(queries)]
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from loguru import logger
+from tqdm import tqdm
+
+# Attributes that change how fast the contexts are retrieved, not which ones
+_RUNTIME_ATTRIBUTES = {
+    'embed_workers', 'embed_threads_per_worker', 'embed_batch_size', 'num_workers', 'ingest_workers', 'timeout',
+}
+_SCALARS = (str, int, float, bool, type(None))
+
+
+def retriever_config(retriever) -> dict:
+    """Settings of a retriever that determine its contexts, including those of the legs of an ensemble."""
+    config = {'class': type(retriever).__name__}
+    for name, value in sorted(vars(retriever).items()):
+        if name.startswith('_') or name in _RUNTIME_ATTRIBUTES:
+            continue
+        if isinstance(value, _SCALARS):
+            config[name] = value
+        elif isinstance(value, (list, tuple)) and all(isinstance(item, _SCALARS) for item in value):
+            config[name] = list(value)
+        elif isinstance(value, dict) and all(isinstance(item, _SCALARS) for item in value.values()):
+            config[name] = {str(key): item for key, item in value.items()}
+        elif hasattr(value, 'retrieve'):
+            config[name] = retriever_config(value)
+        else:
+            # Embedding models, possibly wrapped for llama_index, and rerankers
+            value = getattr(value, '_langchain_embedding', value)
+            if isinstance(getattr(value, 'model_name', None), str):
+                config[name] = value.model_name
+    return config
+
+
+def retriever_fingerprint(retriever) -> str:
+    config = json.dumps(retriever_config(retriever), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(config.encode('utf-8')).hexdigest()[:16]
+
+
+def contexts_path(directory: str, task_name: str, fingerprint: str) -> str:
+    return os.path.join(directory, f'{task_name}_{fingerprint}.parquet')
+
+
+def load_contexts(directory: str, task_name: str, retriever) -> dict:
+    """Contexts materialized for `task_name` by a retriever with the same fingerprint, by data point ID."""
+    path = contexts_path(directory, task_name, retriever_fingerprint(retriever))
+    if not os.path.exists(path):
+        return {}
+    table = pq.read_table(path, columns=['ID', 'context'])
+    return dict(zip(table.column('ID').to_pylist(), table.column('context').to_pylist()))
+
+
+def materialize_contexts(task, retriever, dataset: list[dict], directory: str = './contexts', batch_size: int = 64) -> str:
+    """Retrieve the context of every data point once and write them to a Parquet file.
+
+    The file is named after the task and the fingerprint of the retriever, and holds
+    one row per data point with its `ID`, `context` and the retriever `fingerprint`.
+    The retriever settings are stored in the schema metadata. Data points already in
+    the file are not retrieved again, and data points whose retrieval fails are left
+    out, so that evaluations retrieve them live.
+
+    Args:
+        task (BaseTask): Task whose `retrieve_docs_batch` builds the contexts, bound to `retriever`.
+        retriever: Retriever of the contexts.
+        dataset (list[dict]): Data points from `get_task_datasets`.
+        directory (str): Directory of the context files.
+        batch_size (int): Number of data points retrieved together.
+
+    Returns:
+        str: Path of the context file.
+    """
+    task_name = task.__class__.__name__
+    config = retriever_config(retriever)
+    fingerprint = retriever_fingerprint(retriever)
+    path = contexts_path(directory, task_name, fingerprint)
+    contexts = load_contexts(directory, task_name, retriever)
+    todo = [data_point for data_point in dataset if data_point['ID'] not in contexts]
+
+    for start in tqdm(range(0, len(todo), batch_size), desc=f'{task_name} contexts'):
+        batch = todo[start:start + batch_size]
+        try:
+            batch_contexts = task.retrieve_docs_batch(batch)
+        except Exception as e:
+            logger.warning(repr(e))
+            batch_contexts = []
+            for data_point in batch:
+                try:
+                    batch_contexts.append(task.retrieve_docs(data_point))
+                except Exception as e:
+                    logger.warning(repr(e))
+                    batch_contexts.append(None)
+        for data_point, context in zip(batch, batch_contexts):
+            if context is not None:
+                contexts[data_point['ID']] = context
+
+    table = pa.table({
+        'ID': list(contexts),
+        'context': pa.array(list(contexts.values()), type=pa.string()),
+        'fingerprint': pa.array([fingerprint] * len(contexts), type=pa.string()),
+    })
+    table = table.replace_schema_metadata({'retriever': json.dumps(config, ensure_ascii=False)})
+    os.makedirs(directory, exist_ok=True)
+    # Written next to the final file first, so a crash never leaves a truncated file behind
+    pq.write_table(table, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    logger.info(f'{len(contexts)}/{len(dataset)} {task_name} contexts of retriever {fingerprint} saved at {path}')
+    return path
@@ -0,0 +1,119 @@
+import hashlib
+from dataclasses import replace
+from typing import List
+
+import numpy as np
+
+from src.retrievers.hits import RetrievalHit
+
+FUSION_METHODS = ('rrf', 'combsum', 'combmnz')
+NORMALIZATIONS = ('minmax', 'zscore', 'none')
+
+
+def chunk_id(text: str) -> int:
+    """Signed 64-bit content hash of a chunk.
+
+    The legs of an ensemble index the chunks separately, so their node ids differ
+    and the same chunk is matched by its content.
+    """
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+
+def chunk_ids(hits: List[RetrievalHit]) -> np.ndarray:
+    return np.fromiter((chunk_id(hit.text) for hit in hits), dtype=np.int64, count=len(hits))
+
+
+def normalize_scores(scores: np.ndarray, normalization: str = 'minmax') -> np.ndarray:
+    """Scores of one leg mapped to a common scale.
+
+    `minmax` maps them to [0, 1], `zscore` to zero mean and unit variance, and
+    `none` keeps the raw retriever scores. A leg whose scores are all equal gets
+    1 with `minmax` and 0 with `zscore`.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    if normalization == 'none' or len(scores) == 0:
+        return scores
+    if normalization == 'minmax':
+        low, span = scores.min(), np.ptp(scores)
+        return (scores - low) / span if span > 0 else np.ones_like(scores)
+    if normalization == 'zscore':
+        std = scores.std()
+        return (scores - scores.mean()) / std if std > 0 else np.zeros_like(scores)
+    raise ValueError(f"Unknown normalization: {normalization}")
+
+
+def fuse_ids(
+        id_lists: List[np.ndarray],
+        score_lists: List[np.ndarray],
+        method: str = 'rrf',
+        weights: List[float] = None,
+        rrf_k: int = 60,
+        normalization: str = 'minmax',
+    ) -> tuple[np.ndarray, np.ndarray]:
+    """Fuse the ranked candidates of several legs, given as arrays of chunk ids and scores.
+
+    - `rrf`: weighted reciprocal rank fusion, sum of `weight / (rrf_k + rank)`. Scores are ignored.
+    - `combsum`: sum of the weighted normalized scores.
+    - `combmnz`: `combsum` times the number of legs that returned the chunk.
+
+    A chunk returned twice by the same leg counts once, at its best rank. Ties are
+    broken by the first position of the chunk in the concatenated legs.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Positions of the fused chunks in the concatenated
+            legs, at their first occurrence, and their fused scores, best first.
+    """
+    if method not in FUSION_METHODS:
+        raise ValueError(f"Unknown fusion method: {method}")
+    weights = [1.0] * len(id_lists) if weights is None else weights
+
+    all_ids, all_contributions, all_positions = [], [], []
+    offset = 0
+    for ids, scores, weight in zip(id_lists, score_lists, weights):
+        ids = np.asarray(ids, dtype=np.int64)
+        _, first = np.unique(ids, return_index=True)
+        first.sort()
+        if method == 'rrf':
+            contributions = weight / (rrf_k + first + 1.0)
+        else:
+            contributions = weight * normalize_scores(scores, normalization)[first]
+        all_ids.append(ids[first])
+        all_contributions.append(contributions)
+        all_positions.append(offset + first)
+        offset += len(ids)
+
+    if offset == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+    unique_ids, inverse = np.unique(np.concatenate(all_ids), return_inverse=True)
+    fused = np.bincount(inverse, weights=np.concatenate(all_contributions), minlength=len(unique_ids))
+    if method == 'combmnz':
+        fused *= np.bincount(inverse, minlength=len(unique_ids))
+
+    first_positions = np.full(len(unique_ids), offset, dtype=np.int64)
+    np.minimum.at(first_positions, inverse, np.concatenate(all_positions))
+    order = np.lexsort((first_positions, -fused))
+    return first_positions[order], fused[order]
+
+
+def fuse(
+        hit_lists: List[List[RetrievalHit]],
+        method: str = 'rrf',
+        weights: List[float] = None,
+        rrf_k: int = 60,
+        normalization: str = 'minmax',
+        top_k: int = None,
+    ) -> List[RetrievalHit]:
+    """Fuse the hits of several legs into one ranking, see `fuse_ids`.
+
+    The fused hits are those first returned for each chunk, with the fused score.
+    """
+    positions, scores = fuse_ids(
+        [chunk_ids(hits) for hits in hit_lists],
+        [np.fromiter((hit.score for hit in hits), dtype=np.float64, count=len(hits)) for hits in hit_lists],
+        method=method, weights=weights, rrf_k=rrf_k, normalization=normalization,
+    )
+    all_hits = [hit for hits in hit_lists for hit in hits]
+    return [
+        replace(all_hits[position], score=float(score))
+        for position, score in zip(positions[:top_k], scores[:top_k])
+    ]
@@ -0,0 +1,28 @@
+from dataclasses import dataclass
+from typing import List
+
+
+@dataclass
+class RetrievalHit:
+    """One retrieved chunk with the score given by its retriever.
+
+    Args:
+        text (str): Content of the chunk, without metadata.
+        score (float): Retriever score, higher is better. Scores of different retrievers are not comparable.
+        node_id (str): Id of the chunk in its index.
+        source (str): File the chunk was read from, when known.
+    """
+    text: str
+    score: float
+    node_id: str = None
+    source: str = None
+
+
+def node_chunk(node) -> dict:
+    """The fields of a `RetrievalHit` stored for a llama_index node by the local indexes."""
+    return {'text': node.get_content(), 'node_id': node.node_id, 'source': node.metadata.get('file_path')}
+
+
+def join_hits(hits: List[RetrievalHit], sep: str = "\n\n") -> str:
+    """Retrieval context passed to the prompts."""
+    return sep.join(hit.text for hit in hits)
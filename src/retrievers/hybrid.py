@@ -1,16 +1,108 @@
+import concurrent.futures
+import time
 from abc import ABC
 from typing import List
-from operator import itemgetter
 
 from llama_index.schema import TextNode
 from llama_index.schema import NodeWithScore
 from llama_index.retrievers import BaseRetriever
 from llama_index.indices.query.schema import QueryType
 from langchain.schema.embeddings import Embeddings
+from loguru import logger
 
 from src.retrievers import BaseRetriever, CustomBM25Retriever
+from src.retrievers.fusion import FUSION_METHODS, NORMALIZATIONS, fuse
+from src.retrievers.hits import RetrievalHit, join_hits
+from src.utils.latency import LatencyHistogram
+
+
+class LegFanOut:
+    """Query the legs of an ensemble concurrently on a thread pool shared by all queries.
+
+    Each leg gets `timeout` seconds from the start of the query. A leg that raises
+    or times out is logged and contributes no hits, so the ensemble degrades to the
+    legs that answered; only when every leg fails is the error raised. A timed-out
+    leg keeps its worker until it returns, since a running thread cannot be cancelled.
+
+    The latency of every leg call, including late ones, and of the whole fan-out are
+    recorded in `latency`.
+
+    Args:
+        legs (dict): Retrievers with a `retrieve` method, by name.
+        depths (dict): Number of candidates asked from each leg, by name, the `similarity_top_k`
+            of the leg by default.
+        timeout (float): Seconds to wait for each leg, no limit by default.
+        max_workers (int): Threads of the pool, two per concurrent query are enough.
+    """
+    def __init__(self, legs: dict, depths: dict = None, timeout: float = None, max_workers: int = 32):
+        self.legs = legs
+        self.depths = depths or {}
+        self.timeout = timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='RetrievalLeg')
+        self.latency = {name: LatencyHistogram(name) for name in [*legs, 'fan_out']}
+
+    def _retrieve_leg(self, name: str, query_text: str) -> List[RetrievalHit]:
+        with self.latency[name].time():
+            return self.legs[name].retrieve(query_text, self.depths.get(name))
+
+    def _gather(self, futures: dict, timeout: float, description: str, empty) -> list:
+        concurrent.futures.wait(futures.values(), timeout=timeout)
+        results, errors = [], []
+        for name, future in futures.items():
+            if not future.done():
+                future.cancel()
+                errors.append(TimeoutError(f'{name} retrieval timed out after {timeout}s'))
+            elif future.exception() is not None:
+                errors.append(future.exception())
+            else:
+                results.append(future.result())
+                continue
+            logger.warning(f'Retrieval leg {name} failed for {description}: {errors[-1]!r}')
+            results.append(empty)
+
+        if len(errors) == len(futures):
+            raise errors[0]
+        return results
+
+    def retrieve(self, query_text: str) -> List[List[RetrievalHit]]:
+        """Hits of each leg, in the order of `legs`, empty for the legs that failed."""
+        start = time.perf_counter()
+        futures = {
+            name: self.executor.submit(self._retrieve_leg, name, query_text) for name in self.legs
+        }
+        try:
+            return self._gather(futures, self.timeout, f'query {query_text[:20]!r}', [])
+        finally:
+            self.latency['fan_out'].record(time.perf_counter() - start)
+
+    def retrieve_batch(self, queries: List[str]) -> List[List[List[RetrievalHit]]]:
+        """Hits of each leg for each query, from one `retrieve_batch` call per leg.
+
+        Batches are not recorded in the latency histograms, which are per query. The
+        timeout of a batch is `timeout` per query.
+        """
+        futures = {
+            name: self.executor.submit(leg.retrieve_batch, queries, self.depths.get(name))
+            for name, leg in self.legs.items()
+        }
+        timeout = self.timeout * len(queries) if self.timeout is not None else None
+        leg_results = self._gather(futures, timeout, f'a batch of {len(queries)} queries', [[] for _ in queries])
+        return [list(hit_lists) for hit_lists in zip(*leg_results)]
+
+    def latency_summary(self) -> dict:
+        return {name: histogram.summary() for name, histogram in self.latency.items()}
+
 
 class EnsembleRetriever(ABC):
+    """Fusion of a BM25 and an embedding retriever queried concurrently.
+
+    Args:
+        fusion (str): `rrf`, `combsum` or `combmnz`, see `src.retrievers.fusion`.
+        fusion_normalization (str): Score normalization of `combsum` and `combmnz`,
+            `minmax`, `zscore` or `none`.
+        candidate_depth (int | dict): Number of candidates fetched from each leg before
+            fusion, or a dict of them by leg (`bm25`, `embedding`). `similarity_top_k` by default.
+    """
     def __init__(
             self, 
             docs_directory: str, 
@@ -22,7 +114,20 @@ class EnsembleRetriever(ABC):
             construct_index: bool = False,
             add_index: bool = False,
             similarity_top_k: int=2,
+            embed_workers: int = 0,
+            embed_threads_per_worker: int = 4,
+            embed_batch_size: int = None,
+            ingest_workers: int = 0,
+            leg_timeout: float = None,
+            fanout_workers: int = 32,
+            fusion: str = 'rrf',
+            fusion_normalization: str = 'minmax',
+            candidate_depth: int | dict = None,
         ):
+        if fusion not in FUSION_METHODS:
+            raise ValueError(f"Unknown fusion method: {fusion}")
+        if fusion_normalization not in NORMALIZATIONS:
+            raise ValueError(f"Unknown normalization: {fusion_normalization}")
         super().__init__()
         self.weights = [0.5, 0.5]
         self.c: int = 60
@@ -34,47 +139,53 @@ class EnsembleRetriever(ABC):
         self.chunk_overlap = chunk_overlap
         self.collection_name = collection_name
         self.similarity_top_k = similarity_top_k
+        self.fusion = fusion
+        self.fusion_normalization = fusion_normalization
+        if not isinstance(candidate_depth, dict):
+            candidate_depth = {'bm25': candidate_depth, 'embedding': candidate_depth}
 
         self.embedding_retriever = BaseRetriever(
             docs_directory, embed_model=embed_model, embed_dim=embed_dim,
             chunk_size=chunk_size, chunk_overlap=chunk_overlap,
             construct_index=construct_index, add_index=add_index,
             collection_name=collection_name, similarity_top_k=similarity_top_k,
+            embed_workers=embed_workers, embed_threads_per_worker=embed_threads_per_worker,
+            embed_batch_size=embed_batch_size, ingest_workers=ingest_workers,
         )
         self.bm25_retriever = CustomBM25Retriever(
             docs_directory, embed_model=embed_model,
             chunk_size=chunk_size, chunk_overlap=chunk_overlap,
-            similarity_top_k=similarity_top_k,
+            similarity_top_k=similarity_top_k, ingest_workers=ingest_workers,
+        )
+        self.fan_out = LegFanOut(
+            {'bm25': self.bm25_retriever, 'embedding': self.embedding_retriever},
+            depths=candidate_depth, timeout=leg_timeout, max_workers=fanout_workers,
+        )
+
+    @property
+    def thread_safe(self) -> bool:
+        return self.bm25_retriever.thread_safe and self.embedding_retriever.thread_safe
+
+    def retrieve(self, query_text: str, top_k: int = None) -> List[RetrievalHit]:
+        return fuse(
+            self.fan_out.retrieve(query_text), method=self.fusion, weights=self.weights,
+            rrf_k=self.c, normalization=self.fusion_normalization, top_k=top_k or self.top_k,
         )
 
+    def retrieve_batch(self, queries: List[str], top_k: int = None) -> List[List[RetrievalHit]]:
+        return [
+            fuse(
+                hit_lists, method=self.fusion, weights=self.weights, rrf_k=self.c,
+                normalization=self.fusion_normalization, top_k=top_k or self.top_k,
+            )
+            for hit_lists in self.fan_out.retrieve_batch(queries)
+        ]
+
     def search_docs(self, query_text: str):
-        bm25_search_docs = self.bm25_retriever.search_docs(query_text)
-        bm25_search_docs = bm25_search_docs.split("\n")
-        embedding_search_docs = self.embedding_retriever.search_docs(query_text)
-        embedding_search_docs = embedding_search_docs.split("\n\n")
-
-        doc_lists = [bm25_search_docs, embedding_search_docs]
-
-        # Create a union of all unique documents in the input doc_lists
-        all_documents = set()
-        for doc_list in doc_lists:
-            for doc in doc_list:
-                all_documents.add(doc)
-
-        # Initialize the RRF score dictionary for each document
-        rrf_score_dic = {doc: 0.0 for doc in all_documents}
-
-        # Calculate RRF scores for each document
-        for doc_list, weight in zip(doc_lists, self.weights):
-            for rank, doc in enumerate(doc_list, start=1):
-                rrf_score = weight * (1 / (rank + self.c))
-                rrf_score_dic[doc] += rrf_score
-
-        # Sort documents by their RRF scores in descending order
-        sorted_documents = sorted(rrf_score_dic.items(), key=itemgetter(1), reverse=True)
-        result = []
-        for sorted_doc in sorted_documents[:self.top_k]:
-            text, score = sorted_doc
-            result.append(text)
-
-        return "\n\n".join(result)
+        return join_hits(self.retrieve(query_text), "\n\n")
+
+    def search_docs_batch(self, queries: List[str]) -> List[str]:
+        return [join_hits(hits, "\n\n") for hits in self.retrieve_batch(queries)]
+
+    def latency_summary(self) -> dict:
+        return self.fan_out.latency_summary()
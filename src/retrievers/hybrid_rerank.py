@@ -1,4 +1,5 @@
 from abc import ABC
+from dataclasses import replace
 from typing import List
 from operator import itemgetter
 
@@ -9,13 +10,65 @@ from llama_index.indices.query.schema import QueryType
 from langchain.schema.embeddings import Embeddings
 
 from src.retrievers import BaseRetriever, CustomBM25Retriever
+from src.retrievers.hits import RetrievalHit, join_hits
+from src.retrievers.hybrid import LegFanOut
+from src.utils.batching import MicroBatcher
 from FlagEmbedding import FlagReranker
 
 
-def bge_rerank_result(query_text: str, docs: List[str], top_n):
-    reranker = FlagReranker('sentence-transformers/bge-rerank-base')
+class BgeReranker:
+    """Cross-encoder loaded once and shared by all queries of a retriever.
 
-    scores = reranker.compute_score([[query_text, passage] for passage in docs])
+    Rerank requests coming from concurrent evaluator threads are gathered by a
+    `MicroBatcher` and their (query, passage) pairs are scored in one forward pass.
+
+    Args:
+        model_name (str): Name or path of the bge reranker.
+        batch_size (int): Batch size of `FlagReranker.compute_score`.
+        max_batch_size (int): Maximum number of queries merged into one scoring call.
+        max_wait (float): Seconds to wait for other queries before scoring a batch.
+    """
+    def __init__(
+            self,
+            model_name: str = 'sentence-transformers/bge-rerank-base',
+            batch_size: int = 256,
+            max_batch_size: int = 16,
+            max_wait: float = 0.01,
+        ):
+        self.model_name = model_name
+        self.model = FlagReranker(model_name)
+        self.batch_size = batch_size
+        self.batcher = MicroBatcher(
+            self._score_requests, max_batch_size=max_batch_size, max_wait=max_wait, name='BgeReranker'
+        )
+
+    def _score_requests(self, requests: List[tuple[str, List[str]]]) -> List[List[float]]:
+        pairs = [[query_text, passage] for query_text, docs in requests for passage in docs]
+        if not pairs:
+            return [[] for _ in requests]
+        scores = self.model.compute_score(pairs, batch_size=self.batch_size)
+        if not isinstance(scores, list):  # a single pair gives a bare float
+            scores = [scores]
+
+        results, start = [], 0
+        for _, docs in requests:
+            results.append(scores[start:start + len(docs)])
+            start += len(docs)
+        return results
+
+    def compute_score(self, query_text: str, docs: List[str]) -> List[float]:
+        return self.batcher.submit((query_text, docs))
+
+    def compute_scores(self, requests: List[tuple[str, List[str]]]) -> List[List[float]]:
+        """Scores of several (query, docs) requests already batched by the caller."""
+        return self._score_requests(requests)
+
+
+def bge_rerank_result(query_text: str, docs: List[str], top_n, reranker: BgeReranker = None):
+    if reranker is None:
+        reranker = BgeReranker(max_batch_size=1)
+
+    scores = reranker.compute_score(query_text, docs)
     
     score_doc_pairs = zip(scores, docs)
     sorted_pairs = sorted(score_doc_pairs, key=lambda x: x[0], reverse=True)
@@ -24,6 +77,12 @@ def bge_rerank_result(query_text: str, docs: List[str], top_n):
     return sorted_docs[:top_n]
 
 class EnsembleRerankRetriever(ABC):
+    """Union of the candidates of a BM25 and an embedding retriever, reranked by a cross-encoder.
+
+    Args:
+        candidate_depth (int | dict): Number of candidates fetched from each leg before
+            reranking, or a dict of them by leg (`bm25`, `embedding`). `similarity_top_k` by default.
+    """
     def __init__(
             self, 
             docs_directory: str, 
@@ -35,6 +94,16 @@ class EnsembleRerankRetriever(ABC):
             construct_index: bool = False,
             add_index: bool = False,
             similarity_top_k: int=2,
+            embed_workers: int = 0,
+            embed_threads_per_worker: int = 4,
+            embed_batch_size: int = None,
+            ingest_workers: int = 0,
+            reranker_name: str = 'sentence-transformers/bge-rerank-base',
+            rerank_max_batch_size: int = 16,
+            rerank_max_wait: float = 0.01,
+            leg_timeout: float = None,
+            fanout_workers: int = 32,
+            candidate_depth: int | dict = None,
         ):
         super().__init__()
         self.weights = [0.5, 0.5]
@@ -47,34 +116,68 @@ class EnsembleRerankRetriever(ABC):
         self.chunk_overlap = chunk_overlap
         self.collection_name = collection_name
         self.similarity_top_k = similarity_top_k
+        if not isinstance(candidate_depth, dict):
+            candidate_depth = {'bm25': candidate_depth, 'embedding': candidate_depth}
 
         self.embedding_retriever = BaseRetriever(
             docs_directory, embed_model=embed_model, embed_dim=embed_dim,
             chunk_size=chunk_size, chunk_overlap=chunk_overlap,
             construct_index=construct_index, add_index=add_index,
             collection_name=collection_name, similarity_top_k=similarity_top_k,
+            embed_workers=embed_workers, embed_threads_per_worker=embed_threads_per_worker,
+            embed_batch_size=embed_batch_size, ingest_workers=ingest_workers,
         )
         self.bm25_retriever = CustomBM25Retriever(
             docs_directory, embed_model=embed_model,
             chunk_size=chunk_size, chunk_overlap=chunk_overlap,
-            similarity_top_k=similarity_top_k,
+            similarity_top_k=similarity_top_k, ingest_workers=ingest_workers,
+        )
+        self.fan_out = LegFanOut(
+            {'bm25': self.bm25_retriever, 'embedding': self.embedding_retriever},
+            depths=candidate_depth, timeout=leg_timeout, max_workers=fanout_workers,
+        )
+        self.reranker = BgeReranker(
+            reranker_name, max_batch_size=rerank_max_batch_size, max_wait=rerank_max_wait
         )
 
-    def search_docs(self, query_text: str):
-        bm25_search_docs = self.bm25_retriever.search_docs(query_text)
-        bm25_search_docs = bm25_search_docs.split("\n")
-        embedding_search_docs = self.embedding_retriever.search_docs(query_text)
-        embedding_search_docs = embedding_search_docs.split("\n\n")
+    @property
+    def thread_safe(self) -> bool:
+        return self.bm25_retriever.thread_safe and self.embedding_retriever.thread_safe
 
-        doc_lists = [bm25_search_docs, embedding_search_docs]
+    @staticmethod
+    def _union(hit_lists: List[List[RetrievalHit]]) -> List[RetrievalHit]:
+        # Union of the chunks found by both legs, matched by text
+        unique_hits = {}
+        for hits in hit_lists:
+            for hit in hits:
+                unique_hits.setdefault(hit.text, hit)
+        return list(unique_hits.values())
 
-        # Create a union of all unique documents in the input doc_lists
-        all_documents = set()
-        for doc_list in doc_lists:
-            for doc in doc_list:
-                all_documents.add(doc)
+    @staticmethod
+    def _rank(hits: List[RetrievalHit], scores: List[float], top_k: int) -> List[RetrievalHit]:
+        ranked = sorted(zip(scores, hits), key=lambda x: x[0], reverse=True)
+        return [replace(hit, score=float(score)) for score, hit in ranked[:top_k]]
+
+    def retrieve(self, query_text: str, top_k: int = None) -> List[RetrievalHit]:
+        hits = self._union(self.fan_out.retrieve(query_text))
+        scores = self.reranker.compute_score(query_text, [hit.text for hit in hits])
+        return self._rank(hits, scores, top_k or self.top_k)
+
+    def retrieve_batch(self, queries: List[str], top_k: int = None) -> List[List[RetrievalHit]]:
+        """Hits of each query, with the candidates of all queries reranked in one call."""
+        candidates = [self._union(hit_lists) for hit_lists in self.fan_out.retrieve_batch(queries)]
+        score_lists = self.reranker.compute_scores([
+            (query_text, [hit.text for hit in hits]) for query_text, hits in zip(queries, candidates)
+        ])
+        return [
+            self._rank(hits, scores, top_k or self.top_k) for hits, scores in zip(candidates, score_lists)
+        ]
+
+    def search_docs(self, query_text: str):
+        return join_hits(self.retrieve(query_text), "\n\n")
 
-        doc_lists = list(all_documents)
-        rerank_doc_lists = bge_rerank_result(query_text, doc_lists, top_n=self.top_k)
+    def search_docs_batch(self, queries: List[str]) -> List[str]:
+        return [join_hits(hits, "\n\n") for hits in self.retrieve_batch(queries)]
 
-        return "\n\n".join(rerank_doc_lists)
+    def latency_summary(self) -> dict:
+        return self.fan_out.latency_summary()
@@ -0,0 +1,75 @@
+import concurrent.futures
+from collections import deque
+from typing import Iterator, List
+
+from llama_index import SimpleDirectoryReader
+from llama_index.node_parser import SimpleNodeParser
+
+_node_parser = None
+
+
+def _init_chunking_worker(chunk_size: int, chunk_overlap: int) -> None:
+    global _node_parser
+    _node_parser = SimpleNodeParser.from_defaults(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+
+def _chunk_file(path: str) -> list:
+    documents = SimpleDirectoryReader(input_files=[path]).load_data()
+    return _node_parser.get_nodes_from_documents(documents)
+
+
+def list_files(docs_directory: str) -> List[str]:
+    """The files `SimpleDirectoryReader(docs_directory)` would load, in the same order."""
+    return [str(path) for path in SimpleDirectoryReader(docs_directory).input_files]
+
+
+def iter_node_batches(
+        docs_directory: str,
+        chunk_size: int = 128,
+        chunk_overlap: int = 0,
+        batch_size: int = 8000,
+        num_workers: int = 0,
+    ) -> Iterator[list]:
+    """Yield the nodes of the files of `docs_directory` in batches of `batch_size`, reading files lazily.
+
+    Each file is read and chunked on its own, in a pool of `num_workers` processes or
+    in-process when it is 0, and its nodes are yielded in file order. At most two files
+    per worker are in flight, so memory is bounded by a few files and one batch
+    whatever the size of the corpus.
+
+    The nodes are those of `SimpleNodeParser.get_nodes_from_documents` on
+    `SimpleDirectoryReader(docs_directory).load_data()`, which chunks each document
+    independently.
+    """
+    files = list_files(docs_directory)
+    if num_workers <= 0:
+        _init_chunking_worker(chunk_size, chunk_overlap)
+        node_lists = (_chunk_file(path) for path in files)
+        yield from _batched(node_lists, batch_size)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(
+        num_workers, initializer=_init_chunking_worker, initargs=(chunk_size, chunk_overlap),
+    ) as executor:
+        yield from _batched(_ordered_results(executor, files, 2 * num_workers), batch_size)
+
+
+def _ordered_results(executor, files: List[str], max_pending: int) -> Iterator[list]:
+    pending = deque()
+    for path in files:
+        pending.append(executor.submit(_chunk_file, path))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _batched(node_lists: Iterator[list], batch_size: int) -> Iterator[list]:
+    batch = []
+    for nodes in node_lists:
+        batch.extend(nodes)
+        while len(batch) >= batch_size:
+            yield batch[:batch_size]
+            batch = batch[batch_size:]
+    if batch:
+        yield batch
@@ -0,0 +1,259 @@
+import json
+import os
+from abc import ABC
+from typing import List
+
+import numpy as np
+from llama_index.schema import MetadataMode
+from langchain.schema.embeddings import Embeddings
+from loguru import logger
+
+from src.embeddings.parallel import ParallelEmbedder, iter_embeddings
+from src.retrievers.hits import RetrievalHit, join_hits, node_chunk
+from src.retrievers.ingestion import iter_node_batches
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Positions of the k largest scores, best first."""
+    k = min(k, len(scores))
+    if k == 0:
+        return np.zeros(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+def train_ivf(vectors: np.ndarray, nlist: int, iterations: int = 10, sample_size: int = None,
+              chunk_size: int = 65536, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """Spherical k-means coarse quantizer of normalized `vectors`.
+
+    Centroids are trained on a sample of at most `sample_size` vectors (256 per list
+    by default), then every vector is assigned to its closest centroid, `chunk_size`
+    vectors at a time so that a memory-mapped matrix is never loaded at once.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The (nlist, dim) centroids and the list of each vector.
+    """
+    rng = np.random.default_rng(seed)
+    num_vectors = len(vectors)
+    nlist = max(1, min(nlist, num_vectors))
+    sample_size = min(num_vectors, sample_size or 256 * nlist)
+    sample = np.asarray(vectors[np.sort(rng.choice(num_vectors, sample_size, replace=False))], dtype=np.float32)
+
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # Empty lists keep their previous centroid
+        centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+    assignment = np.empty(num_vectors, dtype=np.int64)
+    for start in range(0, num_vectors, chunk_size):
+        chunk = np.asarray(vectors[start:start + chunk_size], dtype=np.float32)
+        assignment[start:start + chunk_size] = np.argmax(chunk @ centroids.T, axis=1)
+    return centroids.astype(np.float32), assignment
+
+
+class LocalVectorRetriever(ABC):
+    """Embedding retriever over a memory-mapped vector file, with no vector database.
+
+    Chunks and their normalized embeddings are stored under
+    `index_directory/collection_name`:
+
+    - `vectors.npy` is a float32 (num_chunks, embed_dim) matrix, memory-mapped at query time.
+    - `chunks.json` holds the chunk texts, node ids and sources.
+    - `ivf.npz` holds the IVF centroids and the chunk ids grouped by list.
+
+    The index is built from the node batches of `iter_node_batches`, each batch being
+    embedded and written out before the next one is read.
+
+    `index_type='ivf'` scores only the chunks of the `nprobe` lists closest to the
+    query. `index_type='flat'` scores every chunk exactly, which is the reference
+    that `recall_at_k` compares IVF against.
+    """
+    # Searches only read the memory-mapped arrays
+    thread_safe: bool = True
+
+    def __init__(
+            self,
+            docs_directory: str,
+            embed_model: Embeddings,
+            embed_dim: int = 768,
+            chunk_size: int = 128,
+            chunk_overlap: int = 0,
+            collection_name: str = "docs",
+            construct_index: bool = False,
+            similarity_top_k: int = 2,
+            index_directory: str = './index',
+            index_type: str = 'ivf',
+            nlist: int = None,
+            nprobe: int = 16,
+            embed_workers: int = 0,
+            embed_threads_per_worker: int = 4,
+            embed_batch_size: int = None,
+            ingest_workers: int = 0,
+        ):
+        if index_type not in ('ivf', 'flat'):
+            raise ValueError(f"Unknown index type: {index_type}")
+        self.docs_directory = docs_directory
+        self.embed_model = embed_model
+        self.embed_dim = embed_dim
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.collection_name = collection_name
+        self.similarity_top_k = similarity_top_k
+        self.index_path = os.path.join(index_directory, collection_name)
+        self.index_type = index_type
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.embed_workers = embed_workers
+        self.embed_threads_per_worker = embed_threads_per_worker
+        self.embed_batch_size = embed_batch_size
+        self.ingest_workers = ingest_workers
+
+        if construct_index:
+            self.construct_index()
+        self.load_index()
+
+    def construct_index(self):
+        os.makedirs(self.index_path, exist_ok=True)
+        # The number of chunks is only known at the end, the rows are appended to a raw file first
+        raw_path = os.path.join(self.index_path, 'vectors.f32')
+        embedder = None
+        if self.embed_workers > 0:
+            embedder = ParallelEmbedder(
+                self.embed_model, num_workers=self.embed_workers,
+                threads_per_worker=self.embed_threads_per_worker, batch_size=self.embed_batch_size or 32,
+            )
+        num_chunks = 0
+        try:
+            with open(os.path.join(self.index_path, 'chunks.json'), 'w', encoding='utf-8') as chunks_file, \
+                    open(raw_path, 'wb') as raw_file:
+                chunks_file.write('[')
+                for nodes in iter_node_batches(
+                    self.docs_directory, self.chunk_size, self.chunk_overlap,
+                    batch_size=8000, num_workers=self.ingest_workers,
+                ):
+                    texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+                    chunks = (json.dumps(node_chunk(node), ensure_ascii=False) for node in nodes)
+                    chunks_file.write((', ' if num_chunks else '') + ', '.join(chunks))
+
+                    if embedder is not None:
+                        if self.embed_batch_size is None and not embedder.tuned:
+                            embedder.tune_batch_size(texts)
+                        embeddings_iter = embedder.embed(texts)
+                    else:
+                        embeddings_iter = iter_embeddings(self.embed_model, texts, batch_size=self.embed_batch_size)
+                    for embeddings in embeddings_iter:
+                        raw_file.write(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+                    num_chunks += len(nodes)
+                    print(f"Embedding of {num_chunks} nodes finished!")
+                chunks_file.write(']')
+        finally:
+            if embedder is not None:
+                embedder.close()
+
+        vectors = np.lib.format.open_memmap(
+            os.path.join(self.index_path, 'vectors.npy'), mode='w+',
+            dtype=np.float32, shape=(num_chunks, self.embed_dim),
+        )
+        if num_chunks:
+            raw = np.memmap(raw_path, dtype=np.float32, mode='r', shape=(num_chunks, self.embed_dim))
+            for start in range(0, num_chunks, 65536):
+                vectors[start:start + 65536] = raw[start:start + 65536]
+            del raw
+        vectors.flush()
+        os.remove(raw_path)
+
+        nlist = self.nlist or max(1, int(4 * np.sqrt(num_chunks)))
+        centroids, assignment = train_ivf(vectors, nlist)
+        order = np.argsort(assignment, kind='stable')
+        offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=len(centroids)), out=offsets[1:])
+        np.savez(os.path.join(self.index_path, 'ivf.npz'), centroids=centroids, ids=order, offsets=offsets)
+        print("Indexing finished!")
+
+    def load_index(self):
+        self.vectors = np.load(os.path.join(self.index_path, 'vectors.npy'), mmap_mode='r')
+        with open(os.path.join(self.index_path, 'chunks.json'), encoding='utf-8') as f:
+            self.chunks = json.load(f)
+        ivf = np.load(os.path.join(self.index_path, 'ivf.npz'))
+        self.centroids, self.list_ids, self.list_offsets = ivf['centroids'], ivf['ids'], ivf['offsets']
+        logger.info(f'Loaded {len(self.chunks)} chunks and {len(self.centroids)} IVF lists from {self.index_path}')
+
+    def embed_query(self, query_text: str) -> np.ndarray:
+        return np.asarray(self.embed_model.embed_query(query_text), dtype=np.float32)
+
+    def embed_queries(self, queries: List[str]) -> np.ndarray:
+        embed = getattr(self.embed_model, 'embed_queries', self.embed_model.embed_documents)
+        return np.asarray(embed(queries), dtype=np.float32).reshape(len(queries), -1)
+
+    def search_flat(self, query: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Exact top-k chunk ids and scores by inner product with every chunk."""
+        scores = self.vectors @ query
+        top = _top_k(scores, k)
+        return top, scores[top]
+
+    def search_ivf(self, query: np.ndarray, k: int, nprobe: int = None) -> tuple[np.ndarray, np.ndarray]:
+        """Approximate top-k chunk ids and scores among the chunks of the closest lists."""
+        probes = _top_k(self.centroids @ query, nprobe or self.nprobe)
+        candidates = np.concatenate([
+            self.list_ids[self.list_offsets[probe]:self.list_offsets[probe + 1]] for probe in probes
+        ])
+        # Sorted ids read the memory-mapped file sequentially
+        candidates.sort()
+        scores = self.vectors[candidates] @ query
+        top = _top_k(scores, k)
+        return candidates[top], scores[top]
+
+    def search(self, query_text: str, k: int = None) -> tuple[np.ndarray, np.ndarray]:
+        query = self.embed_query(query_text)
+        k = k or self.similarity_top_k
+        if self.index_type == 'flat':
+            return self.search_flat(query, k)
+        return self.search_ivf(query, k)
+
+    def retrieve(self, query_text: str, top_k: int = None) -> List[RetrievalHit]:
+        ids, scores = self.search(query_text, top_k)
+        return [RetrievalHit(score=float(score), **self.chunks[i]) for i, score in zip(ids, scores)]
+
+    def retrieve_batch(self, queries: List[str], top_k: int = None, batch_size: int = 256) -> List[List[RetrievalHit]]:
+        """Hits of each query, from one embedding call.
+
+        Flat searches score `batch_size` queries per pass over the vector file; IVF
+        searches probe different lists for each query and are run one by one.
+        """
+        k = top_k or self.similarity_top_k
+        embeddings = self.embed_queries(queries) if queries else np.zeros((0, self.embed_dim), dtype=np.float32)
+        results = []
+        if self.index_type == 'flat':
+            for start in range(0, len(embeddings), batch_size):
+                scores = self.vectors @ embeddings[start:start + batch_size].T
+                for column in scores.T:
+                    top = _top_k(column, k)
+                    results.append((top, column[top]))
+        else:
+            results = [self.search_ivf(query, k) for query in embeddings]
+        return [
+            [RetrievalHit(score=float(score), **self.chunks[i]) for i, score in zip(ids, scores)]
+            for ids, scores in results
+        ]
+
+    def search_docs(self, query_text: str):
+        return join_hits(self.retrieve(query_text), "\n\n")
+
+    def search_docs_batch(self, queries: List[str]) -> List[str]:
+        return [join_hits(hits, "\n\n") for hits in self.retrieve_batch(queries)]
+
+    def recall_at_k(self, queries: list[str], k: int = None, nprobe: int = None) -> float:
+        """Mean fraction of the exact top-k chunks that the IVF search also returns."""
+        k = k or self.similarity_top_k
+        recalls = []
+        for query_text in queries:
+            query = self.embed_query(query_text)
+            exact, _ = self.search_flat(query, k)
+            approximate, _ = self.search_ivf(query, k, nprobe)
+            if len(exact):
+                recalls.append(len(np.intersect1d(exact, approximate)) / len(exact))
+        return float(np.mean(recalls)) if recalls else 0.0
@@ -0,0 +1,280 @@
+import concurrent.futures
+import json
+import os
+import re
+from abc import ABC
+from collections import Counter
+from typing import List
+
+import jieba
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+from loguru import logger
+
+from src.retrievers.hits import RetrievalHit, join_hits, node_chunk
+from src.retrievers.ingestion import iter_node_batches
+
+_WORD = re.compile(r'\w')
+
+
+def tokenize(text: str) -> list[str]:
+    """Lower-cased jieba tokens, without whitespace and punctuation."""
+    return [token.lower() for token in jieba.lcut(text) if _WORD.search(token)]
+
+
+class BM25Index:
+    """In-process BM25 inverted index over jieba tokens.
+
+    Scores follow Elasticsearch's BM25 similarity:
+    idf * tf / (tf + k1 * (1 - b + b * dl / avgdl)).
+
+    The index is a set of `.npy` arrays under `path`, memory-mapped on load:
+
+    - `offsets.npy` holds where each term's postings start.
+    - `doc_gaps.npy` holds the delta-encoded doc ids of the postings, as uint16 when
+      every gap fits, otherwise as uint32.
+    - `tfs.npy` holds the term frequencies as uint16.
+    - `skip_ids.npy` holds the absolute doc id at the start of every block of
+      `block_size` postings, and `block_offsets.npy` holds where each term's blocks start.
+    - `max_scores.npy` holds an upper bound of each term's contribution to a score.
+    - `doc_lengths.npy` holds the number of tokens of each document.
+
+    Queries are scored term at a time with MaxScore pruning. Terms are visited by
+    decreasing upper bound and accumulated densely. Once at least k documents score
+    more than the upper bounds of the remaining terms add up to, no new document can
+    enter the top k. From then on the remaining terms only update the few candidates
+    that can still make it, decoding only the postings blocks that may contain them.
+    """
+    block_size = 128
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.k1, self.b, self.avgdl = meta['k1'], meta['b'], meta['avgdl']
+        with open(os.path.join(path, 'vocab.json'), encoding='utf-8') as f:
+            self.vocab = json.load(f)
+        # Plain ndarray views of the maps avoid the per-slice overhead of np.memmap
+        load = lambda name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r').view(np.ndarray)
+        self.offsets, self.doc_gaps, self.tfs = load('offsets'), load('doc_gaps'), load('tfs')
+        self.max_scores, self.doc_lengths = load('max_scores'), load('doc_lengths')
+        self.skip_ids, self.block_offsets = load('skip_ids'), load('block_offsets')
+        self.num_docs = len(self.doc_lengths)
+        df = np.diff(self.offsets)
+        self.idf = np.log(1 + (self.num_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        self.norms = (self.k1 * (1 - self.b + self.b * self.doc_lengths / self.avgdl)).astype(np.float32)
+
+    @classmethod
+    def build(cls, texts: list[str], path: str, k1: float = 1.2, b: float = 0.75, num_workers: int = 0) -> 'BM25Index':
+        """Tokenize `texts`, write the index under `path` and load it."""
+        if num_workers > 0:
+            with concurrent.futures.ProcessPoolExecutor(num_workers) as executor:
+                docs = list(executor.map(tokenize, texts, chunksize=256))
+        else:
+            docs = [tokenize(text) for text in texts]
+
+        vocab, term_ids, doc_ids, tfs = {}, [], [], []
+        for doc_id, tokens in enumerate(docs):
+            for token, tf in Counter(tokens).items():
+                term_ids.append(vocab.setdefault(token, len(vocab)))
+                doc_ids.append(doc_id)
+                tfs.append(tf)
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        tfs = np.minimum(np.asarray(tfs, dtype=np.int64), np.iinfo(np.uint16).max).astype(np.uint16)
+        doc_lengths = np.fromiter((len(tokens) for tokens in docs), dtype=np.int32, count=len(docs))
+        avgdl = float(doc_lengths.mean()) if len(docs) else 1.0
+
+        # Postings sorted by term, then by doc id
+        order = np.lexsort((doc_ids, term_ids))
+        term_ids, doc_ids, tfs = term_ids[order], doc_ids[order], tfs[order]
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(vocab)), out=offsets[1:])
+        starts = offsets[:-1]
+        gaps = np.diff(doc_ids, prepend=0)
+        gaps[starts] = doc_ids[starts]
+        gap_dtype = np.uint16 if len(gaps) == 0 or gaps.max() <= np.iinfo(np.uint16).max else np.uint32
+
+        norms = k1 * (1 - b + b * doc_lengths[doc_ids] / avgdl)
+        contributions = tfs / (tfs + norms)
+        df = np.diff(offsets)
+        idf = np.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+        max_scores = idf * np.maximum.reduceat(contributions, starts) if len(vocab) else np.zeros(0)
+
+        num_blocks = -(-df // cls.block_size)
+        block_offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(num_blocks, out=block_offsets[1:])
+        block_terms = np.repeat(np.arange(len(vocab)), num_blocks)
+        block_index = np.arange(block_offsets[-1]) - block_offsets[block_terms]
+        skip_ids = doc_ids[starts[block_terms] + block_index * cls.block_size]
+
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'offsets.npy'), offsets)
+        np.save(os.path.join(path, 'doc_gaps.npy'), gaps.astype(gap_dtype))
+        np.save(os.path.join(path, 'tfs.npy'), tfs)
+        np.save(os.path.join(path, 'max_scores.npy'), max_scores.astype(np.float32))
+        np.save(os.path.join(path, 'doc_lengths.npy'), doc_lengths)
+        np.save(os.path.join(path, 'skip_ids.npy'), skip_ids)
+        np.save(os.path.join(path, 'block_offsets.npy'), block_offsets)
+        with open(os.path.join(path, 'vocab.json'), 'w', encoding='utf-8') as f:
+            json.dump(vocab, f, ensure_ascii=False)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'k1': k1, 'b': b, 'avgdl': avgdl, 'num_docs': len(docs)}, f)
+        return cls(path)
+
+    def postings(self, term_id: int) -> tuple[np.ndarray, np.ndarray]:
+        """Doc ids and BM25 contributions of a term."""
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        doc_ids = np.cumsum(self.doc_gaps[start:end], dtype=np.int64)
+        tfs = self.tfs[start:end].astype(np.float32)
+        return doc_ids, self.idf[term_id] * tfs / (tfs + self.norms[doc_ids])
+
+    def lookup(self, term_id: int, doc_ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """BM25 contributions of a term to the sorted `doc_ids` that contain it.
+
+        Only the postings blocks whose doc id range covers one of `doc_ids` are decoded.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: Positions in `doc_ids` of the documents that
+            contain the term and their contributions.
+        """
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        first_ids = self.skip_ids[self.block_offsets[term_id]:self.block_offsets[term_id + 1]]
+        blocks = np.searchsorted(first_ids, doc_ids, side='right') - 1
+        blocks = blocks[blocks >= 0]
+        # `doc_ids` are sorted, so are their blocks
+        blocks = blocks[np.flatnonzero(np.diff(blocks, prepend=-1))]
+        if len(blocks) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        if 2 * len(blocks) > len(first_ids):
+            # Most blocks are needed, decoding the whole list is cheaper
+            block_ids, scores = self.postings(term_id)
+            index = np.minimum(np.searchsorted(block_ids, doc_ids), len(block_ids) - 1)
+            hit = np.flatnonzero(block_ids[index] == doc_ids)
+            return hit, scores[index[hit]]
+
+        block_starts = start + blocks * self.block_size
+        lengths = np.minimum(block_starts + self.block_size, end) - block_starts
+        segment_starts = np.zeros(len(blocks), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=segment_starts[1:])
+        positions = np.arange(lengths.sum()) - np.repeat(segment_starts - block_starts, lengths)
+        # Decode each block from its absolute first doc id
+        gaps = self.doc_gaps[positions].astype(np.int64)
+        gaps[segment_starts] = first_ids[blocks]
+        block_ids = np.cumsum(gaps)
+        block_ids -= np.repeat(block_ids[segment_starts] - first_ids[blocks], lengths)
+
+        index = np.minimum(np.searchsorted(block_ids, doc_ids), len(block_ids) - 1)
+        hit = np.flatnonzero(block_ids[index] == doc_ids)
+        tfs = self.tfs[positions[index[hit]]].astype(np.float32)
+        return hit, self.idf[term_id] * tfs / (tfs + self.norms[doc_ids[hit]])
+
+    def search(self, query: str, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Top-k doc ids and scores, best first."""
+        counts = Counter(self.vocab[token] for token in tokenize(query) if token in self.vocab)
+        if not counts or k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        # A term repeated in the query counts once per occurrence, like a `match` query
+        terms = sorted(counts, key=lambda term: -counts[term] * self.max_scores[term])
+        bounds = np.array([counts[term] * self.max_scores[term] for term in terms])
+        remaining = np.append(np.cumsum(bounds[::-1])[::-1], 0.0)
+
+        accumulator = np.zeros(self.num_docs, dtype=np.float32)
+        i = 0
+        while i < len(terms):
+            doc_ids, scores = self.postings(terms[i])
+            # Doc ids are unique within a postings list
+            accumulator[doc_ids] += counts[terms[i]] * scores
+            i += 1
+            # Documents not seen yet can score at most `remaining[i]`
+            if np.count_nonzero(accumulator > remaining[i]) >= k:
+                break
+
+        cand_ids = np.flatnonzero(accumulator)
+        cand_scores = accumulator[cand_ids]
+        for j in range(i, len(terms) + 1):
+            # A candidate can gain at most `remaining[j]` from the terms left
+            above = cand_scores[cand_scores > remaining[j]]
+            if len(above) >= k:
+                threshold = np.partition(above, len(above) - k)[len(above) - k]
+                keep = np.flatnonzero(cand_scores + remaining[j] >= threshold)
+                cand_ids, cand_scores = cand_ids[keep], cand_scores[keep]
+            if j == len(terms):
+                break
+            hit, scores = self.lookup(terms[j], cand_ids)
+            cand_scores[hit] += counts[terms[j]] * scores
+
+        k = min(k, len(cand_ids))
+        if k == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        top = np.argpartition(-cand_scores, k - 1)[:k]
+        top = top[np.lexsort((cand_ids[top], -cand_scores[top]))]
+        return cand_ids[top], cand_scores[top]
+
+
+class LocalBM25Retriever(ABC):
+    """Drop-in replacement of `CustomBM25Retriever` without Elasticsearch.
+
+    Chunks the documents like the other retrievers and searches them with a
+    `BM25Index` stored under `index_directory/collection_name`. The documents are
+    read and chunked batch by batch by `iter_node_batches`, only the chunks are kept.
+    """
+    # Searches only read the memory-mapped index
+    thread_safe: bool = True
+
+    def __init__(
+            self,
+            docs_directory: str,
+            embed_model: Embeddings = None,
+            chunk_size: int = 128,
+            chunk_overlap: int = 0,
+            collection_name: str = "docs_80k",
+            construct_index: bool = False,
+            similarity_top_k: int = 2,
+            index_directory: str = './index',
+            num_workers: int = 0,
+            ingest_workers: int = 0,
+        ):
+        self.docs_directory = docs_directory
+        self.embed_model = embed_model
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.similarity_top_k = similarity_top_k
+        self.collection_name = collection_name
+        self.index_path = os.path.join(index_directory, collection_name, 'bm25')
+        self.num_workers = num_workers
+        self.ingest_workers = ingest_workers
+
+        if construct_index:
+            self.construct_index()
+        self.index = BM25Index(self.index_path)
+        with open(os.path.join(self.index_path, 'chunks.json'), encoding='utf-8') as f:
+            self.chunks = json.load(f)
+        logger.info(f'Loaded BM25 index of {len(self.chunks)} chunks from {self.index_path}')
+
+    def construct_index(self):
+        chunks = []
+        for nodes in iter_node_batches(
+            self.docs_directory, self.chunk_size, self.chunk_overlap,
+            batch_size=8000, num_workers=self.ingest_workers,
+        ):
+            chunks.extend(node_chunk(node) for node in nodes)
+
+        BM25Index.build([chunk['text'] for chunk in chunks], self.index_path, num_workers=self.num_workers)
+        with open(os.path.join(self.index_path, 'chunks.json'), 'w', encoding='utf-8') as f:
+            json.dump(chunks, f, ensure_ascii=False)
+        print("Indexing finished!")
+
+    def retrieve(self, query_text: str, top_k: int = None) -> List[RetrievalHit]:
+        doc_ids, scores = self.index.search(query_text, top_k or self.similarity_top_k)
+        return [RetrievalHit(score=float(score), **self.chunks[i]) for i, score in zip(doc_ids, scores)]
+
+    def retrieve_batch(self, queries: List[str], top_k: int = None) -> List[List[RetrievalHit]]:
+        # Searches are in-process, there is no round trip to save
+        return [self.retrieve(query_text, top_k) for query_text in queries]
+
+    def search_docs(self, query_text: str):
+        return join_hits(self.retrieve(query_text), '\n')
+
+    def search_docs_batch(self, queries: List[str]) -> List[str]:
+        return [join_hits(hits, '\n') for hits in self.retrieve_batch(queries)]
@@ -11,6 +11,9 @@ from src.metric.common import (
 from src.metric.quest_eval import QuestEval
 
 class BaseTask(ABC):
+    # Generation stops at the end of the answer, the rest of the response is never used
+    stop_sequences = ['</response>']
+
     def __init__(
             self,
             output_dir: str = './output',
@@ -39,10 +42,30 @@ class BaseTask(ABC):
 
         return " "
 
+    def retrieve_docs_batch(self, objs:list[dict]) -> list[str]:
+        # retrieve the contexts of several data points, in as few retriever calls as possible
+        return [self.retrieve_docs(obj) for obj in objs]
+
     def model_generation(self, obj:dict) -> None:
         # use LLM to generate text
         
         return     
+
+    def build_query(self, obj:dict) -> str:
+        # fill the prompt template with the data point
+        
+        return ''
+
+    @staticmethod
+    def parse_response(res: str) -> str:
+        real_res = res.split('<response>')[-1].split('</response>')[0]
+        return real_res.strip()
+
+    async def amodel_generation(self, obj:dict) -> str:
+        # use LLM to generate text without blocking the event loop
+        query = self.build_query(obj)
+        res = await self.model.asafe_request(query, stop=self.stop_sequences)
+        return self.parse_response(res)
         
     def _read_prompt_template(self, filename: str):
         # read template to generate prompt
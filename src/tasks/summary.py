@@ -35,19 +35,23 @@ class Summary(BaseTask):
     
     def retrieve_docs(self, obj:dict) -> str:
         query_text = obj["event"]
-        retrieve_context = self.retriever.search_docs(query_text)
-        retrieve_context = retrieve_context.split('\nGiven the context information')[0]
-        return retrieve_context
+        return self.retriever.search_docs(query_text)
 
-    def model_generation(self, obj:dict):
+    def retrieve_docs_batch(self, objs:list[dict]) -> list[str]:
+        return self.retriever.search_docs_batch([obj["event"] for obj in objs])
+
+    def build_query(self, obj:dict) -> str:
         template = self._read_prompt_template('summary.txt')
         query = template.format(
             event=f'{obj["event"]}',
             search_documents=f'{obj["retrieve_context"]}'
         )
-        res = self.model.safe_request(query)
-        real_res = res.split('<response>')[-1].split('</response>')[0]
-        return real_res.strip()
+        return query
+
+    def model_generation(self, obj:dict):
+        query = self.build_query(obj)
+        res = self.model.safe_request(query, stop=self.stop_sequences)
+        return self.parse_response(res)
 
     def _read_prompt_template(self, filename: str):
         path = os.path.join('src/prompts/', filename)
@@ -0,0 +1,80 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable
+
+from loguru import logger
+
+
+class MicroBatcher:
+    """Collect concurrent single-item calls into batches handled by one worker thread.
+
+    Evaluator threads call `submit` with one item and block until its result is ready.
+    The worker waits at most `max_wait` seconds after the first pending item to fill a
+    batch of up to `max_batch_size` items, then calls `batch_fn` once for the batch.
+
+    Args:
+        batch_fn (Callable[[list], list]): Maps a list of items to a list of results of the same length.
+        max_batch_size (int): Upper bound on the number of items passed to `batch_fn`.
+        max_wait (float): Seconds to wait for more items once a batch has been started.
+        name (str): Name of the worker thread, for logging.
+    """
+    def __init__(
+            self,
+            batch_fn: Callable[[list], list],
+            max_batch_size: int = 32,
+            max_wait: float = 0.01,
+            name: str = 'MicroBatcher',
+        ):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.name = name
+        self._queue = queue.Queue()
+        self._worker = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, item: Any) -> Any:
+        """Add `item` to the next batch and wait for its result."""
+        if self.max_batch_size == 1:
+            return self.batch_fn([item])[0]
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((item, future))
+        return future.result()
+
+    def _ensure_worker(self) -> None:
+        with self._start_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self._worker.start()
+
+    def _collect(self) -> list[tuple[Any, Future]]:
+        pending = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(pending) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                pending.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return pending
+
+    def _loop(self) -> None:
+        while True:
+            pending = self._collect()
+            items = [item for item, _ in pending]
+            try:
+                results = self.batch_fn(items)
+                if len(results) != len(items):
+                    raise ValueError(f'{self.name}: got {len(results)} results for {len(items)} items')
+            except Exception as e:
+                logger.warning(repr(e))
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(pending, results):
+                future.set_result(result)
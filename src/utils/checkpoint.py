@@ -0,0 +1,152 @@
+import json
+import os
+import re
+import time
+from threading import Lock
+
+# Every record starts with its id and validity, so they can be read without parsing the rest of the line
+_RECORD_PREFIX = re.compile(r'^\{"id": (?P<id>"(?:[^"\\]|\\.)*"|-?\d+), "valid": (?P<valid>true|false)')
+
+
+class ResultCheckpoint:
+    """Append-only JSONL log of evaluation results.
+
+    Each result is appended as one line as soon as it is scored. Lines are flushed
+    immediately and fsync'ed in batches of `fsync_every` records or every
+    `fsync_interval` seconds, whichever comes first.
+
+    A sidecar index next to the log keeps one `<valid>\t<json id>` line per record,
+    so resuming only reads the small index instead of the result bodies. The index is
+    written after the log, a missing index entry only means that the result is
+    evaluated again.
+
+    Args:
+        path (str): Path of the JSONL file.
+        fsync_every (int): Number of appended records between two fsyncs.
+        fsync_interval (float): Maximum number of seconds between two fsyncs.
+    """
+    def __init__(self, path: str, fsync_every: int = 32, fsync_interval: float = 5.0):
+        self.path = path
+        self.index_path = os.path.splitext(path)[0] + '.ids'
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._file = None
+        self._index_file = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._lock = Lock()
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def append(self, result: dict) -> None:
+        line = json.dumps({'id': result['id'], 'valid': result['valid'], **result}, ensure_ascii=False)
+        index_line = f"{int(bool(result['valid']))}\t{json.dumps(result['id'], ensure_ascii=False)}"
+        with self._lock:
+            if self._file is None:
+                self._open()
+            self._file.write(line + '\n')
+            self._file.flush()
+            self._index_file.write(index_line + '\n')
+            self._index_file.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+
+    def _open(self) -> None:
+        # Drop a line truncated by a crash, so that the next record starts on its own line
+        _truncate_partial_line(self.path)
+        _truncate_partial_line(self.index_path)
+        if self.exists() and not os.path.exists(self.index_path):
+            self._write_index(self._scan_ids())
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._index_file = open(self.index_path, 'a', encoding='utf-8')
+
+    def _sync(self) -> None:
+        os.fsync(self._file.fileno())
+        os.fsync(self._index_file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._index_file.close()
+                self._file = None
+                self._index_file = None
+
+    def read_ids(self) -> dict:
+        """Map every id in the checkpoint to whether it has a valid result."""
+        if not self.exists():
+            return {}
+        if not os.path.exists(self.index_path):
+            ids = self._scan_ids()
+            self._write_index(ids)
+            return ids
+
+        ids = {}
+        with open(self.index_path, encoding='utf-8') as f:
+            for line in f:
+                valid, _, id_ = line.rstrip('\n').partition('\t')
+                try:
+                    id_ = json.loads(id_)
+                except json.JSONDecodeError:  # e.g. a line truncated by a crash
+                    continue
+                ids[id_] = ids.get(id_, False) or valid == '1'
+        return ids
+
+    def completed_ids(self) -> set:
+        """Ids that already have a valid result."""
+        return {id_ for id_, valid in self.read_ids().items() if valid}
+
+    def _write_index(self, ids: dict) -> None:
+        with open(self.index_path, 'w', encoding='utf-8') as f:
+            for id_, valid in ids.items():
+                f.write(f"{int(valid)}\t{json.dumps(id_, ensure_ascii=False)}\n")
+
+    def _scan_ids(self) -> dict:
+        """Rebuild the id index from the log itself."""
+        ids = {}
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                match = _RECORD_PREFIX.match(line)
+                if match is None:  # e.g. a line truncated by a crash
+                    continue
+                id_ = json.loads(match['id'])
+                ids[id_] = ids.get(id_, False) or match['valid'] == 'true'
+        return ids
+
+    def read_results(self) -> list[dict]:
+        """Compact the checkpoint into one result per id, preferring the last valid one."""
+        results = {}
+        if not self.exists():
+            return []
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                previous = results.get(result['id'])
+                if previous is None or result['valid'] or not previous['valid']:
+                    results[result['id']] = result
+        return list(results.values())
+
+
+def _truncate_partial_line(path: str, block_size: int = 1 << 16) -> None:
+    """Cut `path` after its last newline, if it exists."""
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - block_size)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        f.truncate(end)
@@ -0,0 +1,81 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class LatencyHistogram:
+    """Thread-safe histogram of latencies on log-spaced buckets.
+
+    Latencies between `min_latency` and `max_latency` seconds fall in buckets
+    `10 ** (1 / buckets_per_decade)` apart, so percentiles are exact to within a
+    few percent whatever the number of recorded calls. Values outside the range
+    are clamped to the first or last bucket.
+
+    Args:
+        name (str): Name used in the summary.
+        min_latency (float): Upper bound of the first bucket, in seconds.
+        max_latency (float): Lower bound of the last bucket, in seconds.
+        buckets_per_decade (int): Resolution of the histogram.
+    """
+    def __init__(
+            self,
+            name: str,
+            min_latency: float = 1e-4,
+            max_latency: float = 100.0,
+            buckets_per_decade: int = 20,
+        ):
+        self.name = name
+        self.min_latency = min_latency
+        self.buckets_per_decade = buckets_per_decade
+        num_buckets = math.ceil(math.log10(max_latency / min_latency) * buckets_per_decade) + 1
+        # Upper bound of each bucket, the last one is open-ended
+        self.bounds = min_latency * 10 ** (np.arange(num_buckets) / buckets_per_decade)
+        self.counts = np.zeros(num_buckets, dtype=np.int64)
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        position = math.ceil(math.log10(max(seconds, self.min_latency) / self.min_latency) * self.buckets_per_decade)
+        with self._lock:
+            self.counts[min(position, len(self.counts) - 1)] += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    @contextmanager
+    def time(self):
+        """Record the duration of the `with` block, whether or not it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(time.perf_counter() - start)
+
+    @property
+    def count(self) -> int:
+        return int(self.counts.sum())
+
+    def percentile(self, q: float) -> float:
+        """Upper bound of the bucket holding the `q`-th percentile, in seconds."""
+        with self._lock:
+            counts = self.counts.copy()
+        if not counts.any():
+            return 0.0
+        position = int(np.searchsorted(np.cumsum(counts), q / 100 * counts.sum()))
+        return float(min(self.bounds[position], self.max))
+
+    def summary(self) -> dict:
+        """Count, mean, p50, p90, p99 and max latencies, in milliseconds."""
+        count = self.count
+        return {
+            'count': count,
+            'mean_ms': round(1000 * self.total / count, 2) if count else 0.0,
+            **{f'p{q}_ms': round(1000 * self.percentile(q), 2) for q in (50, 90, 99)},
+            'max_ms': round(1000 * self.max, 2),
+        }
+
+    def __repr__(self) -> str:
+        return f'LatencyHistogram({self.name!r}, {self.summary()})'
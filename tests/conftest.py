@@ -0,0 +1,73 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from importlib import import_module
+
+import pytest
+
+try:
+    conf = import_module("src.configs.real_config")
+except ImportError:
+    conf = import_module("src.configs.config")
+
+# `src.llms` only exports GPT, which the metrics import, when a GPT endpoint is configured
+if conf.GPT_api_key == '' and conf.GPT_transit_url == '':
+    conf.GPT_transit_url = 'http://127.0.0.1:9/v1/chat/completions'
+
+
+class StubServer(ThreadingHTTPServer):
+    """HTTP server answering every POST with `respond(body)`, by default a 200 echo of the JSON body.
+
+    `respond` returns the status, the headers and the JSON body of the answer, or
+    sleeps first to simulate a slow model. Requests are recorded with their arrival
+    time, along with the largest number of requests handled at the same time.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _StubHandler)
+        self.url = f'http://127.0.0.1:{self.server_port}/v1/chat/completions'
+        self.respond = lambda body: (200, {}, body)
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        pass  # e.g. a client that timed out before the answer
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with server.lock:
+            server.requests.append((time.monotonic(), body))
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            status, headers, answer = server.respond(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+        data = json.dumps(answer).encode('utf-8')
+        self.send_response(status)
+        for name, value in {'Content-Type': 'application/json', **headers}.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,69 @@
+import asyncio
+import importlib
+import sys
+import types
+
+import pytest
+
+
+class FakeCompletions:
+    """Records the arguments of `chat.completions.create` and echoes the prompt back."""
+    def __init__(self):
+        self.calls = []
+
+    def _response(self, kwargs):
+        self.calls.append(kwargs)
+        message = types.SimpleNamespace(content=f"<response>{kwargs['messages'][0]['content']}</response> and more")
+        return types.SimpleNamespace(
+            choices=[types.SimpleNamespace(message=message)], usage=types.SimpleNamespace(total_tokens=1),
+        )
+
+    def create(self, **kwargs):
+        return self._response(kwargs)
+
+
+class FakeAsyncCompletions(FakeCompletions):
+    async def create(self, **kwargs):
+        return self._response(kwargs)
+
+
+@pytest.fixture
+def openai(monkeypatch):
+    """A fake `openai` client module, with `src.llms.api_model` imported against it."""
+    fake = types.ModuleType('openai')
+    fake.chat = types.SimpleNamespace(completions=FakeCompletions())
+    async_completions = FakeAsyncCompletions()
+    fake.AsyncOpenAI = lambda **kwargs: types.SimpleNamespace(chat=types.SimpleNamespace(completions=async_completions))
+    fake.async_completions = async_completions
+    monkeypatch.setitem(sys.modules, 'openai', fake)
+    monkeypatch.delitem(sys.modules, 'src.llms.api_model', raising=False)
+    yield fake
+    sys.modules.pop('src.llms.api_model', None)
+
+
+@pytest.fixture
+def gpt(openai):
+    return importlib.import_module('src.llms.api_model').GPT()
+
+
+def test_request_without_stop(gpt, openai):
+    assert gpt.request('hello') == '<response>hello</response> and more'
+    assert gpt.safe_request('hello') == '<response>hello</response> and more'
+    assert [call['stop'] for call in openai.chat.completions.calls] == [None, None]
+
+
+def test_arequest_without_stop(gpt, openai):
+    assert asyncio.run(gpt.arequest('hello')) == '<response>hello</response> and more'
+    assert asyncio.run(gpt.asafe_request('hello')) == '<response>hello</response> and more'
+    assert [call['stop'] for call in openai.async_completions.calls] == [None, None]
+
+
+def test_asafe_request_with_stop(gpt, openai):
+    assert asyncio.run(gpt.asafe_request('hello', stop=['</response>'])) == '<response>hello'
+    assert openai.async_completions.calls[-1]['stop'] == ['</response>']
+
+
+def test_safe_request_with_stop_is_not_streamed(gpt, openai):
+    assert gpt.safe_request('hello', stop=['</response>']) == '<response>hello'
+    assert openai.chat.completions.calls[-1]['stop'] == ['</response>']
+    assert 'stream' not in openai.chat.completions.calls[-1]
@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+tokenizers = pytest.importorskip('tokenizers')
+
+from src.llms.local_model import LocalLLM
+
+PROMPTS = ['w1 w2 w3', 'w4', 'w5 w6 w7 w8 w9 w10', 'w11 w12']
+
+
+@pytest.fixture(scope='module')
+def tiny_lm():
+    """A random-weight GPT-2 with a word-level tokenizer, small enough to generate on CPU."""
+    vocab = {'[PAD]': 0, '[UNK]': 1, '[EOS]': 2, **{f'w{i}': i + 3 for i in range(61)}}
+    backend = tokenizers.Tokenizer(tokenizers.models.WordLevel(vocab, unk_token='[UNK]'))
+    backend.pre_tokenizer = tokenizers.pre_tokenizers.WhitespaceSplit()
+    tokenizer = transformers.PreTrainedTokenizerFast(
+        tokenizer_object=backend, unk_token='[UNK]', pad_token='[PAD]', eos_token='[EOS]',
+    )
+    torch.manual_seed(0)
+    config = transformers.GPT2Config(
+        vocab_size=len(vocab), n_positions=64, n_embd=32, n_layer=2, n_head=2, initializer_range=0.5,
+        bos_token_id=2, eos_token_id=2, pad_token_id=0,
+    )
+    # Double precision, so that padding cannot flip a greedy choice by rounding
+    model = transformers.GPT2LMHeadModel(config).double().eval()
+    return tokenizer, model
+
+
+@pytest.fixture
+def llm(tiny_lm):
+    llm = LocalLLM('tiny', max_new_tokens=6, max_batch_size=len(PROMPTS), max_wait=1.0)
+    llm.tokenizer, llm.model = tiny_lm
+    # Greedy, and never ending early on EOS, so that every output is compared in full
+    llm.gen_kwargs = {'do_sample': False, 'max_new_tokens': 6, 'min_new_tokens': 6}
+    return llm
+
+
+def count_generate_calls(llm, monkeypatch) -> list[int]:
+    batch_sizes = []
+    generate = llm.model.generate
+
+    def counting_generate(*args, **kwargs):
+        batch_sizes.append(len(kwargs['input_ids']))
+        return generate(*args, **kwargs)
+    monkeypatch.setattr(llm.model, 'generate', counting_generate)
+    return batch_sizes
+
+
+def test_batched_greedy_outputs_match_single_prompts(llm):
+    singles = [llm.generate_batch([(prompt, ())])[0] for prompt in PROMPTS]
+    assert all(singles)
+    assert llm.generate_batch([(prompt, ()) for prompt in PROMPTS]) == singles
+
+
+def test_batched_outputs_end_at_their_own_stop_sequences(llm):
+    singles = [llm.generate_batch([(prompt, ())])[0] for prompt in PROMPTS]
+    # Stop at the third generated word of the first prompt only
+    stop = singles[0].split()[2]
+    batch = llm.generate_batch([(PROMPTS[0], (stop,)), *((prompt, ()) for prompt in PROMPTS[1:])])
+    assert batch[0] == singles[0][:singles[0].index(stop)]
+    assert batch[1:] == singles[1:]
+
+
+def test_concurrent_requests_share_one_generate_call(llm, monkeypatch):
+    expected = [llm.generate_batch([(prompt, ())])[0] for prompt in PROMPTS]
+    batch_sizes = count_generate_calls(llm, monkeypatch)
+    results = [None] * len(PROMPTS)
+
+    def request(index):
+        results[index] = llm.request(PROMPTS[index])
+    threads = [threading.Thread(target=request, args=(index,)) for index in range(len(PROMPTS))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert batch_sizes == [len(PROMPTS)]
+    assert results == expected
@@ -0,0 +1,128 @@
+import asyncio
+import time
+
+import pytest
+
+from src.llms import remote_model
+from src.llms.remote_model import GPT, RemoteLLM, _SelfHostedChat
+from src.llms.transport import close_async_session
+
+
+def chat_completion(content: str) -> dict:
+    return {'choices': [{'message': {'content': content}}], 'usage': {'total_tokens': 1}}
+
+
+def answer_chat(body: dict, delay: float = 0.0) -> tuple[int, dict, dict]:
+    """Answer like a chat completion API, which ends the content before the stop sequence."""
+    time.sleep(delay)
+    content = f"<response>{body['messages'][0]['content']}</response> and more"
+    for stop in body.get('stop') or []:
+        content = content.split(stop)[0]
+    return 200, {}, chat_completion(content)
+
+
+class SelfHosted(_SelfHostedChat):
+    url = None
+
+    def endpoint(self) -> tuple[str, str]:
+        return self.url, 'token'
+
+
+@pytest.fixture
+def gpt(stub_server, monkeypatch):
+    monkeypatch.setattr(remote_model.conf, 'GPT_transit_url', stub_server.url)
+    stub_server.respond = answer_chat
+    return GPT()
+
+
+def run(coroutine):
+    async def main():
+        try:
+            return await coroutine
+        finally:
+            await close_async_session()
+    return asyncio.run(main())
+
+
+def test_remote_llms_are_abstract():
+    with pytest.raises(TypeError):
+        RemoteLLM()
+    with pytest.raises(TypeError):
+        _SelfHostedChat()
+
+
+def test_arequest_matches_request(gpt, stub_server):
+    assert gpt.request('hello') == '<response>hello</response> and more'
+    assert run(gpt.arequest('hello')) == '<response>hello</response> and more'
+    assert run(gpt.asafe_request('hello')) == '<response>hello</response> and more'
+    assert len(stub_server.requests) == 3
+
+
+def test_asafe_request_sends_stop(gpt, stub_server):
+    assert run(gpt.asafe_request('hello', stop=['</response>'])) == '<response>hello'
+    assert stub_server.requests[-1][1]['stop'] == ['</response>']
+
+
+def test_safe_request_sends_stop_without_streaming(gpt, stub_server):
+    assert gpt.safe_request('hello', stop=['</response>']) == '<response>hello'
+    assert stub_server.requests[-1][1]['stop'] == ['</response>']
+    assert 'stream' not in stub_server.requests[-1][1]
+
+
+def test_asafe_request_cuts_responses_at_stop(stub_server):
+    stub_server.respond = lambda body: (200, {}, {'choices': [f"{body['prompt']}</response> and more"]})
+    model = SelfHosted()
+    model.url = stub_server.url
+    assert run(model.asafe_request('hello')) == 'hello</response> and more'
+    assert run(model.asafe_request('hello', stop=['</response>'])) == 'hello'
+
+
+def test_asafe_request_returns_empty_on_error(gpt, stub_server):
+    stub_server.respond = lambda body: (400, {}, {'error': 'bad request'})
+    assert run(gpt.asafe_request('hello')) == ''
+    assert len(stub_server.requests) == 1
+
+
+def test_async_evaluator_overlaps_requests(gpt, stub_server, tmp_path):
+    from evaluator import AsyncEvaluator
+    from src.tasks.base import BaseTask
+
+    class Retriever:
+        collection_name = 'docs'
+        similarity_top_k = 2
+        thread_safe = True
+
+        def search_docs(self, query_text: str) -> str:
+            return f'context of {query_text}'
+
+    class EchoTask(BaseTask):
+        def set_model(self, model, retriever):
+            self.model = model
+            self.retriever = retriever
+
+        def retrieve_docs(self, obj: dict) -> str:
+            return self.retriever.search_docs(obj['question'])
+
+        def build_query(self, obj: dict) -> str:
+            return obj['retrieve_context']
+
+        def scoring(self, data_point: dict) -> dict:
+            return {'metrics': {}, 'log': {'generated_text': data_point['generated_text']}, 'valid': True}
+
+    delay = 0.3
+    stub_server.respond = lambda body: answer_chat(body, delay)
+    dataset = [{'ID': str(i), 'question': f'question {i}'} for i in range(8)]
+    evaluator = AsyncEvaluator(
+        EchoTask(output_dir=str(tmp_path)), gpt, Retriever(), dataset, output_dir=str(tmp_path), max_concurrency=8,
+    )
+
+    start = time.perf_counter()
+    output = evaluator.run(show_progress_bar=False)
+    elapsed = time.perf_counter() - start
+
+    assert [result['log']['generated_text'] for result in output['results']] == [
+        f'context of question {i}' for i in range(8)
+    ]
+    assert all(body['stop'] == EchoTask.stop_sequences for _, body in stub_server.requests)
+    assert stub_server.max_active > 1
+    assert elapsed < len(dataset) * delay / 2
@@ -0,0 +1,141 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from src.llms import transport
+from src.llms.transport import HTTPTransport, close_async_session
+
+OK = (200, {}, {'ok': True})
+RATE_LIMITED = (429, {'Retry-After': '0.3'}, {'error': 'rate limited'})
+UNAVAILABLE = (503, {}, {'error': 'unavailable'})
+
+
+def script(stub_server, *answers, delays=()):
+    """Answer the requests in turn with `answers`, repeating the last one, after the given delays."""
+    def respond(body):
+        index = len(stub_server.requests) - 1
+        if index < len(delays):
+            time.sleep(delays[index])
+        return answers[min(index, len(answers) - 1)]
+    stub_server.respond = respond
+
+
+def gaps(stub_server) -> list[float]:
+    times = [arrival for arrival, _ in stub_server.requests]
+    return [later - earlier for earlier, later in zip(times, times[1:])]
+
+
+@pytest.fixture(autouse=True)
+def longest_backoff(monkeypatch):
+    # Full jitter picks a delay up to the backoff, always take the upper bound
+    monkeypatch.setattr(transport.random, 'uniform', lambda low, high: high)
+
+
+@pytest.fixture(params=['sync', 'async'])
+def post(request):
+    """`HTTPTransport.post` or `apost` on the stub server, both returning the decoded JSON body."""
+    if request.param == 'sync':
+        return lambda http, url, payload: http.post(url, data=json.dumps(payload)).json()
+
+    def apost(http, url, payload):
+        async def main():
+            try:
+                return await http.apost(url, data=json.dumps(payload))
+            finally:
+                await close_async_session()
+        return asyncio.run(main())
+    return apost
+
+
+def test_retries_with_exponential_backoff(stub_server, post):
+    script(stub_server, UNAVAILABLE, UNAVAILABLE, UNAVAILABLE, OK)
+    http = HTTPTransport(max_retries=4, backoff_base=0.05)
+    assert post(http, stub_server.url, {}) == {'ok': True}
+    assert len(stub_server.requests) == 4
+    for gap, backoff in zip(gaps(stub_server), [0.05, 0.1, 0.2]):
+        assert gap >= backoff
+
+
+def test_honours_retry_after(stub_server, post):
+    script(stub_server, RATE_LIMITED, OK)
+    http = HTTPTransport(max_retries=4, backoff_base=0.01)
+    assert post(http, stub_server.url, {}) == {'ok': True}
+    assert len(stub_server.requests) == 2
+    assert gaps(stub_server)[0] >= 0.3
+
+
+def test_retry_after_is_capped_by_backoff_max(stub_server, post):
+    script(stub_server, (429, {'Retry-After': '60'}, {}), OK)
+    http = HTTPTransport(max_retries=4, backoff_max=0.1)
+    assert post(http, stub_server.url, {}) == {'ok': True}
+    assert gaps(stub_server)[0] < 5
+
+
+def test_fails_only_after_the_last_retry(stub_server, post):
+    script(stub_server, UNAVAILABLE)
+    http = HTTPTransport(max_retries=2, backoff_base=0.01)
+    with pytest.raises(Exception) as info:
+        post(http, stub_server.url, {})
+    assert '503' in str(info.value)
+    assert len(stub_server.requests) == 3
+
+
+def test_client_errors_are_not_retried(stub_server, post):
+    script(stub_server, (400, {}, {'error': 'bad request'}), OK)
+    http = HTTPTransport(max_retries=4, backoff_base=0.01)
+    with pytest.raises(Exception):
+        post(http, stub_server.url, {})
+    assert len(stub_server.requests) == 1
+
+
+def test_retries_timed_out_requests(stub_server, post):
+    script(stub_server, OK, delays=[1.0])
+    http = HTTPTransport(max_retries=4, backoff_base=0.01, timeout=0.3)
+    assert post(http, stub_server.url, {}) == {'ok': True}
+    assert len(stub_server.requests) == 2
+
+
+def test_waits_for_slow_responses(stub_server, post):
+    script(stub_server, OK, delays=[0.5])
+    http = HTTPTransport(max_retries=0, timeout=5)
+    assert post(http, stub_server.url, {}) == {'ok': True}
+    assert len(stub_server.requests) == 1
+
+
+def test_token_bucket_caps_sync_request_rate(stub_server):
+    from concurrent.futures import ThreadPoolExecutor
+
+    rate, num_requests = 20, 40
+    http = HTTPTransport(rate_limits={stub_server.url: rate})
+    start = time.monotonic()
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda _: http.post(stub_server.url, data='{}'), range(num_requests)))
+    # The bucket starts full, with `rate` tokens
+    assert time.monotonic() - start >= 0.9 * (num_requests - rate) / rate
+    assert len(stub_server.requests) == num_requests
+
+
+def test_token_bucket_caps_async_request_rate(stub_server):
+    rate, num_requests = 20, 40
+    http = HTTPTransport(rate_limits={stub_server.url: rate})
+
+    async def main():
+        try:
+            return await asyncio.gather(*(http.apost(stub_server.url, data='{}') for _ in range(num_requests)))
+        finally:
+            await close_async_session()
+
+    start = time.monotonic()
+    asyncio.run(main())
+    assert time.monotonic() - start >= 0.9 * (num_requests - rate) / rate
+    assert len(stub_server.requests) == num_requests
+
+
+def test_token_bucket_only_limits_its_endpoint(stub_server):
+    http = HTTPTransport(rate_limits={'http://127.0.0.1:9/other': 1})
+    start = time.monotonic()
+    for _ in range(5):
+        http.post(stub_server.url, data='{}')
+    assert time.monotonic() - start < 1
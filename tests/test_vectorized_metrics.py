@@ -0,0 +1,63 @@
+import math
+
+import numpy as np
+import pytest
+
+from src.metric.common import bleu_score, rougeL_score
+from src.metric.vectorized import Vocabulary, batch_bleu, batch_rougeL, bleu_scores, rougeL_scores
+
+PAIRS = [
+    ('国家统计局今天发布数据，上半年国内生产总值同比增长5.5%。', '国家统计局发布数据显示，上半年国内生产总值同比增长5.5%，经济运行总体平稳。'),
+    ('新华社北京电 记者从交通运输部获悉，春运期间全国铁路累计发送旅客4.8亿人次。', '春运期间，全国铁路累计发送旅客4.8亿人次，同比增长38%。'),
+    ('会议强调，要坚持稳中求进工作总基调。', '会议强调，要坚持稳中求进工作总基调，完整、准确、全面贯彻新发展理念。'),
+    ('好的好的好的好的', '好的'),
+    ('好的', '好的好的好的好的'),
+    ('今天天气很好', '明天天气不好'),
+    ('完全不同的一句话', '另外一段毫无关系的文字'),
+    ('The quick brown fox jumps over the lazy dog', 'the quick brown fox jumped over a lazy dog'),
+    ('一模一样的句子。', '一模一样的句子。'),
+    ('好', '好'),
+    ('今天', '明天'),
+    ('   ', '今天'),
+    # `bleu_score` fails on empty texts, `rougeL_score` scores them 0
+    ('', '今天天气很好'),
+    ('今天天气很好', ''),
+    ('', ''),
+]
+
+
+@pytest.mark.parametrize('with_penalty', [False, True])
+def test_bleu_matches_bleu_score(with_penalty):
+    scores = bleu_scores([c for c, _ in PAIRS], [r for _, r in PAIRS], with_penalty=with_penalty)
+    for (continuation, reference), row in zip(PAIRS, scores):
+        expected = bleu_score(continuation, reference, with_penalty=with_penalty)
+        if expected is None:
+            assert np.isnan(row).all()
+        else:
+            np.testing.assert_allclose(row, expected, rtol=0, atol=1e-9)
+
+
+def test_rougeL_matches_rougeL_score():
+    scores = rougeL_scores([c for c, _ in PAIRS], [r for _, r in PAIRS])
+    for (continuation, reference), score in zip(PAIRS, scores):
+        assert math.isclose(score, rougeL_score(continuation, reference), rel_tol=0, abs_tol=1e-9)
+
+
+def test_scores_do_not_depend_on_the_batch():
+    vocab = Vocabulary()
+    predictions = vocab.encode_texts([c for c, _ in PAIRS])
+    references = vocab.encode_texts([r for _, r in PAIRS])
+    batch = batch_bleu(predictions, references)
+    singles = np.vstack([batch_bleu([p], [r]) for p, r in zip(predictions, references)])
+    np.testing.assert_array_equal(np.isnan(batch), np.isnan(singles))
+    np.testing.assert_allclose(batch, singles, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(
+        batch_rougeL(predictions, references),
+        np.concatenate([batch_rougeL([p], [r]) for p, r in zip(predictions, references)]),
+        rtol=0, atol=1e-12,
+    )
+
+
+def test_empty_batches():
+    assert batch_bleu([], []).shape == (0, 5)
+    assert batch_rougeL([], []).shape == (0,)